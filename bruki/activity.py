@@ -10,7 +10,8 @@ import pandas as pd
 from PIL import Image
 
 from bruki import plots
-from bruki.config import ConfigModel, load_config, resolve_events, resolve_paths
+from bruki.config import ConfigModel, load_config, resolve_events
+from bruki.inventory import resolve_paths
 
 
 def parse_timestamp(filename: str, patterns: list[dict[str, Any]]) -> datetime | None:
@@ -82,6 +82,21 @@ def resolve_events(
     return [events_map[event_name] for event_name in event_references]
 
 
+def is_image_match(
+    relative_path: Path,
+    extension_set: set[str],
+    exclude_directories: list[str],
+    anti_patterns: list[str],
+) -> bool:
+    if relative_path.suffix.lower() not in extension_set:
+        return False
+    if any(exclude_directory in relative_path.parts for exclude_directory in exclude_directories):
+        return False
+    return not any(
+        fnmatch.fnmatch(relative_path.name, anti_pattern) for anti_pattern in anti_patterns
+    )
+
+
 def list_image_paths(
     source_spec: SourceConfig,
     extensions: list[str],
@@ -90,22 +105,14 @@ def list_image_paths(
     root_path = Path(source_spec.path).expanduser()
     if not root_path.exists():
         return []
-    exclude_directories = source_spec.exclude
     extension_set = {extension.lower() for extension in extensions}
     matches: list[Path] = []
     for file_path in root_path.rglob("*"):
         if not file_path.is_file():
             continue
-        if file_path.suffix.lower() not in extension_set:
-            continue
         relative_path = file_path.relative_to(root_path)
-        if any(
-            exclude_directory in relative_path.parts for exclude_directory in exclude_directories
-        ):
-            continue
-        if any(fnmatch.fnmatch(file_path.name, anti_pattern) for anti_pattern in anti_patterns):
-            continue
-        matches.append(file_path)
+        if is_image_match(relative_path, extension_set, source_spec.exclude, anti_patterns):
+            matches.append(file_path)
     return sorted(matches)
 
 
@@ -2,6 +2,7 @@ from __future__ import annotations
 
 import importlib
 import time
+from collections.abc import Iterator
 from dataclasses import dataclass
 from pathlib import Path
 
@@ -10,14 +11,28 @@ import joblib
 import numpy as np
 import torch
 import umap
-from PIL import Image
 from tqdm import tqdm
 
+from bruki.server.ml import (
+    DECODE_SIZE,
+    BackendConfig,
+    VisionBackend,
+    decode_image,
+    iter_decoded_batches,
+    load_backend,
+)
+from bruki.server.service import connect as connect_service
+
 
 @dataclass(frozen=True)
 class EmbedConfig:
     min_size: int = 10
     checkpoint_every: int = 100
+    graph_cache_dir: Path = Path("data/notebook/models")
+    use_service: bool = True
+    decode_size: int = DECODE_SIZE
+    decode_workers: int = 0
+    decode_batch: int = 16
 
 
 @dataclass(frozen=True)
@@ -39,8 +54,17 @@ _HF_LOADERS = {
 }
 
 
-def load_model(spec: dict):
+def load_model(spec: dict, config: EmbedConfig | None = None):
     name, backend = spec["name"], spec["backend"]
+    runtime = spec.get("runtime", "torch")
+    if runtime != "torch" or spec.get("quantize", False):
+        if spec.get("family") != "clip":
+            raise RuntimeError(f"runtime {runtime} only supports the clip family")
+        cache_dir = (config or EmbedConfig()).graph_cache_dir
+        backend_config = BackendConfig(name=runtime, quantize=spec.get("quantize", False))
+        encoder = load_backend(name, backend_config, cache_dir, local_files_only=False)
+        return encoder, encoder.processor, torch.device("cpu")
+
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
     if backend == "open_clip_hf":
@@ -59,13 +83,7 @@ def load_model(spec: dict):
 
 
 def prepare_image(path: Path, config: EmbedConfig):
-    try:
-        with Image.open(path) as img:
-            if img.size[0] < config.min_size or img.size[1] < config.min_size:
-                return None
-            return img.convert("RGB")
-    except OSError:
-        return None
+    return decode_image(str(path), target_size=config.decode_size, min_size=config.min_size)
 
 
 def _send(inputs: dict, device) -> dict:
@@ -85,6 +103,8 @@ def _cls_token(outputs) -> torch.Tensor:
 def encode_features(spec: dict, model, processor, image, device) -> torch.Tensor:
     backend, family = spec["backend"], spec["family"]
 
+    if isinstance(model, VisionBackend):
+        return torch.from_numpy(model.encode([image]))
     if backend == "open_clip_hf":
         features = model.encode_image(processor(image).unsqueeze(0).to(device))
     elif family == "clip":
@@ -103,6 +123,40 @@ def encode_features(spec: dict, model, processor, image, device) -> torch.Tensor
     return features / features.norm(dim=-1, keepdim=True)
 
 
+def _service_compatible(spec: dict) -> bool:
+    return spec["family"] == "clip" and spec["backend"] != "open_clip_hf"
+
+
+def _iter_service_vectors(client, spec: dict, paths: list[str]) -> Iterator[np.ndarray | None]:
+    backend = BackendConfig(name=spec.get("runtime", "torch"), quantize=spec.get("quantize", False))
+    for _, vectors, valid in client.iter_embeddings(paths, spec["name"], backend):
+        for vec, ok in zip(vectors, valid, strict=True):
+            yield vec if ok else None
+
+
+def _iter_local_vectors(
+    spec: dict,
+    loaded: tuple,
+    paths: list[str],
+    config: EmbedConfig,
+) -> Iterator[np.ndarray | None]:
+    model, processor, device = loaded
+    batches = iter_decoded_batches(
+        paths,
+        batch_size=config.decode_batch,
+        target_size=config.decode_size,
+        workers=config.decode_workers,
+    )
+    with torch.inference_mode():
+        for _, images in batches:
+            for image in images:
+                if image is None:
+                    yield None
+                    continue
+                features = encode_features(spec, model, processor, image, device)
+                yield features.cpu().numpy()[0].astype(np.float32)
+
+
 def load_or_embed(spec: dict, paths: list[Path], cache_dir: Path, config: EmbedConfig):
     model_name = spec["name"]
     cache_file = cache_dir / f"{model_name.replace('/', '__')}.pkl"
@@ -144,21 +198,22 @@ def load_or_embed(spec: dict, paths: list[Path], cache_dir: Path, config: EmbedC
             "elapsed_s": 0.0,
         }, "hit"
 
-    model, processor, device = load_model(spec)
-    started = time.perf_counter()
-
-    with torch.inference_mode():
-        for step, i in enumerate(tqdm(pending, desc=f"embed:{model_name}"), start=1):
-            image = prepare_image(Path(path_strings[i]), config)
-            if image is None:
+    pending_paths = [path_strings[i] for i in pending]
+    client = connect_service() if config.use_service and _service_compatible(spec) else None
+    if client is not None:
+        started = time.perf_counter()
+        vectors = _iter_service_vectors(client, spec, pending_paths)
+    else:
+        loaded = load_model(spec, config)
+        started = time.perf_counter()
+        vectors = _iter_local_vectors(spec, loaded, pending_paths, config)
+
+    with tqdm(total=len(pending), desc=f"embed:{model_name}") as bar:
+        for step, (i, vec) in enumerate(zip(pending, vectors, strict=True), start=1):
+            bar.update(1)
+            if vec is None:
                 valid_mask[i] = False
             else:
-                vec = (
-                    encode_features(spec, model, processor, image, device)
-                    .cpu()
-                    .numpy()[0]
-                    .astype(np.float32)
-                )
                 if embeddings is None:
                     embeddings = np.zeros((n, vec.shape[0]), dtype=np.float32)
                 embeddings[i] = vec
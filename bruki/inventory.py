@@ -0,0 +1,339 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from bruki.config import ConfigModel, SourceConfig, is_image_match
+from bruki.server import database
+
+INVENTORY_DB = Path("data/inventory.sqlite3")
+# Directories modified this recently are rescanned next time: a file added within the
+# same timestamp tick as the listing would not move the directory mtime again.
+RACY_WINDOW_NS = 2_000_000_000
+
+_SCAN_LOCK = threading.Lock()
+
+
+@dataclass(frozen=True)
+class SourceScan:
+    series: str
+    source: str
+    root: Path
+    root_id: int
+    generation: int
+    file_count: int
+    changed_paths: tuple[str, ...] = ()
+    removed_paths: tuple[str, ...] = ()
+
+
+@dataclass
+class ScanStats:
+    scanned_dirs: int = 0
+    skipped_dirs: int = 0
+    added_files: int = 0
+    updated_files: int = 0
+    changed_paths: list[str] = field(default_factory=list)
+    removed_paths: list[str] = field(default_factory=list)
+
+    @property
+    def changed(self) -> bool:
+        return bool(self.changed_paths or self.removed_paths)
+
+
+def source_spec_key(
+    source_spec: SourceConfig,
+    extensions: list[str],
+    anti_patterns: list[str],
+) -> str:
+    spec = {
+        "exclude": sorted(source_spec.exclude),
+        "extensions": sorted(extension.lower() for extension in extensions),
+        "anti_patterns": sorted(anti_patterns),
+    }
+    return hashlib.sha1(json.dumps(spec, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def next_generation(conn: sqlite3.Connection) -> int:
+    conn.execute(
+        """
+        INSERT INTO inventory_meta(id, generation) VALUES (1, 1)
+        ON CONFLICT(id) DO UPDATE SET generation = generation + 1
+        """
+    )
+    (generation,) = conn.execute("SELECT generation FROM inventory_meta WHERE id = 1").fetchone()
+    return int(generation)
+
+
+def scan_root(
+    conn: sqlite3.Connection,
+    root_id: int,
+    root_path: Path,
+    source_spec: SourceConfig,
+    extension_set: set[str],
+    anti_patterns: list[str],
+    full: bool = False,
+    dirs: set[str] | None = None,
+) -> ScanStats:
+    # With ``dirs`` only those directories, plus subdirectories new to the index, are listed.
+    stats = ScanStats()
+    root = str(root_path)
+    known_dirs = dict(
+        conn.execute("SELECT dir_path, mtime_ns FROM inventory_dir WHERE root_id = ?", (root_id,))
+    )
+    children: dict[str, list[str]] = {}
+    for dir_path in known_dirs:
+        if dir_path != root:
+            children.setdefault(os.path.dirname(dir_path), []).append(dir_path)
+
+    targeted = dirs is not None
+    if not root_path.is_dir():
+        stack: list[str] = []
+    elif dirs is not None:
+        stack = sorted(
+            dir_path for dir_path in dirs if dir_path == root or dir_path.startswith(root + os.sep)
+        )
+    else:
+        stack = [root]
+    forced = set(stack) if targeted else set()
+    seen_dirs: set[str] = set()
+    visited: set[tuple[int, int]] = set()
+    missing_dirs: set[str] = set()
+    dir_rows: list[tuple[int, str, int]] = []
+    upserts: list[tuple[int, str, str, int, int]] = []
+    removed: list[tuple[int, str]] = []
+    now_ns = time.time_ns()
+    while stack:
+        dir_path = stack.pop()
+        try:
+            dir_stat = os.stat(dir_path)
+        except OSError:
+            continue
+        if (dir_stat.st_dev, dir_stat.st_ino) in visited:
+            continue
+        visited.add((dir_stat.st_dev, dir_stat.st_ino))
+        seen_dirs.add(dir_path)
+        if not full and dir_path not in forced and known_dirs.get(dir_path) == dir_stat.st_mtime_ns:
+            stats.skipped_dirs += 1
+            if not targeted:
+                stack.extend(children.get(dir_path, ()))
+            continue
+
+        stats.scanned_dirs += 1
+        found: dict[str, tuple[int, int]] = {}
+        subdirs: set[str] = set()
+        try:
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    try:
+                        # Like the rglob scan this replaced, linked directories are not followed:
+                        # a link loop or a link to a large tree must not change what is indexed.
+                        if entry.is_dir(follow_symlinks=False):
+                            if entry.name not in source_spec.exclude:
+                                subdirs.add(entry.path)
+                            continue
+                        if not entry.is_file():
+                            continue
+                        relative_path = Path(entry.path).relative_to(root_path)
+                        if not is_image_match(
+                            relative_path, extension_set, source_spec.exclude, anti_patterns
+                        ):
+                            continue
+                        file_stat = entry.stat()
+                    except OSError:
+                        continue
+                    found[entry.path] = (int(file_stat.st_mtime_ns), int(file_stat.st_size))
+        except OSError:
+            continue
+        stack.extend(subdirs)
+        missing_dirs.update(child for child in children.get(dir_path, ()) if child not in subdirs)
+
+        previous = {
+            input_path: (mtime_ns, size_bytes)
+            for input_path, mtime_ns, size_bytes in conn.execute(
+                """
+                SELECT input_path, mtime_ns, size_bytes FROM inventory_file
+                WHERE root_id = ? AND dir_path = ?
+                """,
+                (root_id, dir_path),
+            )
+        }
+        for input_path, file_stat in found.items():
+            if input_path not in previous:
+                stats.added_files += 1
+            elif previous[input_path] != file_stat:
+                stats.updated_files += 1
+            else:
+                continue
+            stats.changed_paths.append(input_path)
+            upserts.append((root_id, input_path, dir_path, *file_stat))
+        removed.extend((root_id, input_path) for input_path in previous if input_path not in found)
+        racy = now_ns - dir_stat.st_mtime_ns < RACY_WINDOW_NS
+        dir_rows.append((root_id, dir_path, 0 if racy else int(dir_stat.st_mtime_ns)))
+
+    if targeted:
+        gone = {
+            dir_path
+            for dir_path in known_dirs
+            if any(
+                dir_path == missing or dir_path.startswith(missing + os.sep)
+                for missing in missing_dirs
+            )
+        }
+    else:
+        gone = set(known_dirs) - seen_dirs
+    gone_dirs = [(root_id, dir_path) for dir_path in sorted(gone)]
+    for _, dir_path in gone_dirs:
+        stats.removed_paths.extend(
+            input_path
+            for (input_path,) in conn.execute(
+                "SELECT input_path FROM inventory_file WHERE root_id = ? AND dir_path = ?",
+                (root_id, dir_path),
+            )
+        )
+    stats.removed_paths.extend(input_path for _, input_path in removed)
+    with conn:
+        conn.executemany(
+            "DELETE FROM inventory_file WHERE root_id = ? AND dir_path = ?",
+            gone_dirs,
+        )
+        conn.executemany(
+            "DELETE FROM inventory_dir WHERE root_id = ? AND dir_path = ?",
+            gone_dirs,
+        )
+        conn.executemany(
+            "DELETE FROM inventory_file WHERE root_id = ? AND input_path = ?",
+            removed,
+        )
+        conn.executemany(
+            """
+            INSERT INTO inventory_file(root_id, input_path, dir_path, mtime_ns, size_bytes)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(root_id, input_path) DO UPDATE SET
+                dir_path = excluded.dir_path,
+                mtime_ns = excluded.mtime_ns,
+                size_bytes = excluded.size_bytes
+            """,
+            upserts,
+        )
+        conn.executemany(
+            """
+            INSERT INTO inventory_dir(root_id, dir_path, mtime_ns) VALUES (?, ?, ?)
+            ON CONFLICT(root_id, dir_path) DO UPDATE SET mtime_ns = excluded.mtime_ns
+            """,
+            dir_rows,
+        )
+    return stats
+
+
+def scan_sources(
+    config: ConfigModel,
+    db_path: Path = INVENTORY_DB,
+    series: list[str] | None = None,
+    prefix: str | None = None,
+    full: bool = False,
+    dirs: set[str] | None = None,
+) -> list[SourceScan]:
+    series_names = sorted(config.data.keys()) if series is None else series
+    extension_set = {extension.lower() for extension in config.extensions}
+    scans: list[SourceScan] = []
+    with _SCAN_LOCK, database.connection(db_path) as conn:
+        for series_name in series_names:
+            if prefix is not None and not series_name.startswith(prefix):
+                continue
+            series_config = config.data[series_name]
+            anti_patterns = config.anti_patterns + series_config.anti_patterns
+            for source_name, source_spec in sorted(series_config.sources.items()):
+                root_path = Path(source_spec.path).expanduser()
+                spec_key = source_spec_key(source_spec, config.extensions, anti_patterns)
+                with conn:
+                    conn.execute(
+                        """
+                        INSERT OR IGNORE INTO inventory_root(
+                            root_path, spec_key, generation, file_count, scanned_at
+                        )
+                        VALUES (?, ?, 0, 0, 0)
+                        """,
+                        (str(root_path), spec_key),
+                    )
+                root_id, generation, file_count = conn.execute(
+                    """
+                    SELECT root_id, generation, file_count FROM inventory_root
+                    WHERE root_path = ? AND spec_key = ?
+                    """,
+                    (str(root_path), spec_key),
+                ).fetchone()
+                stats = scan_root(
+                    conn,
+                    root_id,
+                    root_path,
+                    source_spec,
+                    extension_set,
+                    anti_patterns,
+                    full=full,
+                    dirs=dirs,
+                )
+                with conn:
+                    if stats.changed or generation == 0:
+                        generation = next_generation(conn)
+                        (file_count,) = conn.execute(
+                            "SELECT COUNT(*) FROM inventory_file WHERE root_id = ?",
+                            (root_id,),
+                        ).fetchone()
+                    conn.execute(
+                        """
+                        UPDATE inventory_root
+                        SET generation = ?, file_count = ?, scanned_at = ?
+                        WHERE root_id = ?
+                        """,
+                        (generation, file_count, time.time(), root_id),
+                    )
+                scans.append(
+                    SourceScan(
+                        series=series_name,
+                        source=source_name,
+                        root=root_path,
+                        root_id=int(root_id),
+                        generation=int(generation),
+                        file_count=int(file_count),
+                        changed_paths=tuple(stats.changed_paths),
+                        removed_paths=tuple(stats.removed_paths),
+                    )
+                )
+    return scans
+
+
+def read_dirs(db_path: Path, scans: list[SourceScan]) -> list[str]:
+    with database.connection(db_path) as conn:
+        return [
+            dir_path
+            for scan in scans
+            for (dir_path,) in conn.execute(
+                "SELECT dir_path FROM inventory_dir WHERE root_id = ?",
+                (scan.root_id,),
+            )
+        ]
+
+
+def read_paths(db_path: Path, scan: SourceScan) -> list[Path]:
+    with database.connection(db_path) as conn:
+        rows = conn.execute(
+            "SELECT input_path FROM inventory_file WHERE root_id = ?",
+            (scan.root_id,),
+        ).fetchall()
+    return sorted(Path(input_path) for (input_path,) in rows)
+
+
+def resolve_paths(
+    config: ConfigModel,
+    db_path: Path = INVENTORY_DB,
+    series: list[str] | None = None,
+    prefix: str | None = None,
+) -> list[tuple[str, str, list[Path]]]:
+    return [
+        (scan.series, scan.source, read_paths(db_path, scan))
+        for scan in scan_sources(config, db_path, series=series, prefix=prefix)
+    ]
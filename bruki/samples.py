@@ -5,7 +5,8 @@ import json
 import random
 from pathlib import Path
 
-from bruki.config import load_config, resolve_paths
+from bruki.config import load_config
+from bruki.inventory import resolve_paths
 
 
 def parse_args() -> argparse.Namespace:
@@ -0,0 +1,419 @@
+import argparse
+import importlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from functools import cached_property
+from pathlib import Path
+
+import numpy as np
+
+from bruki.server import matrix as matrix_store
+
+NPROBE_ENV = "TAGGER_ANN_NPROBE"
+DEFAULT_NPROBE = 16
+LISTS_PER_SQRT_ROW = 4
+MIN_LISTS = 16
+MAX_LISTS = 4096
+MIN_INDEXED_ROWS = 2048
+TRAIN_SAMPLE_ROWS = 65536
+TRAIN_ROWS_PER_LIST = 32
+RETRAIN_GROWTH = 4.0
+SCORE_CHUNK_ROWS = 16384
+
+_INDEX_LOCK = threading.Lock()
+_INDEXES: dict[Path, "SearchIndex"] = {}
+
+
+@dataclass(frozen=True)
+class IndexInfo:
+    model: str
+    nlist: int
+    trained_rows: int
+    version: int
+
+
+@dataclass(frozen=True)
+class SearchIndex:
+    key: tuple[int, int, int, int]
+    model: str
+    paths: list[str]
+    rows: np.ndarray
+    matrix: np.ndarray
+    position: dict[str, int]
+    centroids: np.ndarray | None
+    offsets: np.ndarray
+    order: np.ndarray
+    unlisted: np.ndarray
+
+    @cached_property
+    def dense(self) -> np.ndarray:
+        # Full scans pay the float16 widening once per matrix generation, not per query.
+        dense = np.empty((len(self.rows), self.matrix.shape[1]), dtype=np.float32)
+        for start in range(0, len(self.rows), SCORE_CHUNK_ROWS):
+            chunk = self.rows[start : start + SCORE_CHUNK_ROWS]
+            dense[start : start + len(chunk)] = self.matrix[chunk]
+        return dense
+
+
+def default_nprobe() -> int:
+    return max(1, int(os.environ.get(NPROBE_ENV, DEFAULT_NPROBE)))
+
+
+def list_count(rows: int) -> int:
+    return int(np.clip(round(LISTS_PER_SQRT_ROW * rows**0.5), MIN_LISTS, MAX_LISTS))
+
+
+def read_index_info(conn: sqlite3.Connection) -> IndexInfo | None:
+    row = conn.execute(
+        "SELECT model, nlist, trained_rows, version FROM ann_meta WHERE id = 1"
+    ).fetchone()
+    return None if row is None else IndexInfo(*row)
+
+
+def write_index_info(conn: sqlite3.Connection, info: IndexInfo) -> None:
+    conn.execute(
+        """
+        INSERT INTO ann_meta(id, model, nlist, trained_rows, version, updated_at)
+        VALUES (1, ?, ?, ?, ?, ?)
+        ON CONFLICT(id) DO UPDATE SET
+            model = excluded.model,
+            nlist = excluded.nlist,
+            trained_rows = excluded.trained_rows,
+            version = excluded.version,
+            updated_at = excluded.updated_at
+        """,
+        (info.model, info.nlist, info.trained_rows, info.version, time.time()),
+    )
+
+
+def load_centroids(conn: sqlite3.Connection, dim: int) -> np.ndarray:
+    rows = conn.execute("SELECT centroid FROM ann_centroid ORDER BY list_id").fetchall()
+    if not rows:
+        return np.zeros((0, dim), dtype=np.float32)
+    return np.vstack([np.frombuffer(blob, dtype=np.float32) for (blob,) in rows])
+
+
+def gather(view: matrix_store.MatrixView, positions: np.ndarray) -> np.ndarray:
+    return np.asarray(view.matrix[view.rows[positions]], dtype=np.float32)
+
+
+def nearest_lists(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    return np.argmax(vectors @ centroids.T, axis=1)
+
+
+def train_lists(view: matrix_store.MatrixView, live: np.ndarray, nlist: int) -> np.ndarray:
+    mini_batch_k_means = importlib.import_module("sklearn.cluster").MiniBatchKMeans
+
+    sample = live
+    sample_rows = min(TRAIN_SAMPLE_ROWS, TRAIN_ROWS_PER_LIST * nlist)
+    if len(sample) > sample_rows:
+        rng = np.random.default_rng(0)
+        sample = np.sort(rng.choice(live, size=sample_rows, replace=False))
+    clusterer = mini_batch_k_means(
+        n_clusters=nlist,
+        random_state=0,
+        batch_size=max(1024, min(8192, nlist * 8)),
+        n_init=1,
+    )
+    clusterer.fit(gather(view, sample))
+    centroids = clusterer.cluster_centers_.astype(np.float32)
+    # CLIP vectors are unit length, so list probing ranks centroids by inner product too.
+    norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+    return centroids / np.where(norms > 0, norms, 1.0)
+
+
+def update_index(conn: sqlite3.Connection, db_path: Path, model: str) -> dict:
+    view = matrix_store.open_matrix(db_path)
+    if view is None:
+        return {"indexed_rows": 0, "assigned_rows": 0, "removed_rows": 0, "retrained": False}
+    live = np.flatnonzero(view.valid)
+    info = read_index_info(conn)
+    if len(live) < MIN_INDEXED_ROWS:
+        # Small libraries are scanned exactly; an IVF index would only cost recall.
+        with conn:
+            conn.execute("DELETE FROM ann_entry")
+            conn.execute("DELETE FROM ann_centroid")
+            conn.execute("DELETE FROM ann_meta")
+        return {"indexed_rows": 0, "assigned_rows": 0, "removed_rows": 0, "retrained": False}
+
+    retrained = (
+        info is None
+        or info.model != model
+        or len(live) > info.trained_rows * RETRAIN_GROWTH
+        or len(live) * RETRAIN_GROWTH < info.trained_rows
+    )
+    version = info.version + 1 if info is not None else 1
+    if retrained:
+        nlist = list_count(len(live))
+        centroids = train_lists(view, live, nlist)
+        with conn:
+            conn.execute("DELETE FROM ann_entry")
+            conn.execute("DELETE FROM ann_centroid")
+            conn.executemany(
+                "INSERT INTO ann_centroid(list_id, centroid) VALUES (?, ?)",
+                [(list_id, centroid.tobytes()) for list_id, centroid in enumerate(centroids)],
+            )
+            write_index_info(conn, IndexInfo(model, nlist, len(live), version))
+        info = IndexInfo(model, nlist, len(live), version)
+    else:
+        centroids = load_centroids(conn, view.matrix.shape[1])
+
+    with conn:
+        removed_rows = conn.execute(
+            """
+            DELETE FROM ann_entry
+            WHERE NOT EXISTS (
+                SELECT 1 FROM matrix_row
+                WHERE matrix_row.input_path = ann_entry.input_path AND matrix_row.valid = 1
+            )
+            """
+        ).rowcount
+    pending = [
+        input_path
+        for (input_path,) in conn.execute(
+            """
+            SELECT matrix_row.input_path
+            FROM matrix_row
+            LEFT JOIN ann_entry ON ann_entry.input_path = matrix_row.input_path
+            WHERE matrix_row.valid = 1
+              AND (
+                  ann_entry.input_path IS NULL
+                  OR ann_entry.mtime_ns != matrix_row.mtime_ns
+                  OR ann_entry.size_bytes != matrix_row.size_bytes
+              )
+            """
+        )
+    ]
+    if pending:
+        position = {input_path: index for index, input_path in enumerate(view.paths)}
+        stats = {
+            input_path: (mtime_ns, size_bytes)
+            for input_path, mtime_ns, size_bytes in conn.execute(
+                "SELECT input_path, mtime_ns, size_bytes FROM matrix_row WHERE valid = 1"
+            )
+        }
+        for start in range(0, len(pending), SCORE_CHUNK_ROWS):
+            chunk = pending[start : start + SCORE_CHUNK_ROWS]
+            positions = np.fromiter((position[path] for path in chunk), dtype=np.int64)
+            lists = nearest_lists(gather(view, positions), centroids)
+            with conn:
+                conn.executemany(
+                    """
+                    INSERT INTO ann_entry(input_path, list_id, mtime_ns, size_bytes)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT(input_path) DO UPDATE SET
+                        list_id = excluded.list_id,
+                        mtime_ns = excluded.mtime_ns,
+                        size_bytes = excluded.size_bytes
+                    """,
+                    [
+                        (input_path, int(list_id), *stats[input_path])
+                        for input_path, list_id in zip(chunk, lists, strict=True)
+                    ],
+                )
+    if (pending or removed_rows) and not retrained:
+        with conn:
+            write_index_info(conn, IndexInfo(info.model, info.nlist, info.trained_rows, version))
+    return {
+        "indexed_rows": len(live),
+        "lists": info.nlist,
+        "assigned_rows": len(pending),
+        "removed_rows": int(removed_rows),
+        "retrained": retrained,
+    }
+
+
+def index_key(conn: sqlite3.Connection) -> tuple[int, int, int, int]:
+    store = conn.execute(
+        "SELECT generation, row_count, revision FROM matrix_store WHERE id = 1"
+    ).fetchone()
+    meta = conn.execute("SELECT version FROM ann_meta WHERE id = 1").fetchone()
+    generation, row_count, revision = store if store is not None else (0, 0, 0)
+    version = int(meta[0]) if meta is not None else 0
+    return int(generation), int(row_count), version, int(revision)
+
+
+def load_search_index(db_path: Path) -> SearchIndex | None:
+    conn = sqlite3.connect(f"{db_path.resolve().as_uri()}?mode=ro", uri=True)
+    try:
+        key = index_key(conn)
+        view = matrix_store.open_matrix(db_path)
+        if view is None:
+            return None
+        live = np.flatnonzero(view.valid)
+        paths = [view.paths[index] for index in live]
+        position = {input_path: index for index, input_path in enumerate(paths)}
+        centroids = load_centroids(conn, view.matrix.shape[1]) if key[2] else None
+        entries = conn.execute("SELECT input_path, list_id FROM ann_entry").fetchall()
+    finally:
+        conn.close()
+
+    lists = np.full(len(paths), -1, dtype=np.int64)
+    for input_path, list_id in entries:
+        index = position.get(input_path)
+        if index is not None:
+            lists[index] = list_id
+    nlist = 0 if centroids is None else len(centroids)
+    listed = np.flatnonzero(lists >= 0)
+    order = listed[np.argsort(lists[listed], kind="stable")]
+    offsets = np.zeros(nlist + 1, dtype=np.int64)
+    if nlist:
+        offsets[1:] = np.cumsum(np.bincount(lists[listed], minlength=nlist))
+    return SearchIndex(
+        key=key,
+        model=view.model,
+        paths=paths,
+        rows=view.rows[live],
+        matrix=view.matrix,
+        position=position,
+        centroids=centroids if nlist else None,
+        offsets=offsets,
+        order=order,
+        # Vectors synced after the last index update are scanned exactly until assigned.
+        unlisted=np.flatnonzero(lists < 0),
+    )
+
+
+def search_index(db_path: Path) -> SearchIndex | None:
+    db_path = db_path.resolve()
+    conn = sqlite3.connect(f"{db_path.as_uri()}?mode=ro", uri=True)
+    try:
+        key = index_key(conn)
+    finally:
+        conn.close()
+    with _INDEX_LOCK:
+        index = _INDEXES.get(db_path)
+        if index is None or index.key != key:
+            index = load_search_index(db_path)
+            if index is None:
+                _INDEXES.pop(db_path, None)
+                return None
+            _INDEXES[db_path] = index
+        return index
+
+
+def score_positions(index: SearchIndex, positions: np.ndarray, query: np.ndarray) -> np.ndarray:
+    scores = np.empty(len(positions), dtype=np.float32)
+    for start in range(0, len(positions), SCORE_CHUNK_ROWS):
+        chunk = positions[start : start + SCORE_CHUNK_ROWS]
+        block = np.asarray(index.matrix[index.rows[chunk]], dtype=np.float32)
+        scores[start : start + len(chunk)] = block @ query
+    return scores
+
+
+def candidate_positions(index: SearchIndex, query: np.ndarray, nprobe: int) -> np.ndarray:
+    if index.centroids is None:
+        return np.arange(len(index.paths))
+    nprobe = min(nprobe, len(index.centroids))
+    probe = np.argpartition(-(index.centroids @ query), nprobe - 1)[:nprobe]
+    parts = [index.order[index.offsets[list_id] : index.offsets[list_id + 1]] for list_id in probe]
+    parts.append(index.unlisted)
+    return np.concatenate(parts)
+
+
+def top_k(
+    index: SearchIndex,
+    query: np.ndarray,
+    k: int,
+    nprobe: int,
+    exact: bool,
+    exclude: int = -1,
+) -> tuple[np.ndarray, np.ndarray, int]:
+    if exact:
+        positions = np.arange(len(index.paths))
+        scores = index.dense @ query
+    else:
+        positions = candidate_positions(index, query, nprobe)
+        scores = score_positions(index, positions, query)
+    scores[positions == exclude] = -np.inf
+    best = ranked(scores, k)
+    return positions[best], scores[best], len(positions)
+
+
+def ranked(scores: np.ndarray, stop: int) -> np.ndarray:
+    stop = min(stop, int(np.isfinite(scores).sum()))
+    if stop <= 0:
+        return np.zeros(0, dtype=np.int64)
+    best = np.argpartition(-scores, stop - 1)[:stop]
+    return best[np.argsort(-scores[best], kind="stable")]
+
+
+def similar(
+    db_path: Path,
+    input_path: str,
+    k: int = 20,
+    nprobe: int = 0,
+    exact: bool = False,
+) -> dict:
+    started = time.perf_counter()
+    index = search_index(db_path)
+    if index is None or input_path not in index.position:
+        raise KeyError(input_path)
+    nprobe = nprobe if nprobe > 0 else default_nprobe()
+    source = index.position[input_path]
+    query = np.asarray(index.matrix[index.rows[source]], dtype=np.float32)
+    positions, scores, candidates = top_k(index, query, k, nprobe, exact, exclude=source)
+    return {
+        "input_path": input_path,
+        "mode": "exact" if exact or index.centroids is None else "ann",
+        "nprobe": nprobe if index.centroids is not None else 0,
+        "candidates": candidates,
+        "indexed_rows": len(index.paths),
+        "elapsed_ms": round(1000 * (time.perf_counter() - started), 3),
+        "items": [
+            {"input_path": index.paths[int(position)], "score": round(float(score), 6)}
+            for position, score in zip(positions, scores, strict=True)
+        ],
+    }
+
+
+def recall(db_path: Path, sample_size: int = 200, k: int = 10, nprobe: int = 0) -> dict:
+    index = search_index(db_path)
+    if index is None:
+        raise ValueError(f"No CLIP matrix store next to {db_path}")
+    nprobe = nprobe if nprobe > 0 else default_nprobe()
+    rng = np.random.default_rng(0)
+    sample = rng.choice(len(index.paths), size=min(sample_size, len(index.paths)), replace=False)
+    hits = 0
+    expected = 0
+    timings = {"ann": 0.0, "exact": 0.0}
+    for source in sample:
+        query = np.asarray(index.matrix[index.rows[source]], dtype=np.float32)
+        started = time.perf_counter()
+        approx, _, _ = top_k(index, query, k, nprobe, False, exclude=int(source))
+        timings["ann"] += time.perf_counter() - started
+        started = time.perf_counter()
+        truth, _, _ = top_k(index, query, k, nprobe, True, exclude=int(source))
+        timings["exact"] += time.perf_counter() - started
+        hits += len(np.intersect1d(approx, truth))
+        expected += len(truth)
+    queries = max(len(sample), 1)
+    return {
+        "queries": len(sample),
+        "k": k,
+        "nprobe": nprobe,
+        "indexed_rows": len(index.paths),
+        "lists": 0 if index.centroids is None else len(index.centroids),
+        "recall": round(hits / expected, 4) if expected else 0.0,
+        "ann_ms": round(1000 * timings["ann"] / queries, 3),
+        "exact_ms": round(1000 * timings["exact"] / queries, 3),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Check the CLIP nearest-neighbour index.")
+    parser.add_argument("--db", default="data/server/state.sqlite3", help="state database path")
+    parser.add_argument("--recall", type=int, default=200, metavar="N", help="sampled queries")
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--nprobe", type=int, default=0)
+    args = parser.parse_args()
+    result = recall(Path(args.db), sample_size=args.recall, k=args.k, nprobe=args.nprobe)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,14 +2,17 @@ import argparse
 import json
 import logging
 import os
-import sqlite3
 import threading
 import time
+from collections import Counter
 from pathlib import Path
 
-from flask import Flask, jsonify, render_template, request, send_file
+from flask import Flask, Response, jsonify, render_template, request, send_file
 
+from bruki.server import ann, classifier, database, jobs, watch
 from bruki.server import ml as ml_pipeline
+from bruki.server import search as text_search
+from bruki.server import status as status_store
 
 APP_DIR = Path(__file__).resolve().parent
 app = Flask(
@@ -27,15 +30,25 @@ SAMPLE_LABELS_PATH = Path("data/notebook/labels.jsonl")
 SAMPLE_STATE_DB = Path("data/notebook/state.sqlite3")
 SAMPLE_PATH = Path("data/notebook/sample.jsonl")
 SAMPLE_MODE = False
-_, _, _source_roots = ml_pipeline.resolve_screenshot_records(CONFIG_PATH)
-SOURCE_ROOTS = [Path(root) for root in _source_roots]
+STATUS_STREAM_INTERVAL = 0.5
+STATUS_STREAM_KEEPALIVE = 15.0
+ML_BATCH_SIZE = int(os.environ.get("TAGGER_BATCH_SIZE", str(ml_pipeline.DEFAULT_BATCH_SIZE)))
+ML_BACKEND = ml_pipeline.BackendConfig(
+    name=os.environ.get("TAGGER_BACKEND", "torch"),
+    quantize=os.environ.get("TAGGER_QUANTIZE", "").lower() in {"1", "true", "yes", "on"},
+)
+SOURCE_ROOTS = [Path(root) for root in ml_pipeline.screenshot_roots(CONFIG_PATH)]
 DEFAULT_STATE_DB = STATE_DB
 DEFAULT_LABELS_PATH = LABELS_PATH
 DEFAULT_SOURCE_ROOTS = list(SOURCE_ROOTS)
 
+logger = logging.getLogger(__name__)
+
 _CACHE_LOCK = threading.Lock()
 _LABELS_CACHE: dict[str, list[str]] = {}
 _LABELS_MTIME_NS: int | None = None
+_SUGGESTIONS_CACHE: tuple[tuple, dict[str, list[dict]]] | None = None
+_SUGGESTIONS_EPOCH = 0
 
 
 class AccessLogFilter(logging.Filter):
@@ -91,41 +104,10 @@ def now_iso() -> str:
     return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
 
 
-def init_review_tables(db_path: Path) -> None:
-    db_path.parent.mkdir(parents=True, exist_ok=True)
-    conn = sqlite3.connect(db_path)
-    with conn:
-        conn.executescript(
-            """
-            CREATE TABLE IF NOT EXISTS tag_assignment (
-                input_path TEXT NOT NULL,
-                tag TEXT NOT NULL,
-                source TEXT NOT NULL,
-                confidence REAL NOT NULL,
-                updated_at TEXT NOT NULL,
-                PRIMARY KEY(input_path, tag)
-            );
-            CREATE INDEX IF NOT EXISTS idx_tag_assignment_tag ON tag_assignment(tag);
-
-            CREATE TABLE IF NOT EXISTS review_event (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                input_path TEXT NOT NULL,
-                before_tags TEXT NOT NULL,
-                after_tags TEXT NOT NULL,
-                actor TEXT NOT NULL,
-                action TEXT NOT NULL,
-                created_at TEXT NOT NULL
-            );
-            """
-        )
-    conn.close()
-
-
 def sync_tag_assignment(db_path: Path, input_path: str, categories: list[str]) -> None:
-    init_review_tables(db_path)
+    global _SUGGESTIONS_EPOCH
     now = now_iso()
-    conn = sqlite3.connect(db_path)
-    with conn:
+    with database.connection(db_path) as conn, conn:
         conn.execute("DELETE FROM tag_assignment WHERE input_path = ?", (input_path,))
         if categories:
             conn.executemany(
@@ -135,7 +117,9 @@ def sync_tag_assignment(db_path: Path, input_path: str, categories: list[str]) -
                 """,
                 [(input_path, tag, "human", 1.0, now) for tag in categories],
             )
-    conn.close()
+    # The delete above also dropped the model's suggestions for this image.
+    with _CACHE_LOCK:
+        _SUGGESTIONS_EPOCH += 1
 
 
 def log_review_event(
@@ -145,7 +129,6 @@ def log_review_event(
     after_tags: list[str],
     actor: str = "ui",
 ) -> None:
-    init_review_tables(db_path)
     before_set = set(before_tags)
     after_set = set(after_tags)
     if not before_set and after_set:
@@ -155,8 +138,7 @@ def log_review_event(
     else:
         action = "update"
 
-    conn = sqlite3.connect(db_path)
-    with conn:
+    with database.connection(db_path) as conn, conn:
         conn.execute(
             """
             INSERT INTO review_event(input_path, before_tags, after_tags, actor, action, created_at)
@@ -171,7 +153,30 @@ def log_review_event(
                 now_iso(),
             ),
         )
-    conn.close()
+
+
+def load_suggestions(db_path: Path) -> dict[str, list[dict]]:
+    global _SUGGESTIONS_CACHE
+    # The key is taken before reading, so a rescoring that lands mid-read forces a reload.
+    with _CACHE_LOCK:
+        key = (db_path, classifier.scoring_revision(db_path), _SUGGESTIONS_EPOCH)
+        if _SUGGESTIONS_CACHE is not None and _SUGGESTIONS_CACHE[0] == key:
+            return _SUGGESTIONS_CACHE[1]
+    with database.connection(db_path) as conn:
+        rows = conn.execute(
+            """
+            SELECT input_path, tag, confidence
+            FROM tag_assignment
+            WHERE source = 'model'
+            ORDER BY input_path, confidence DESC
+            """
+        ).fetchall()
+    suggestions: dict[str, list[dict]] = {}
+    for input_path, tag, confidence in rows:
+        suggestions.setdefault(input_path, []).append({"tag": tag, "confidence": confidence})
+    with _CACHE_LOCK:
+        _SUGGESTIONS_CACHE = (key, suggestions)
+    return suggestions
 
 
 def labels_mtime_ns() -> int | None:
@@ -267,6 +272,9 @@ def index():
 @app.get("/api/items")
 def get_items():
     selected_cluster = request.args.get("cluster", "")
+    suggestions = {} if SAMPLE_MODE else load_suggestions(resolve_state_db())
+    groups = {} if SAMPLE_MODE else ml_pipeline.get_duplicate_groups(resolve_state_db())
+    group_sizes = Counter(groups.values())
     payload = []
     for item_idx, item in enumerate(load_all()):
         if selected_cluster:
@@ -275,6 +283,11 @@ def get_items():
                 continue
         row = dict(item)
         row["_idx"] = item_idx
+        if row.get("input_path") in suggestions:
+            row["suggestions"] = suggestions[row["input_path"]]
+        if row.get("input_path") in groups:
+            row["duplicate_group"] = groups[row["input_path"]]
+            row["duplicate_count"] = group_sizes[row["duplicate_group"]]
         payload.append(row)
     return jsonify(payload)
 
@@ -319,6 +332,8 @@ def patch_item(idx):
         before_tags=previous,
         after_tags=categories_clean,
     )
+    if not SAMPLE_MODE:
+        classifier.schedule_update(db_path, labels_by_path, input_path)
     response = dict(items[idx])
     response["categories"] = categories_clean
     response["_idx"] = idx
@@ -354,10 +369,63 @@ def purge_preview():
 def start_ml():
     if SAMPLE_MODE:
         return jsonify({"started": False, "disabled": True})
-    started = ml_pipeline.start_job(config_path=CONFIG_PATH, db_path=resolve_state_db())
+    started = ml_pipeline.start_job(
+        config_path=CONFIG_PATH,
+        db_path=resolve_state_db(),
+        batch_size=ML_BATCH_SIZE,
+        backend=ML_BACKEND,
+    )
     return jsonify({"started": started})
 
 
+@app.post("/api/ml/pause")
+def pause_ml():
+    if SAMPLE_MODE:
+        return jsonify({"paused": False, "disabled": True})
+    job = jobs.request("pause")
+    return jsonify({"paused": job is not None, "job": job})
+
+
+@app.post("/api/ml/resume")
+def resume_ml():
+    if SAMPLE_MODE:
+        return jsonify({"resumed": False, "disabled": True})
+    job = jobs.request("resume")
+    if job is not None:
+        return jsonify({"resumed": True, "started": False, "job": job})
+    # Nothing is running: resuming a cancelled scan starts it again from its last finished stage.
+    started = ml_pipeline.start_job(
+        config_path=CONFIG_PATH,
+        db_path=resolve_state_db(),
+        batch_size=ML_BATCH_SIZE,
+        backend=ML_BACKEND,
+        force=True,
+    )
+    return jsonify({"resumed": started, "started": started, "job": None})
+
+
+@app.post("/api/ml/cancel")
+def cancel_ml():
+    if SAMPLE_MODE:
+        return jsonify({"cancelled": False, "disabled": True})
+    job = jobs.request("cancel")
+    return jsonify({"cancelled": job is not None, "job": job})
+
+
+@app.get("/api/ml/jobs")
+def ml_jobs():
+    if SAMPLE_MODE:
+        return jsonify({"jobs": [], "disabled": True})
+    raw_limit = request.args.get("limit", "50")
+    try:
+        limit = int(raw_limit)
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+    if limit < 1 or limit > jobs.HISTORY_LIMIT:
+        return jsonify({"error": f"limit must be in [1, {jobs.HISTORY_LIMIT}]"}), 400
+    return jsonify({"jobs": jobs.history(resolve_state_db(), limit)})
+
+
 @app.get("/api/ml/status")
 def ml_status():
     if SAMPLE_MODE:
@@ -365,6 +433,32 @@ def ml_status():
     return jsonify(ml_pipeline.get_status(config_path=CONFIG_PATH, db_path=resolve_state_db()))
 
 
+@app.get("/api/ml/events")
+def ml_events():
+    if SAMPLE_MODE:
+        return jsonify({"stage": "disabled", "disabled": True})
+    bus = status_store.status_bus(resolve_state_db())
+
+    def stream():
+        version, payload = bus.snapshot()
+        while True:
+            body = json.dumps(ml_pipeline.describe_status(CONFIG_PATH, payload))
+            yield f"id: {version}\ndata: {body}\n\n"
+            # Coalesce progress bursts; the client only needs a couple of frames a second.
+            time.sleep(STATUS_STREAM_INTERVAL)
+            current, payload = bus.wait(version, STATUS_STREAM_KEEPALIVE)
+            while current == version:
+                yield ": keepalive\n\n"
+                current, payload = bus.wait(version, STATUS_STREAM_KEEPALIVE)
+            version = current
+
+    return Response(
+        stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.get("/api/ml/clusters")
 def ml_clusters():
     if SAMPLE_MODE:
@@ -372,6 +466,61 @@ def ml_clusters():
     return jsonify(ml_pipeline.get_clusters(db_path=resolve_state_db()))
 
 
+@app.get("/api/similar")
+def similar_items():
+    if SAMPLE_MODE:
+        return jsonify({"disabled": True})
+    input_path = request.args.get("path", "")
+    if not input_path:
+        return jsonify({"error": "path is required"}), 400
+    try:
+        k = int(request.args.get("k", "20"))
+        nprobe = int(request.args.get("nprobe", "0"))
+    except ValueError:
+        return jsonify({"error": "k and nprobe must be integers"}), 400
+    if k < 1 or k > 500:
+        return jsonify({"error": "k must be in [1, 500]"}), 400
+    mode = request.args.get("mode", "ann")
+    if mode not in {"ann", "exact"}:
+        return jsonify({"error": "mode must be ann or exact"}), 400
+    try:
+        result = ann.similar(
+            resolve_state_db(),
+            input_path,
+            k=k,
+            nprobe=nprobe,
+            exact=mode == "exact",
+        )
+    except KeyError:
+        return jsonify({"error": "no embedding for path"}), 404
+    return jsonify(result)
+
+
+@app.get("/api/search")
+def search_items():
+    if SAMPLE_MODE:
+        return jsonify({"disabled": True})
+    query = request.args.get("q", "")
+    if not query.strip():
+        return jsonify({"error": "q is required"}), 400
+    try:
+        offset = int(request.args.get("offset", "0"))
+        limit = int(request.args.get("limit", str(text_search.DEFAULT_LIMIT)))
+    except ValueError:
+        return jsonify({"error": "offset and limit must be integers"}), 400
+    if offset < 0:
+        return jsonify({"error": "offset must be >= 0"}), 400
+    if limit < 1 or limit > text_search.MAX_LIMIT:
+        return jsonify({"error": f"limit must be in [1, {text_search.MAX_LIMIT}]"}), 400
+    try:
+        result = text_search.search(resolve_state_db(), query, offset=offset, limit=limit)
+    except LookupError:
+        return jsonify({"error": "no CLIP embeddings indexed yet"}), 404
+    except (ImportError, OSError) as exc:
+        return jsonify({"error": f"CLIP text encoder unavailable: {exc}"}), 503
+    return jsonify(result)
+
+
 @app.post("/api/ml/ocr")
 def ml_ocr():
     if SAMPLE_MODE:
@@ -379,32 +528,57 @@ def ml_ocr():
     return jsonify(ml_pipeline.sync_ocr_db(config_path=CONFIG_PATH, db_path=resolve_state_db()))
 
 
+@app.get("/api/ocr/search")
+def ocr_search():
+    if SAMPLE_MODE:
+        return jsonify({"disabled": True})
+    query = request.args.get("q", "")
+    if not query.strip():
+        return jsonify({"error": "q is required"}), 400
+    try:
+        offset = int(request.args.get("offset", "0"))
+        limit = int(request.args.get("limit", str(text_search.DEFAULT_LIMIT)))
+    except ValueError:
+        return jsonify({"error": "offset and limit must be integers"}), 400
+    if offset < 0:
+        return jsonify({"error": "offset must be >= 0"}), 400
+    if limit < 1 or limit > text_search.MAX_LIMIT:
+        return jsonify({"error": f"limit must be in [1, {text_search.MAX_LIMIT}]"}), 400
+    db_path = resolve_state_db()
+    try:
+        result = text_search.search_ocr(db_path, query, offset=offset, limit=limit)
+    except ValueError:
+        return jsonify({"error": "q has no searchable terms"}), 400
+    except LookupError:
+        return jsonify({"error": "OCR full-text index unavailable"}), 503
+    return jsonify(result)
+
+
 @app.get("/api/review/summary")
 def review_summary():
     db_path = resolve_state_db()
-    init_review_tables(db_path)
-    conn = sqlite3.connect(db_path)
-    row = conn.execute(
-        """
-        SELECT
-            COUNT(*) AS events,
-            SUM(CASE WHEN action = 'add' THEN 1 ELSE 0 END) AS adds,
-            SUM(CASE WHEN action = 'update' THEN 1 ELSE 0 END) AS updates,
-            SUM(CASE WHEN action = 'clear' THEN 1 ELSE 0 END) AS clears,
-            SUM(CASE WHEN action = 'noop' THEN 1 ELSE 0 END) AS noops
-        FROM review_event
-        """,
-    ).fetchone()
-    top_tags = conn.execute(
-        """
-        SELECT tag, COUNT(*) AS c
-        FROM tag_assignment
-        GROUP BY tag
-        ORDER BY c DESC, tag ASC
-        LIMIT 20
-        """,
-    ).fetchall()
-    conn.close()
+    with database.connection(db_path) as conn:
+        row = conn.execute(
+            """
+            SELECT
+                COUNT(*) AS events,
+                SUM(CASE WHEN action = 'add' THEN 1 ELSE 0 END) AS adds,
+                SUM(CASE WHEN action = 'update' THEN 1 ELSE 0 END) AS updates,
+                SUM(CASE WHEN action = 'clear' THEN 1 ELSE 0 END) AS clears,
+                SUM(CASE WHEN action = 'noop' THEN 1 ELSE 0 END) AS noops
+            FROM review_event
+            """,
+        ).fetchone()
+        top_tags = conn.execute(
+            """
+            SELECT tag, COUNT(*) AS c
+            FROM tag_assignment
+            WHERE source = 'human'
+            GROUP BY tag
+            ORDER BY c DESC, tag ASC
+            LIMIT 20
+            """,
+        ).fetchall()
     events, adds, updates, clears, noops = row if row else (0, 0, 0, 0, 0)
     return jsonify(
         {
@@ -429,18 +603,16 @@ def review_events():
         return jsonify({"error": "limit must be in [1, 500]"}), 400
 
     db_path = resolve_state_db()
-    init_review_tables(db_path)
-    conn = sqlite3.connect(db_path)
-    rows = conn.execute(
-        """
-        SELECT id, input_path, before_tags, after_tags, actor, action, created_at
-        FROM review_event
-        ORDER BY id DESC
-        LIMIT ?
-        """,
-        (limit,),
-    ).fetchall()
-    conn.close()
+    with database.connection(db_path) as conn:
+        rows = conn.execute(
+            """
+            SELECT id, input_path, before_tags, after_tags, actor, action, created_at
+            FROM review_event
+            ORDER BY id DESC
+            LIMIT ?
+            """,
+            (limit,),
+        ).fetchall()
 
     payload = []
     for event_id, input_path, before_tags, after_tags, actor, action, created_at in rows:
@@ -458,6 +630,32 @@ def review_events():
     return jsonify(payload)
 
 
+@app.get("/api/review/queue")
+def review_queue():
+    if SAMPLE_MODE:
+        return jsonify({"disabled": True})
+    try:
+        offset = int(request.args.get("offset", "0"))
+        limit = int(request.args.get("limit", "50"))
+    except ValueError:
+        return jsonify({"error": "offset and limit must be integers"}), 400
+    if offset < 0:
+        return jsonify({"error": "offset must be >= 0"}), 400
+    if limit < 1 or limit > 500:
+        return jsonify({"error": "limit must be in [1, 500]"}), 400
+    db_path = resolve_state_db()
+    try:
+        result = classifier.review_queue(
+            db_path,
+            set(load_labels_cached()),
+            offset=offset,
+            limit=limit,
+        )
+    except LookupError:
+        return jsonify({"error": "no CLIP embeddings indexed yet"}), 404
+    return jsonify(result)
+
+
 def path_within(path: Path, root: Path) -> bool:
     try:
         path.relative_to(root)
@@ -486,6 +684,8 @@ def main() -> None:
     parser.add_argument("--sample", action="store_true", help="Run labeling-only sample mode.")
     args = parser.parse_args()
     set_sample_mode(args.sample)
+    # Schema setup and migrations run here once; request handlers only borrow connections.
+    database.ensure_schema(resolve_state_db())
 
     access_log = os.environ.get("TAGGER_ACCESS_LOG", "").lower() in {"1", "true", "yes", "on"}
     werkzeug_logger = logging.getLogger("werkzeug")
@@ -495,6 +695,16 @@ def main() -> None:
     ):
         werkzeug_logger.addFilter(AccessLogFilter())
     debug = os.environ.get("TAGGER_DEBUG", "1").lower() in {"1", "true", "yes", "on"}
+    # The debug reloader imports the app twice; only the serving child should watch.
+    if not SAMPLE_MODE and (not debug or os.environ.get("WERKZEUG_RUN_MAIN") == "true"):
+        watch.start_watcher(
+            CONFIG_PATH,
+            resolve_state_db(),
+            batch_size=ML_BATCH_SIZE,
+            backend=ML_BACKEND,
+        )
+        # Score once at startup so images ingested since the last label get suggestions.
+        classifier.schedule_scoring(resolve_state_db(), set(load_labels_cached()))
     app.run(debug=debug, port=5000)
 
 
@@ -16,9 +16,7 @@ let selectedCluster = '',
 let selectedPaths = new Set(),
   selectionAnchorIndex = -1;
 let lastMlStage = '',
-  lastMlStatusKey = '';
-let mlPollDelayMs = 3000,
-  mlPollTimer = null;
+  mlEvents = null;
 let thumbMinPx = 180;
 
 const sampleMode = window.TAGGER_SAMPLE_MODE === true;
@@ -87,10 +85,11 @@ function setThumbSelected(thumb, sel) {
 }
 
 // filepath bar
-function setFilepath(pathText, categories = []) {
+function setFilepath(pathText, item = {}) {
+  const categories = item.categories || [];
+  const suggestions = item.suggestions || [];
   filepathPath.textContent = pathText || '';
   filepathLabels.replaceChildren();
-  if (!categories.length) return;
   const frag = document.createDocumentFragment();
   for (const cat of categories) {
     const btn = document.createElement('button');
@@ -100,6 +99,27 @@ function setFilepath(pathText, categories = []) {
     btn.textContent = cat;
     frag.appendChild(btn);
   }
+  // model suggestions only for untagged images; clicking stages the tag
+  if (!categories.length) {
+    for (const { tag, confidence } of suggestions) {
+      const btn = document.createElement('button');
+      btn.type = 'button';
+      btn.className = 'filepath-tag suggested';
+      btn.dataset.suggest = tag;
+      btn.textContent = `${tag}? ${Math.round(confidence * 100)}%`;
+      frag.appendChild(btn);
+    }
+  }
+  // near-duplicates share one label; clicking applies the staged tags to the group
+  if (item.duplicate_count > 1) {
+    const btn = document.createElement('button');
+    btn.type = 'button';
+    btn.className = 'filepath-tag duplicates';
+    btn.dataset.group = String(item.duplicate_group);
+    btn.textContent = `${item.duplicate_count} duplicates`;
+    btn.title = 'apply tags to every image in this duplicate group';
+    frag.appendChild(btn);
+  }
   filepathLabels.appendChild(frag);
 }
 
@@ -161,10 +181,21 @@ async function applyTagsToCurrentImage() {
 }
 
 async function applyTagsToSelected() {
-  if (saving || !selectedPaths.size) return;
+  if (!selectedPaths.size) return;
+  await applyTagsToItems(
+    allItems.filter((it) => selectedPaths.has(it.input_path)),
+  );
+}
+
+async function applyTagsToGroup(group) {
+  await applyTagsToItems(
+    allItems.filter((it) => String(it.duplicate_group ?? '') === group),
+  );
+}
+
+async function applyTagsToItems(targets) {
+  if (saving || !targets.length) return;
   const tags = tagify.value.map((e) => e.value);
-  const targets = allItems.filter((it) => selectedPaths.has(it.input_path));
-  if (!targets.length) return;
   saving = true;
   try {
     tags.forEach((tag) => {
@@ -172,11 +203,9 @@ async function applyTagsToSelected() {
     });
     tagify.settings.whitelist = [...allTags];
     // items shares object refs with allItems one pass suffices
-    allItems
-      .filter((it) => selectedPaths.has(it.input_path))
-      .forEach((it) => {
-        it.categories = [...tags];
-      });
+    targets.forEach((it) => {
+      it.categories = [...tags];
+    });
     const responses = await Promise.all(
       targets.map((it) =>
         fetch(`/api/item/${it._idx}`, {
@@ -241,8 +270,31 @@ async function reloadItems() {
 }
 
 // ML
+function formatStageProgress(name, entry) {
+  const rate = (entry.rate_images_per_second || 0).toFixed(2);
+  const done = entry.processed_images || 0;
+  const count = entry.total_images || 0;
+  return `${name} ${done}/${count} · ${rate} img/s · eta ${entry.eta_seconds || 0}s`;
+}
+
+const JOB_STATE_LABELS = {
+  paused: 'paused',
+  waiting: 'waiting for allowed window',
+  cancelling: 'cancelling',
+};
+
 function formatMlStatus(status) {
+  const text = formatMlStage(status);
+  const label = JOB_STATE_LABELS[status.job_state];
+  return label ? `${text} · ${label}` : text;
+}
+
+function formatMlStage(status) {
   const stage = status.stage || 'idle';
+  if (stage === 'indexing') {
+    const stages = Object.entries(status.stage_progress || {});
+    return `ml: ${stages.map(([name, entry]) => formatStageProgress(name, entry)).join(' | ')}`;
+  }
   if (stage === 'embedding' || stage === 'ocr') {
     const done = status.processed_images || 0;
     const count = status.total_images || 0;
@@ -255,6 +307,7 @@ function formatMlStatus(status) {
   if (stage === 'done')
     return `ml: done ${status.total_images || 0} images · k=${status.cluster_count || '—'}`;
   if (stage === 'error') return `ml: error ${status.error || ''}`.trim();
+  if (stage === 'cancelled') return 'ml: cancelled · resume to continue';
   if (stage === 'scanning')
     return `ml: scanning sources (${status.total_images || 0} images)`;
   return `ml: ${stage}`;
@@ -266,55 +319,33 @@ function formatSourceStats(status) {
   return stats.map((r) => `${r.series}/${r.source}: ${r.count}`).join(' | ');
 }
 
-async function refreshMlStatus() {
-  const status = await fetchJson('/api/ml/status');
+async function handleMlStatus(status) {
   const stage = status.stage || 'idle';
-  const statusKey = [
-    stage,
-    status.processed_images || 0,
-    status.total_images || 0,
-    status.cluster_count || 0,
-    status.eta_seconds || 0,
-    status.error || '',
-  ].join(':');
-  const changed = statusKey !== lastMlStatusKey;
   mlStatus.textContent = formatMlStatus(status);
   mlSources.textContent = formatSourceStats(status);
   if (stage === 'done' && lastMlStage !== 'done') {
     await Promise.all([reloadItems(), refreshClusters()]);
   }
   lastMlStage = stage;
-  lastMlStatusKey = statusKey;
-  if (
-    stage === 'embedding' ||
-    stage === 'clustering' ||
-    stage === 'scanning' ||
-    stage === 'ocr'
-  ) {
-    mlPollDelayMs = changed
-      ? 3000
-      : Math.min(Math.round(mlPollDelayMs * 1.5), 15000);
-  } else if (stage === 'done' || stage === 'error') {
-    mlPollDelayMs = changed
-      ? 10000
-      : Math.min(Math.round(mlPollDelayMs * 2), 120000);
-  } else {
-    mlPollDelayMs = changed
-      ? 5000
-      : Math.min(Math.round(mlPollDelayMs * 1.5), 60000);
-  }
 }
 
-async function pollMlStatus() {
-  await refreshMlStatus();
-  mlPollTimer = setTimeout(pollMlStatus, mlPollDelayMs);
+async function refreshMlStatus() {
+  await handleMlStatus(await fetchJson('/api/ml/status'));
+}
+
+// the server pushes status changes; EventSource reconnects on its own
+function subscribeMlStatus() {
+  if (mlEvents !== null) mlEvents.close();
+  mlEvents = new EventSource('/api/ml/events');
+  mlEvents.addEventListener('message', (e) => {
+    handleMlStatus(JSON.parse(e.data));
+  });
 }
 
 async function initMl() {
   await fetchJson('/api/ml/start', { method: 'POST' });
   await Promise.all([refreshMlStatus(), refreshClusters()]);
-  if (mlPollTimer !== null) clearTimeout(mlPollTimer);
-  mlPollTimer = setTimeout(pollMlStatus, mlPollDelayMs);
+  subscribeMlStatus();
 }
 
 // render
@@ -328,7 +359,6 @@ function render() {
       selectedCluster
         ? `no images in cluster c${selectedCluster}`
         : 'no images',
-      [],
     );
     jump.textContent = '0';
     tagbar.className = 'unlabeled';
@@ -338,7 +368,7 @@ function render() {
     return;
   }
   shot.src = `/image?path=${encodeURIComponent(item.input_path)}`;
-  setFilepath(item.input_path, item.categories || []);
+  setFilepath(item.input_path, item);
   jump.textContent = filterMode ? '' : String(idx + 1);
   localStorage.setItem('tagger-index', String(idx));
   const tagged = (item.categories || []).length > 0;
@@ -389,9 +419,11 @@ function renderClusterDropdown(clusters) {
   const cur = selectedCluster;
   clustersDropdown.innerHTML = ['<option value="">all clusters</option>']
     .concat(
-      (clusters || []).map(
-        (c) => `<option value="${c.id}">c${c.id} (${c.count})</option>`,
-      ),
+      (clusters || []).map((c) => {
+        const tags = (c.top_tags || []).map((t) => t.tag).slice(0, 3);
+        const label = tags.length ? ` · ${tags.join(', ')}` : '';
+        return `<option value="${c.id}" title="${esc(c.medoid || '')}">c${c.id} (${c.count})${esc(label)}</option>`;
+      }),
     )
     .join('');
   clustersDropdown.value = cur;
@@ -476,7 +508,7 @@ function initGalleryEvents() {
     thumb.classList.add('active');
     const item = galleryMatches[i];
     if (!item) return;
-    setFilepath(item.input_path, item.categories || []);
+    setFilepath(item.input_path, item);
     jump.textContent = String(
       items.findIndex((it) => it.input_path === item.input_path) + 1,
     );
@@ -590,7 +622,7 @@ document.addEventListener('keydown', (e) => {
       target.scrollIntoView({ block: 'nearest' });
       const activeItem = galleryMatches[galleryIndex];
       if (activeItem) {
-        setFilepath(activeItem.input_path, activeItem.categories || []);
+        setFilepath(activeItem.input_path, activeItem);
         jump.textContent = String(
           items.findIndex((it) => it.input_path === activeItem.input_path) + 1,
         );
@@ -689,6 +721,14 @@ async function init() {
   filepathLabels.addEventListener('click', (e) => {
     const btn = e.target.closest('.filepath-tag');
     if (!btn) return;
+    if (btn.dataset.suggest) {
+      if (!filterMode) tagify.addTags([btn.dataset.suggest]);
+      return;
+    }
+    if (btn.dataset.group) {
+      applyTagsToGroup(btn.dataset.group);
+      return;
+    }
     tagScope = btn.dataset.tag || '__any__';
     applyClusterFilter(true);
   });
@@ -0,0 +1,491 @@
+import logging
+import sqlite3
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+
+from bruki.server import ann, database
+from bruki.server import ml as ml_pipeline
+
+LEARNING_RATE = 0.1
+L2_PENALTY = 1e-3
+UPDATE_STEPS = 25
+BOOTSTRAP_STEPS = 300
+REPLAY_ITEMS = 512
+MIN_EXAMPLES = 3
+SUGGEST_TOP_K = 3
+SUGGEST_MIN_CONFIDENCE = 0.5
+SCORE_DEBOUNCE_SECONDS = 2.0
+SCORE_CHUNK_ROWS = 16384
+QUEUE_SIZE = 500
+QUEUE_POOL = 2048
+QUEUE_ANCHORS = 2048
+NEIGHBOR_WEIGHT = 0.3
+
+_MODEL_LOCK = threading.Lock()
+_SCORE_LOCK = threading.Lock()
+_TIMER_LOCK = threading.Lock()
+_MOMENT_LOCK = threading.Lock()
+_MOMENTS: dict[tuple, tuple[np.ndarray, np.ndarray]] = {}
+_QUEUE_LOCK = threading.Lock()
+_QUEUES: dict[Path, tuple[tuple, dict]] = {}
+_TIMERS: dict[Path, threading.Timer] = {}
+_LABELLED: dict[Path, frozenset[str]] = {}
+_PENDING: dict[Path, tuple[dict[str, list[str]], list[str]]] = {}
+_REVISIONS: dict[Path, int] = {}
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class TagModel:
+    model: str
+    tags: list[str]
+    weights: np.ndarray
+    bias: np.ndarray
+    positives: np.ndarray
+    negatives: np.ndarray
+
+
+def read_tag_model(conn: sqlite3.Connection, model: str, dim: int) -> TagModel:
+    rows = conn.execute(
+        """
+        SELECT tag, weight, bias, positives, negatives
+        FROM tag_model
+        WHERE model = ? AND dim = ?
+        """,
+        (model, dim),
+    ).fetchall()
+    empty = np.zeros(0, dtype=np.int64)
+    if not rows:
+        return TagModel(model, [], np.zeros((0, dim), np.float32), np.zeros(0), empty, empty)
+    tags, blobs, bias, positives, negatives = zip(*rows, strict=True)
+    return TagModel(
+        model=model,
+        tags=list(tags),
+        weights=np.stack([np.frombuffer(blob, dtype=np.float32) for blob in blobs]),
+        bias=np.array(bias, dtype=np.float64),
+        positives=np.array(positives, dtype=np.int64),
+        negatives=np.array(negatives, dtype=np.int64),
+    )
+
+
+def write_tag_model(conn: sqlite3.Connection, tag_model: TagModel) -> None:
+    now = time.time()
+    with conn:
+        conn.execute("DELETE FROM tag_model")
+        conn.executemany(
+            """
+            INSERT INTO tag_model(tag, model, dim, weight, bias, positives, negatives, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            [
+                (
+                    tag,
+                    tag_model.model,
+                    tag_model.weights.shape[1],
+                    np.asarray(weight, dtype=np.float32).tobytes(),
+                    float(bias),
+                    int(positives),
+                    int(negatives),
+                    now,
+                )
+                for tag, weight, bias, positives, negatives in zip(
+                    tag_model.tags,
+                    tag_model.weights,
+                    tag_model.bias,
+                    tag_model.positives,
+                    tag_model.negatives,
+                    strict=True,
+                )
+            ],
+        )
+
+
+def sigmoid(logits: np.ndarray) -> np.ndarray:
+    return 1.0 / (1.0 + np.exp(-np.clip(logits, -30.0, 30.0)))
+
+
+def align_tags(tag_model: TagModel, labels: dict[str, list[str]]) -> TagModel:
+    counts = Counter(tag for categories in labels.values() for tag in set(categories))
+    tags = sorted(counts)
+    dim = tag_model.weights.shape[1]
+    known = {tag: index for index, tag in enumerate(tag_model.tags)}
+    weights = np.zeros((len(tags), dim), dtype=np.float32)
+    bias = np.zeros(len(tags), dtype=np.float64)
+    for index, tag in enumerate(tags):
+        if tag in known:
+            weights[index] = tag_model.weights[known[tag]]
+            bias[index] = tag_model.bias[known[tag]]
+    positives = np.array([counts[tag] for tag in tags], dtype=np.int64)
+    return TagModel(tag_model.model, tags, weights, bias, positives, len(labels) - positives)
+
+
+def training_batch(
+    index: ann.SearchIndex,
+    labels: dict[str, list[str]],
+    tags: list[str],
+    paths: list[str],
+) -> tuple[np.ndarray, np.ndarray]:
+    columns = {tag: column for column, tag in enumerate(tags)}
+    positions = np.array([index.position[input_path] for input_path in paths], dtype=np.int64)
+    targets = np.zeros((len(paths), len(tags)), dtype=np.float32)
+    for row, input_path in enumerate(paths):
+        for tag in labels[input_path]:
+            targets[row, columns[tag]] = 1.0
+    return index.dense[positions], targets
+
+
+def feature_moments(db_path: Path, index: ann.SearchIndex) -> tuple[np.ndarray, np.ndarray]:
+    key = (db_path, index.key)
+    with _MOMENT_LOCK:
+        if key not in _MOMENTS:
+            _MOMENTS.clear()
+            _MOMENTS[key] = (
+                index.dense.mean(axis=0, dtype=np.float64),
+                np.maximum(index.dense.std(axis=0, dtype=np.float64), 1e-6),
+            )
+        return _MOMENTS[key]
+
+
+def fit(
+    tag_model: TagModel,
+    vectors: np.ndarray,
+    targets: np.ndarray,
+    steps: int,
+    moments: tuple[np.ndarray, np.ndarray],
+) -> None:
+    # Gradient descent on the L2-regularised logistic loss, warm-started from the current
+    # weights. CLIP vectors share a large common component, so it runs on standardised
+    # features and the result is folded back into raw-space weights for scoring.
+    center, scale = moments
+    features = (vectors - center) / scale
+    weights = tag_model.weights * scale
+    bias = tag_model.bias + tag_model.weights @ center
+    rate = LEARNING_RATE / len(features)
+    for _ in range(steps):
+        error = sigmoid(features @ weights.T + bias) - targets
+        weights -= rate * (error.T @ features) + LEARNING_RATE * L2_PENALTY * weights
+        bias -= rate * error.sum(axis=0)
+    tag_model.weights = (weights / scale).astype(np.float32)
+    tag_model.bias = bias - tag_model.weights @ center
+
+
+def learn(db_path: Path, labels: dict[str, list[str]], input_path: str) -> dict:
+    index = ann.search_index(db_path)
+    if index is None or input_path not in index.position:
+        return {"trained": False, "reason": "no embedding"}
+    labelled = [path for path in labels if path in index.position]
+    dim = index.matrix.shape[1]
+    with _MODEL_LOCK:
+        with database.connection(db_path) as conn:
+            stored = read_tag_model(conn, index.model, dim)
+            tag_model = align_tags(stored, {path: labels[path] for path in labelled})
+            if not tag_model.tags:
+                write_tag_model(conn, tag_model)
+                return {"trained": False, "reason": "no tags"}
+            if stored.tags:
+                others = [path for path in labelled if path != input_path]
+                rng = np.random.default_rng()
+                if len(others) > REPLAY_ITEMS:
+                    others = rng.choice(others, size=REPLAY_ITEMS, replace=False).tolist()
+                batch, steps, mode = [input_path, *others], UPDATE_STEPS, "update"
+            else:
+                # First label under this embedding model: fit all labelled items from zero.
+                batch, steps, mode = labelled, BOOTSTRAP_STEPS, "bootstrap"
+            vectors, targets = training_batch(index, labels, tag_model.tags, batch)
+            fit(tag_model, vectors, targets, steps, feature_moments(db_path, index))
+            write_tag_model(conn, tag_model)
+    return {
+        "trained": True,
+        "mode": mode,
+        "tags": len(tag_model.tags),
+        "batch_items": len(batch),
+        "labelled_items": len(labelled),
+    }
+
+
+def eligible_tags(tag_model: TagModel) -> np.ndarray:
+    # A tag on every labelled image has nothing to separate it from the rest yet.
+    return np.flatnonzero(
+        (tag_model.positives >= MIN_EXAMPLES) & (tag_model.negatives >= MIN_EXAMPLES)
+    )
+
+
+def top_suggestions(probabilities: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    if probabilities.shape[1] > SUGGEST_TOP_K:
+        keep = np.argpartition(-probabilities, SUGGEST_TOP_K - 1, axis=1)[:, :SUGGEST_TOP_K]
+        mask = np.zeros(probabilities.shape, dtype=bool)
+        np.put_along_axis(mask, keep, True, axis=1)
+        probabilities = np.where(mask, probabilities, 0.0)
+    return np.nonzero(probabilities >= SUGGEST_MIN_CONFIDENCE)
+
+
+def score_corpus(db_path: Path, labelled: set[str]) -> dict:
+    started = time.perf_counter()
+    index = ann.search_index(db_path)
+    if index is None:
+        return {"suggestions": 0, "tags": 0}
+    with _SCORE_LOCK:
+        with database.connection(db_path) as conn:
+            tag_model = read_tag_model(conn, index.model, index.matrix.shape[1])
+            eligible = eligible_tags(tag_model)
+            labelled = labelled | {
+                input_path
+                for (input_path,) in conn.execute(
+                    "SELECT DISTINCT input_path FROM tag_assignment WHERE source = 'human'"
+                )
+            }
+            rows: list[tuple[str, str, str, float, str]] = []
+            now = ml_pipeline.now_iso()
+            if eligible.size:
+                weights = tag_model.weights[eligible]
+                bias = tag_model.bias[eligible]
+                tags = [tag_model.tags[column] for column in eligible]
+                for start in range(0, len(index.paths), SCORE_CHUNK_ROWS):
+                    block = index.dense[start : start + SCORE_CHUNK_ROWS]
+                    probabilities = sigmoid(block @ weights.T + bias)
+                    for row, column in zip(*top_suggestions(probabilities), strict=True):
+                        input_path = index.paths[start + row]
+                        if input_path not in labelled:
+                            confidence = round(float(probabilities[row, column]), 4)
+                            rows.append((input_path, tags[column], "model", confidence, now))
+            with conn:
+                conn.execute("DELETE FROM tag_assignment WHERE source = 'model'")
+                conn.executemany(
+                    """
+                    INSERT OR IGNORE INTO tag_assignment(
+                        input_path, tag, source, confidence, updated_at
+                    )
+                    VALUES (?, ?, ?, ?, ?)
+                    """,
+                    rows,
+                )
+            # Scoring follows label changes, so the cluster picker's dominant tags do too.
+            ml_pipeline.refresh_cluster_tags(conn)
+        key = db_path.resolve()
+        _REVISIONS[key] = _REVISIONS.get(key, 0) + 1
+    return {
+        "suggestions": len(rows),
+        "tags": int(eligible.size),
+        "scored_images": len(index.paths),
+        "elapsed_ms": round(1000 * (time.perf_counter() - started), 3),
+    }
+
+
+def scoring_revision(db_path: Path) -> int:
+    # Bumped after every rewrite of the stored suggestions, so readers can cache them.
+    return _REVISIONS.get(db_path.resolve(), 0)
+
+
+def _score_in_background(db_path: Path) -> None:
+    with _TIMER_LOCK:
+        if _TIMERS.get(db_path) is threading.current_thread():
+            del _TIMERS[db_path]
+        labels, updated = _PENDING.pop(db_path, ({}, []))
+        labelled = _LABELLED.get(db_path, frozenset())
+    # Labels are already saved; a failed update only delays the model until the next label.
+    for input_path in dict.fromkeys(updated):
+        try:
+            learn(db_path, labels, input_path)
+        except Exception:
+            logger.exception("classifier update failed for %s", input_path)
+    try:
+        result = score_corpus(db_path, set(labelled))
+    except Exception:
+        logger.exception("suggestion scoring failed")
+        return
+    logger.info(
+        "stored %d suggestions over %d tags in %.0f ms",
+        result["suggestions"],
+        result["tags"],
+        result.get("elapsed_ms", 0.0),
+    )
+
+
+def schedule_scoring(db_path: Path, labelled: set[str] | None = None) -> None:
+    # Bulk tagging sends one PATCH per image; rescoring waits for the burst to end. Jobs and
+    # ingests pass no labels and reuse the set from the last label change.
+    with _TIMER_LOCK:
+        if labelled is not None:
+            _LABELLED[db_path] = frozenset(labelled)
+        timer = _TIMERS.get(db_path)
+        if timer is not None:
+            timer.cancel()
+        timer = threading.Timer(SCORE_DEBOUNCE_SECONDS, _score_in_background, args=(db_path,))
+        timer.daemon = True
+        _TIMERS[db_path] = timer
+        timer.start()
+
+
+def schedule_update(db_path: Path, labels: dict[str, list[str]], input_path: str) -> None:
+    # Training runs on the scoring timer: its first call after a matrix change builds the
+    # dense search matrix, which is too slow for the label request.
+    with _TIMER_LOCK:
+        _, updated = _PENDING.get(db_path, ({}, []))
+        _PENDING[db_path] = (dict(labels), [*updated, input_path])
+    schedule_scoring(db_path, set(labels))
+
+
+def binary_entropy(probabilities: np.ndarray) -> np.ndarray:
+    p = np.clip(probabilities, 1e-7, 1 - 1e-7)
+    return -(p * np.log2(p) + (1 - p) * np.log2(1 - p))
+
+
+def diverse_order(
+    vectors: np.ndarray,
+    priority: np.ndarray,
+    anchors: np.ndarray,
+    size: int,
+) -> tuple[np.ndarray, np.ndarray]:
+    # Greedy k-center weighted by uncertainty: each pick maximises priority times the cosine
+    # distance to its closest labelled or already queued image.
+    novelty = np.ones(len(vectors), dtype=np.float32)
+    for start in range(0, len(anchors), SCORE_CHUNK_ROWS):
+        closest = (vectors @ anchors[start : start + SCORE_CHUNK_ROWS].T).max(axis=1)
+        novelty = np.minimum(novelty, 1.0 - closest)
+    novelty = np.clip(novelty, 0.0, 1.0)
+    order = np.zeros(min(size, len(vectors)), dtype=np.int64)
+    picked_novelty = np.zeros(len(order), dtype=np.float32)
+    for step in range(len(order)):
+        pick = int(np.argmax(priority * novelty))
+        order[step] = pick
+        picked_novelty[step] = novelty[pick]
+        np.minimum(novelty, 1.0 - vectors @ vectors[pick], out=novelty)
+        novelty[pick] = -1.0
+    return order, picked_novelty
+
+
+def build_queue(
+    conn: sqlite3.Connection,
+    index: ann.SearchIndex,
+    tag_model: TagModel,
+    labelled: set[str],
+) -> dict:
+    unlabelled = np.array(
+        [position for position, path in enumerate(index.paths) if path not in labelled],
+        dtype=np.int64,
+    )
+    eligible = eligible_tags(tag_model)
+    tags = [tag_model.tags[column] for column in eligible]
+    uncertainty = np.ones(len(index.paths), dtype=np.float32)
+    best_tags = np.zeros((len(index.paths), 0), dtype=np.int64)
+    best_probabilities = np.zeros((len(index.paths), 0), dtype=np.float32)
+    if eligible.size:
+        weights = tag_model.weights[eligible]
+        bias = tag_model.bias[eligible]
+        top = min(SUGGEST_TOP_K, len(tags))
+        best_tags = np.zeros((len(index.paths), top), dtype=np.int64)
+        best_probabilities = np.zeros((len(index.paths), top), dtype=np.float32)
+        for start in range(0, len(index.paths), SCORE_CHUNK_ROWS):
+            probabilities = sigmoid(
+                index.dense[start : start + SCORE_CHUNK_ROWS] @ weights.T + bias
+            )
+            stop = start + len(probabilities)
+            # The least settled tag decision is what a label would resolve.
+            uncertainty[start:stop] = binary_entropy(probabilities).max(axis=1)
+            ranked = np.argsort(-probabilities, axis=1)[:, :top]
+            best_tags[start:stop] = ranked
+            best_probabilities[start:stop] = np.take_along_axis(probabilities, ranked, axis=1)
+
+    # Neighbour uncertainty: images in a cluster the model is unsure about are worth more.
+    cluster_of = dict(conn.execute("SELECT input_path, cluster FROM clip_item").fetchall())
+    clusters = np.array([cluster_of.get(path, -1) for path in index.paths], dtype=np.int64)
+    clusters = np.unique(clusters, return_inverse=True)[1]
+    totals = np.bincount(clusters, weights=uncertainty)
+    counts = np.bincount(clusters)
+    neighbor = (totals / np.maximum(counts, 1))[clusters].astype(np.float32)
+    priority = (1.0 - NEIGHBOR_WEIGHT) * uncertainty + NEIGHBOR_WEIGHT * neighbor
+
+    if len(unlabelled) > QUEUE_POOL:
+        if eligible.size:
+            pool = unlabelled[np.argpartition(-priority[unlabelled], QUEUE_POOL - 1)[:QUEUE_POOL]]
+        else:
+            # Without a model every image is equally uncertain; start from an even spread.
+            pool = np.random.default_rng(0).choice(unlabelled, size=QUEUE_POOL, replace=False)
+    else:
+        pool = unlabelled
+    anchor_positions = np.array(
+        [index.position[path] for path in labelled if path in index.position],
+        dtype=np.int64,
+    )
+    if len(anchor_positions) > QUEUE_ANCHORS:
+        anchor_positions = np.random.default_rng(0).choice(
+            anchor_positions, size=QUEUE_ANCHORS, replace=False
+        )
+    order, novelty = diverse_order(
+        index.dense[pool],
+        priority[pool],
+        index.dense[anchor_positions],
+        QUEUE_SIZE,
+    )
+    queue = pool[order]
+    return {
+        "tags": tags,
+        "unlabelled": len(unlabelled),
+        "positions": queue,
+        "uncertainty": uncertainty[queue],
+        "neighbor_uncertainty": neighbor[queue],
+        "novelty": novelty,
+        "priority": priority[queue] * novelty,
+        "best_tags": best_tags[queue],
+        "best_probabilities": best_probabilities[queue],
+    }
+
+
+def review_queue(
+    db_path: Path,
+    labelled: set[str],
+    offset: int = 0,
+    limit: int = 50,
+) -> dict:
+    started = time.perf_counter()
+    index = ann.search_index(db_path)
+    if index is None:
+        raise LookupError(f"No CLIP matrix store next to {db_path}")
+    with database.connection(db_path) as conn:
+        model_version = conn.execute("SELECT COUNT(*), MAX(updated_at) FROM tag_model").fetchone()
+        key = (index.key, tuple(model_version), hash(frozenset(labelled)))
+        with _QUEUE_LOCK:
+            cached = _QUEUES.get(db_path)
+            if cached is None or cached[0] != key:
+                tag_model = read_tag_model(conn, index.model, index.matrix.shape[1])
+                cached = (key, build_queue(conn, index, tag_model, labelled))
+                _QUEUES[db_path] = cached
+                hit = False
+            else:
+                hit = True
+    queue = cached[1]
+    total = len(queue["positions"])
+    items = []
+    for rank in range(offset, min(offset + limit, total)):
+        predictions = zip(queue["best_tags"][rank], queue["best_probabilities"][rank], strict=True)
+        items.append(
+            {
+                "input_path": index.paths[int(queue["positions"][rank])],
+                "rank": rank,
+                "score": round(float(queue["priority"][rank]), 4),
+                "uncertainty": round(float(queue["uncertainty"][rank]), 4),
+                "neighbor_uncertainty": round(float(queue["neighbor_uncertainty"][rank]), 4),
+                "novelty": round(float(queue["novelty"][rank]), 4),
+                "predictions": [
+                    {"tag": queue["tags"][int(column)], "confidence": round(float(p), 4)}
+                    for column, p in predictions
+                ],
+            }
+        )
+    return {
+        "offset": offset,
+        "limit": limit,
+        "total": total,
+        "unlabelled": queue["unlabelled"],
+        "next_offset": offset + limit if offset + limit < total else None,
+        "model_tags": len(queue["tags"]),
+        "cached": hit,
+        "elapsed_ms": round(1000 * (time.perf_counter() - started), 3),
+        "items": items,
+    }
@@ -0,0 +1,413 @@
+import sqlite3
+import threading
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from pathlib import Path
+
+POOL_SIZE = 8
+BUSY_TIMEOUT_SECONDS = 30.0
+CACHE_KIB = 64 * 1024
+MMAP_BYTES = 256 * 1024 * 1024
+OCR_FTS_TRIGGERS = (
+    """
+    CREATE TRIGGER IF NOT EXISTS ocr_doc_fts_insert AFTER INSERT ON ocr_doc BEGIN
+        INSERT INTO ocr_fts(rowid, text) VALUES (new.rowid, new.text);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS ocr_doc_fts_delete AFTER DELETE ON ocr_doc BEGIN
+        INSERT INTO ocr_fts(ocr_fts, rowid, text) VALUES ('delete', old.rowid, old.text);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS ocr_doc_fts_update AFTER UPDATE OF text ON ocr_doc BEGIN
+        INSERT INTO ocr_fts(ocr_fts, rowid, text) VALUES ('delete', old.rowid, old.text);
+        INSERT INTO ocr_fts(rowid, text) VALUES (new.rowid, new.text);
+    END
+    """,
+)
+
+_SCHEMA_LOCK = threading.Lock()
+_READY: dict[Path, int] = {}
+_POOL_LOCK = threading.Lock()
+_POOLS: dict[Path, list[sqlite3.Connection]] = {}
+
+
+def add_missing_column(conn: sqlite3.Connection, table: str, column: str, definition: str) -> None:
+    columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})").fetchall()}
+    if column in columns:
+        return
+    try:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    except sqlite3.OperationalError as exc:
+        if f"duplicate column name: {column}" not in str(exc).lower():
+            raise
+
+
+def execute_script(conn: sqlite3.Connection, script: str) -> None:
+    # executescript() commits first, which would split a migration from its version bump.
+    statement = ""
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            conn.execute(statement)
+            statement = ""
+    if statement.strip():
+        conn.execute(statement)
+
+
+def create_ocr_fts(conn: sqlite3.Connection) -> bool:
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'ocr_fts'").fetchone():
+        return True
+    # External content: the index stores tokens only and reads text back from ocr_doc.
+    try:
+        conn.execute(
+            """
+            CREATE VIRTUAL TABLE ocr_fts USING fts5(
+                text,
+                content = 'ocr_doc',
+                content_rowid = 'rowid',
+                tokenize = 'unicode61 remove_diacritics 2',
+                prefix = '2 3'
+            )
+            """
+        )
+    except sqlite3.OperationalError as exc:
+        if "fts5" not in str(exc):
+            raise
+        return False
+    for statement in OCR_FTS_TRIGGERS:
+        conn.execute(statement)
+    conn.execute("INSERT INTO ocr_fts(ocr_fts) VALUES ('rebuild')")
+    return True
+
+
+def create_core_tables(conn: sqlite3.Connection) -> None:
+    execute_script(
+        conn,
+        """
+        CREATE TABLE IF NOT EXISTS ml_status (
+            id INTEGER PRIMARY KEY CHECK(id = 1),
+            payload TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS clip_item (
+            input_path TEXT PRIMARY KEY,
+            series TEXT NOT NULL,
+            source TEXT NOT NULL,
+            cluster INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS clip_cluster (
+            cluster_id INTEGER PRIMARY KEY,
+            count INTEGER NOT NULL,
+            centroid BLOB
+        );
+        CREATE TABLE IF NOT EXISTS clip_cluster_model (
+            id INTEGER PRIMARY KEY CHECK(id = 1),
+            model TEXT NOT NULL,
+            cluster_count INTEGER NOT NULL,
+            fitted_images INTEGER NOT NULL,
+            baseline_distance REAL NOT NULL,
+            changed_images INTEGER NOT NULL,
+            fitted_at TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS clip_embedding (
+            input_path TEXT PRIMARY KEY,
+            model TEXT NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            size_bytes INTEGER NOT NULL,
+            dim INTEGER NOT NULL,
+            vector BLOB NOT NULL,
+            valid INTEGER NOT NULL DEFAULT 1,
+            norm REAL
+        );
+        CREATE TABLE IF NOT EXISTS ocr_doc (
+            input_path TEXT PRIMARY KEY,
+            text TEXT NOT NULL,
+            ocr_mode TEXT NOT NULL DEFAULT 'full'
+        );
+        CREATE TABLE IF NOT EXISTS file_digest (
+            input_path TEXT PRIMARY KEY,
+            mtime_ns INTEGER NOT NULL,
+            size_bytes INTEGER NOT NULL,
+            partial_digest TEXT NOT NULL,
+            content_digest TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_file_digest_partial ON file_digest(partial_digest);
+        CREATE INDEX IF NOT EXISTS idx_file_digest_content ON file_digest(content_digest);
+        CREATE TABLE IF NOT EXISTS clip_feature (
+            content_digest TEXT NOT NULL,
+            model TEXT NOT NULL,
+            dim INTEGER NOT NULL,
+            vector BLOB NOT NULL,
+            valid INTEGER NOT NULL,
+            norm REAL,
+            PRIMARY KEY(content_digest, model)
+        );
+        CREATE TABLE IF NOT EXISTS ocr_feature (
+            content_digest TEXT PRIMARY KEY,
+            text TEXT NOT NULL,
+            ocr_mode TEXT NOT NULL DEFAULT 'full'
+        );
+        CREATE TABLE IF NOT EXISTS matrix_store (
+            id INTEGER PRIMARY KEY CHECK(id = 1),
+            model TEXT NOT NULL,
+            dtype TEXT NOT NULL,
+            dim INTEGER NOT NULL,
+            file_name TEXT NOT NULL,
+            row_count INTEGER NOT NULL,
+            generation INTEGER NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS matrix_row (
+            input_path TEXT PRIMARY KEY,
+            row INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            size_bytes INTEGER NOT NULL,
+            valid INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS ann_meta (
+            id INTEGER PRIMARY KEY CHECK(id = 1),
+            model TEXT NOT NULL,
+            nlist INTEGER NOT NULL,
+            trained_rows INTEGER NOT NULL,
+            version INTEGER NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS ann_centroid (
+            list_id INTEGER PRIMARY KEY,
+            centroid BLOB NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS image_hash (
+            input_path TEXT PRIMARY KEY,
+            mtime_ns INTEGER NOT NULL,
+            size_bytes INTEGER NOT NULL,
+            phash INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS duplicate_group (
+            input_path TEXT PRIMARY KEY,
+            group_id INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_duplicate_group_group ON duplicate_group(group_id);
+        CREATE TABLE IF NOT EXISTS tag_model (
+            tag TEXT PRIMARY KEY,
+            model TEXT NOT NULL,
+            dim INTEGER NOT NULL,
+            weight BLOB NOT NULL,
+            bias REAL NOT NULL,
+            positives INTEGER NOT NULL,
+            negatives INTEGER NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS ann_entry (
+            input_path TEXT PRIMARY KEY,
+            list_id INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            size_bytes INTEGER NOT NULL
+        );
+        """,
+    )
+
+
+def add_legacy_columns(conn: sqlite3.Connection) -> None:
+    # Databases from before user_version was tracked may predate any of these columns.
+    add_missing_column(conn, "clip_embedding", "valid", "INTEGER NOT NULL DEFAULT 1")
+    add_missing_column(conn, "clip_embedding", "norm", "REAL")
+    add_missing_column(conn, "clip_feature", "norm", "REAL")
+    add_missing_column(conn, "clip_cluster", "centroid", "BLOB")
+    add_missing_column(conn, "clip_cluster", "weight", "REAL NOT NULL DEFAULT 0")
+    add_missing_column(conn, "clip_cluster", "exemplars", "TEXT NOT NULL DEFAULT '[]'")
+    add_missing_column(conn, "clip_cluster", "spread", "REAL NOT NULL DEFAULT 0")
+    add_missing_column(conn, "clip_cluster", "top_tags", "TEXT NOT NULL DEFAULT '[]'")
+    add_missing_column(conn, "clip_item", "mtime_ns", "INTEGER NOT NULL DEFAULT 0")
+    add_missing_column(conn, "clip_item", "size_bytes", "INTEGER NOT NULL DEFAULT 0")
+    add_missing_column(conn, "ocr_doc", "ocr_mode", "TEXT NOT NULL DEFAULT 'full'")
+    add_missing_column(conn, "ocr_feature", "ocr_mode", "TEXT NOT NULL DEFAULT 'full'")
+
+
+def create_review_tables(conn: sqlite3.Connection) -> None:
+    execute_script(
+        conn,
+        """
+        CREATE TABLE IF NOT EXISTS tag_assignment (
+            input_path TEXT NOT NULL,
+            tag TEXT NOT NULL,
+            source TEXT NOT NULL,
+            confidence REAL NOT NULL,
+            updated_at TEXT NOT NULL,
+            PRIMARY KEY(input_path, tag)
+        );
+        CREATE INDEX IF NOT EXISTS idx_tag_assignment_tag ON tag_assignment(tag);
+
+        CREATE TABLE IF NOT EXISTS review_event (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            input_path TEXT NOT NULL,
+            before_tags TEXT NOT NULL,
+            after_tags TEXT NOT NULL,
+            actor TEXT NOT NULL,
+            action TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        );
+        """,
+    )
+
+
+def add_ocr_doc_digest(conn: sqlite3.Connection) -> None:
+    add_missing_column(conn, "ocr_doc", "content_digest", "TEXT")
+
+
+def add_matrix_revision(conn: sqlite3.Connection) -> None:
+    add_missing_column(conn, "matrix_store", "revision", "INTEGER NOT NULL DEFAULT 0")
+
+
+def create_inventory_tables(conn: sqlite3.Connection) -> None:
+    execute_script(
+        conn,
+        """
+        CREATE TABLE IF NOT EXISTS inventory_meta (
+            id INTEGER PRIMARY KEY CHECK(id = 1),
+            generation INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS inventory_root (
+            root_id INTEGER PRIMARY KEY,
+            root_path TEXT NOT NULL,
+            spec_key TEXT NOT NULL,
+            generation INTEGER NOT NULL,
+            file_count INTEGER NOT NULL,
+            scanned_at REAL NOT NULL,
+            UNIQUE(root_path, spec_key)
+        );
+        CREATE TABLE IF NOT EXISTS inventory_dir (
+            root_id INTEGER NOT NULL,
+            dir_path TEXT NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            PRIMARY KEY(root_id, dir_path)
+        );
+        CREATE TABLE IF NOT EXISTS inventory_file (
+            root_id INTEGER NOT NULL,
+            input_path TEXT NOT NULL,
+            dir_path TEXT NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            size_bytes INTEGER NOT NULL,
+            PRIMARY KEY(root_id, input_path)
+        );
+        CREATE INDEX IF NOT EXISTS idx_inventory_file_dir
+            ON inventory_file(root_id, dir_path);
+        """,
+    )
+
+
+def create_job_tables(conn: sqlite3.Connection) -> None:
+    execute_script(
+        conn,
+        """
+        CREATE TABLE IF NOT EXISTS job_run (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            state TEXT NOT NULL,
+            started_at TEXT NOT NULL,
+            finished_at TEXT,
+            duration_seconds REAL,
+            paused_seconds REAL NOT NULL DEFAULT 0,
+            processed_images INTEGER NOT NULL DEFAULT 0,
+            error TEXT NOT NULL DEFAULT ''
+        );
+        """,
+    )
+
+
+# Applied in order; the schema version is the number of migrations run (PRAGMA user_version).
+# Every step is idempotent, so unversioned databases replay all of them safely.
+MIGRATIONS: tuple[Callable[[sqlite3.Connection], object], ...] = (
+    create_core_tables,
+    add_legacy_columns,
+    create_ocr_fts,
+    create_review_tables,
+    create_job_tables,
+    add_ocr_doc_digest,
+    add_matrix_revision,
+    create_inventory_tables,
+)
+
+
+def _open(db_path: Path) -> sqlite3.Connection:
+    # Pooled connections move between request threads, but only one thread uses one at a time.
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT_SECONDS, check_same_thread=False)
+    # WAL makes NORMAL durable across application crashes; only a power cut can lose the
+    # last commits.
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA cache_size = -{CACHE_KIB}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute(f"PRAGMA mmap_size = {MMAP_BYTES}")
+    return conn
+
+
+def _close_pool(key: Path) -> None:
+    with _POOL_LOCK:
+        pool = _POOLS.pop(key, [])
+    for conn in pool:
+        conn.close()
+
+
+def schema_version(conn: sqlite3.Connection) -> int:
+    return int(conn.execute("PRAGMA user_version").fetchone()[0])
+
+
+def ensure_schema(db_path: Path) -> None:
+    key = db_path.resolve()
+    try:
+        inode = key.stat().st_ino
+    except FileNotFoundError:
+        inode = None
+    if inode is not None and _READY.get(key) == inode:
+        return
+    with _SCHEMA_LOCK:
+        if inode is not None and _READY.get(key) == inode:
+            return
+        # A replaced or deleted file leaves pooled handles on the old inode.
+        _close_pool(key)
+        key.parent.mkdir(parents=True, exist_ok=True)
+        conn = _open(key)
+        try:
+            # WAL is persistent in the file: readers no longer block on the job's writes.
+            conn.execute("PRAGMA journal_mode = WAL")
+            # Each step commits together with its version bump. The write lock is taken before
+            # the version is read, so two processes opening an old file migrate it once.
+            while True:
+                with conn:
+                    conn.execute("BEGIN IMMEDIATE")
+                    version = schema_version(conn)
+                    if version >= len(MIGRATIONS):
+                        break
+                    MIGRATIONS[version](conn)
+                    conn.execute(f"PRAGMA user_version = {version + 1}")
+        finally:
+            conn.close()
+        _READY[key] = key.stat().st_ino
+
+
+def connect(db_path: Path) -> sqlite3.Connection:
+    ensure_schema(db_path)
+    return _open(db_path)
+
+
+@contextmanager
+def connection(db_path: Path) -> Iterator[sqlite3.Connection]:
+    ensure_schema(db_path)
+    key = db_path.resolve()
+    with _POOL_LOCK:
+        pool = _POOLS.get(key)
+        conn = pool.pop() if pool else None
+    if conn is None:
+        conn = _open(key)
+    try:
+        yield conn
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        with _POOL_LOCK:
+            pool = _POOLS.setdefault(key, [])
+            if len(pool) < POOL_SIZE:
+                pool.append(conn)
+                conn = None
+        if conn is not None:
+            conn.close()
@@ -0,0 +1,337 @@
+import sqlite3
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from itertools import combinations
+from pathlib import Path
+
+import numpy as np
+
+from bruki.server import ann
+
+HASH_SIZE = 8
+HASH_SAMPLE = 32
+FLAT_HASH_STD = 2.0
+DUPLICATE_RADIUS = 6
+DUPLICATE_MIN_COSINE = 0.95
+HASH_WORKERS = 8
+HASH_CHUNKS = 4
+PAIR_BLOCK_ROWS = 8192
+PAIR_BLOCK_CANDIDATES = 1 << 22
+COSINE_CHUNK_PAIRS = 16384
+
+HashRow = tuple[str, int, int, int | None]
+
+
+def dct_matrix(size: int) -> np.ndarray:
+    grid = np.arange(size)
+    basis = np.cos(np.pi * (2 * grid[None, :] + 1) * grid[:, None] / (2 * size))
+    basis[0] *= np.sqrt(1 / size)
+    basis[1:] *= np.sqrt(2 / size)
+    return basis.astype(np.float32)
+
+
+_DCT = dct_matrix(HASH_SAMPLE)
+
+
+def perceptual_hash(image) -> int | None:
+    from PIL import Image
+
+    small = image.resize((HASH_SAMPLE, HASH_SAMPLE), Image.Resampling.BILINEAR, reducing_gap=2.0)
+    pixels = np.asarray(small.convert("L"), dtype=np.float32)
+    coefficients = (_DCT @ pixels @ _DCT.T)[:HASH_SIZE, :HASH_SIZE].ravel()
+    # Blank and near-uniform frames all hash alike; they are not duplicates of each other.
+    if coefficients[1:].std() < FLAT_HASH_STD:
+        return None
+    bits = np.packbits(coefficients > np.median(coefficients[1:]))
+    # SQLite integers are signed 64-bit.
+    return int(bits.view(">i8")[0])
+
+
+def hash_file(path: str) -> int | None:
+    from PIL import Image
+
+    try:
+        with Image.open(path) as image:
+            image.draft("RGB", (4 * HASH_SAMPLE, 4 * HASH_SAMPLE))
+            return perceptual_hash(image.convert("RGB"))
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+
+def write_hashes(conn: sqlite3.Connection, rows: list[HashRow]) -> None:
+    with conn:
+        conn.executemany(
+            """
+            INSERT INTO image_hash(input_path, mtime_ns, size_bytes, phash)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(input_path) DO UPDATE SET
+                mtime_ns = excluded.mtime_ns,
+                size_bytes = excluded.size_bytes,
+                phash = excluded.phash
+            """,
+            rows,
+        )
+
+
+def update_hashes(
+    conn: sqlite3.Connection,
+    paths: list[str],
+    path_stats: dict[str, tuple[int, int]],
+    digests: dict[str, str],
+    progress: Callable[[int, int], None] | None = None,
+    prune: bool = True,
+) -> dict:
+    known = {
+        input_path: (int(mtime_ns), int(size_bytes))
+        for input_path, mtime_ns, size_bytes in conn.execute(
+            "SELECT input_path, mtime_ns, size_bytes FROM image_hash"
+        )
+    }
+    stale = [
+        path
+        for path in paths
+        if path_stats.get(path, (0, 0)) != (0, 0) and known.get(path) != path_stats[path]
+    ]
+    # Byte-identical copies share a content digest, so they need not be decoded again.
+    by_digest = dict(
+        conn.execute(
+            """
+            SELECT file_digest.content_digest, image_hash.phash
+            FROM image_hash JOIN file_digest USING(input_path)
+            WHERE image_hash.mtime_ns = file_digest.mtime_ns
+              AND image_hash.size_bytes = file_digest.size_bytes
+            """
+        ).fetchall()
+    )
+    rows: list[HashRow] = []
+    pending: list[str] = []
+    for path in stale:
+        digest = digests.get(path)
+        if digest in by_digest:
+            rows.append((path, *path_stats[path], by_digest[digest]))
+        else:
+            pending.append(path)
+    reused = len(rows)
+    with ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="phash") as pool:
+        for done, (path, value) in enumerate(
+            zip(pending, pool.map(hash_file, pending), strict=True), start=1
+        ):
+            rows.append((path, *path_stats[path], value))
+            if progress is not None:
+                progress(done, len(pending))
+    write_hashes(conn, rows)
+
+    deleted = 0
+    if prune:
+        current = set(paths)
+        removed = [(path,) for path in known if path not in current]
+        with conn:
+            conn.executemany("DELETE FROM image_hash WHERE input_path = ?", removed)
+        deleted = len(removed)
+    return {
+        "hashed_images": len(pending),
+        "reused_hashes": reused,
+        "flat_images": sum(value is None for _, _, _, value in rows),
+        "deleted_rows": deleted,
+    }
+
+
+def chunk_probes(bits: int, errors: int) -> np.ndarray:
+    masks = [0]
+    for count in range(1, errors + 1):
+        masks.extend(sum(1 << bit for bit in flips) for flips in combinations(range(bits), count))
+    return np.array(masks, dtype=np.uint64)
+
+
+def verify_slice(
+    hashes: np.ndarray,
+    order: np.ndarray,
+    rows: np.ndarray,
+    low: np.ndarray,
+    counts: np.ndarray,
+    probe_count: int,
+    radius: int,
+    one_sided: bool,
+) -> np.ndarray:
+    # Expand each probe's [low, low + count) slice of the sorted order.
+    offsets = np.repeat(low - np.cumsum(counts) + counts, counts)
+    right = order[offsets + np.arange(counts.sum())]
+    left = np.repeat(np.repeat(rows, probe_count), counts)
+    # When every row probes, each pair is found from both ends; one of them is enough.
+    keep = left < right if one_sided else left != right
+    keep &= np.bitwise_count(hashes[left] ^ hashes[right]) <= radius
+    return np.stack([left[keep], right[keep]], axis=1)
+
+
+def candidate_pairs(
+    hashes: np.ndarray,
+    radius: int = DUPLICATE_RADIUS,
+    queries: np.ndarray | None = None,
+) -> np.ndarray:
+    # Multi-index hashing: two hashes within `radius` bits differ in at most
+    # radius // HASH_CHUNKS bits on at least one 16-bit chunk, so each chunk is probed
+    # with every key that close and only images found that way are compared. Only the
+    # `queries` rows probe when given; pairs come back as (smaller, larger) row numbers.
+    errors = radius // HASH_CHUNKS
+    chunk_bits = 64 // HASH_CHUNKS
+    probes = chunk_probes(chunk_bits, errors)
+    one_sided = queries is None
+    queries = np.arange(len(hashes)) if queries is None else queries
+    found: list[np.ndarray] = []
+    for chunk in range(HASH_CHUNKS):
+        keys = (hashes >> np.uint64(chunk * chunk_bits)) & np.uint64((1 << chunk_bits) - 1)
+        order = np.argsort(keys, kind="stable")
+        # 16-bit keys index a bucket table directly instead of binary-searching per probe.
+        bounds = np.searchsorted(keys[order], np.arange((1 << chunk_bits) + 1, dtype=np.uint64))
+        for start in range(0, len(queries), PAIR_BLOCK_ROWS):
+            rows = queries[start : start + PAIR_BLOCK_ROWS]
+            wanted = keys[rows, None] ^ probes[None, :]
+            low = bounds[wanted]
+            counts = bounds[wanted + np.uint64(1)] - low
+            # Screenshots of one app often share a chunk, and their buckets grow with the
+            # library; rows are verified in slices of bounded candidate count.
+            totals = np.cumsum(counts.sum(axis=1))
+            limits = np.arange(PAIR_BLOCK_CANDIDATES, totals[-1], PAIR_BLOCK_CANDIDATES)
+            for piece in np.split(np.arange(len(rows)), np.searchsorted(totals, limits)):
+                if len(piece):
+                    found.append(
+                        verify_slice(
+                            hashes,
+                            order,
+                            rows[piece],
+                            low[piece].ravel(),
+                            counts[piece].ravel(),
+                            len(probes),
+                            radius,
+                            one_sided,
+                        )
+                    )
+    if not found:
+        return np.zeros((0, 2), dtype=np.int64)
+    return np.unique(np.sort(np.concatenate(found), axis=1), axis=0)
+
+
+def confirm_pairs(pairs: np.ndarray, paths: list[str], index: ann.SearchIndex | None) -> np.ndarray:
+    if index is None or not len(pairs):
+        return pairs
+    positions = np.array([index.position.get(path, -1) for path in paths], dtype=np.int64)
+    left, right = positions[pairs[:, 0]], positions[pairs[:, 1]]
+    # Pairs without an embedding on both sides stand on the hash alone.
+    cosine = np.ones(len(pairs), dtype=np.float32)
+    both = np.flatnonzero((left >= 0) & (right >= 0))
+    for start in range(0, len(both), COSINE_CHUNK_PAIRS):
+        chunk = both[start : start + COSINE_CHUNK_PAIRS]
+        cosine[chunk] = np.einsum("ij,ij->i", index.dense[left[chunk]], index.dense[right[chunk]])
+    return pairs[cosine >= DUPLICATE_MIN_COSINE]
+
+
+def components(count: int, pairs: np.ndarray) -> np.ndarray:
+    parent = np.arange(count)
+
+    def root(node: int) -> int:
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    for left, right in pairs:
+        left_root, right_root = root(int(left)), root(int(right))
+        if left_root != right_root:
+            parent[max(left_root, right_root)] = min(left_root, right_root)
+    return np.array([root(node) for node in range(count)], dtype=np.int64)
+
+
+def neighbourhood(
+    conn: sqlite3.Connection,
+    paths: list[str],
+    hashes: np.ndarray,
+    changed: list[str],
+    index: ann.SearchIndex | None,
+) -> tuple[list[str], np.ndarray, int]:
+    # Grows the changed paths to every group they were or now are part of. Each affected
+    # row probes the whole library once, so the pairs found cover every edge among them.
+    position = {input_path: row for row, input_path in enumerate(paths)}
+    previous = dict(conn.execute("SELECT input_path, group_id FROM duplicate_group").fetchall())
+    members: dict[int, list[str]] = {}
+    for input_path, group_id in previous.items():
+        members.setdefault(group_id, []).append(input_path)
+    affected: set[str] = set()
+    frontier = set(changed)
+    found: list[np.ndarray] = []
+    candidates = 0
+    while frontier:
+        for input_path in list(frontier):
+            if input_path in previous:
+                frontier.update(members[previous[input_path]])
+        frontier -= affected
+        affected |= frontier
+        queries = np.array(
+            sorted(position[input_path] for input_path in frontier if input_path in position),
+            dtype=np.int64,
+        )
+        pairs = candidate_pairs(hashes, queries=queries)
+        candidates += len(pairs)
+        pairs = confirm_pairs(pairs, paths, index)
+        found.append(pairs)
+        frontier = {paths[row] for row in pairs.ravel()} - affected
+    pairs = np.unique(np.concatenate(found), axis=0) if found else np.zeros((0, 2), np.int64)
+    return sorted(affected), pairs, candidates
+
+
+def update_groups(
+    conn: sqlite3.Connection,
+    db_path: Path,
+    changed: list[str] | None = None,
+) -> dict:
+    rows = conn.execute(
+        "SELECT input_path, phash FROM image_hash WHERE phash IS NOT NULL ORDER BY input_path"
+    ).fetchall()
+    paths = [input_path for input_path, _ in rows]
+    hashes = np.array([value for _, value in rows], dtype=np.int64).view(np.uint64)
+    index = ann.search_index(db_path)
+    if changed is None:
+        regrouped = paths
+        candidates = candidate_pairs(hashes)
+        candidate_count = len(candidates)
+        confirmed = confirm_pairs(candidates, paths, index)
+    else:
+        # Ingest batches regroup only around what changed; the other groups stand.
+        regrouped, confirmed, candidate_count = neighbourhood(conn, paths, hashes, changed, index)
+    position = {input_path: row for row, input_path in enumerate(paths)}
+    subset = np.array(
+        [position[input_path] for input_path in regrouped if input_path in position],
+        dtype=np.int64,
+    )
+    roots = components(len(subset), np.searchsorted(subset, confirmed))
+    sizes = np.bincount(roots, minlength=len(subset))
+    grouped = np.flatnonzero(sizes[roots] > 1)
+    with conn:
+        if changed is None:
+            conn.execute("DELETE FROM duplicate_group")
+        else:
+            conn.executemany(
+                "DELETE FROM duplicate_group WHERE input_path = ?",
+                [(input_path,) for input_path in regrouped],
+            )
+        (last_id,) = conn.execute(
+            "SELECT COALESCE(MAX(group_id), 0) FROM duplicate_group"
+        ).fetchone()
+        # Paths are sorted, so each new group is numbered by its first member.
+        group_ids = {
+            root: int(last_id) + number for number, root in enumerate(np.unique(roots[grouped]), 1)
+        }
+        conn.executemany(
+            "INSERT INTO duplicate_group(input_path, group_id) VALUES (?, ?)",
+            [(paths[subset[row]], group_ids[roots[row]]) for row in grouped],
+        )
+        groups, grouped_images = conn.execute(
+            "SELECT COUNT(DISTINCT group_id), COUNT(*) FROM duplicate_group"
+        ).fetchone()
+    return {
+        "hash_rows": len(paths),
+        "regrouped_images": len(regrouped),
+        "candidate_pairs": candidate_count,
+        "confirmed_pairs": len(confirmed),
+        "groups": int(groups),
+        "grouped_images": int(grouped_images),
+    }
@@ -0,0 +1,292 @@
+import ctypes
+import logging
+import os
+import platform
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+from bruki.server import database
+from bruki.server import status as status_store
+
+NICE_ENV = "TAGGER_NICE"
+IO_PRIORITY_ENV = "TAGGER_IO_PRIORITY"
+WINDOWS_ENV = "TAGGER_JOB_WINDOWS"
+DEFAULT_NICE = 10
+DEFAULT_IO_PRIORITY = "best-effort"
+IO_PRIORITY_CLASSES = {"realtime": 1, "best-effort": 2, "idle": 3}
+# Lowest level within the best-effort class; the idle and realtime classes ignore it.
+IO_PRIORITY_LEVEL = 7
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_SET_SYSCALLS = {"x86_64": 251, "aarch64": 30, "i386": 289, "i686": 289}
+WINDOW_RECHECK_SECONDS = 30.0
+HISTORY_LIMIT = 200
+
+_STATE_LOCK = threading.Condition()
+_ACTIVE: "JobControl | None" = None
+
+logger = logging.getLogger(__name__)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+@dataclass
+class JobControl:
+    job_id: int
+    db_path: Path
+    kind: str
+    thread: threading.Thread
+    started: float
+    windowed: bool = True
+    state: str = "running"
+    paused: bool = False
+    cancelled: bool = False
+    paused_seconds: float = 0.0
+
+
+def now_iso() -> str:
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+
+
+def parse_windows(spec: str) -> list[tuple[int, int]]:
+    windows = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            start, end = (
+                int(hour) * 60 + int(minute)
+                for hour, minute in (bound.strip().split(":") for bound in part.split("-"))
+            )
+        except ValueError:
+            raise ValueError(f"{WINDOWS_ENV} entries must look like 22:00-07:00") from None
+        if not (0 <= start < 24 * 60 and 0 <= end < 24 * 60) or start == end:
+            raise ValueError(f"{WINDOWS_ENV} has an empty or out-of-range window: {part}")
+        windows.append((start, end))
+    return windows
+
+
+def job_windows() -> list[tuple[int, int]]:
+    return parse_windows(os.environ.get(WINDOWS_ENV, ""))
+
+
+def within_windows(windows: list[tuple[int, int]], moment: time.struct_time) -> bool:
+    if not windows:
+        return True
+    minute = moment.tm_hour * 60 + moment.tm_min
+    # A window whose end is before its start wraps past midnight.
+    return any(
+        start <= minute < end if start < end else minute >= start or minute < end
+        for start, end in windows
+    )
+
+
+def set_io_priority(name: str) -> bool:
+    if name not in IO_PRIORITY_CLASSES:
+        raise ValueError(f"{IO_PRIORITY_ENV} must be one of off, {', '.join(IO_PRIORITY_CLASSES)}")
+    syscall = IOPRIO_SET_SYSCALLS.get(platform.machine())
+    if syscall is None:
+        return False
+    value = IO_PRIORITY_CLASSES[name] << IOPRIO_CLASS_SHIFT | IO_PRIORITY_LEVEL
+    # Who 0 is the calling thread; threads and processes it starts later inherit the class.
+    libc = ctypes.CDLL(None, use_errno=True)
+    return libc.syscall(syscall, IOPRIO_WHO_PROCESS, 0, value) == 0
+
+
+def priority_settings() -> tuple[int, str]:
+    try:
+        nice = int(os.environ.get(NICE_ENV, str(DEFAULT_NICE)))
+    except ValueError:
+        raise ValueError(f"{NICE_ENV} must be an integer") from None
+    io_priority = os.environ.get(IO_PRIORITY_ENV, DEFAULT_IO_PRIORITY).strip().lower()
+    if io_priority != "off" and io_priority not in IO_PRIORITY_CLASSES:
+        raise ValueError(f"{IO_PRIORITY_ENV} must be one of off, {', '.join(IO_PRIORITY_CLASSES)}")
+    return nice, io_priority
+
+
+def apply_priority(nice: int, io_priority: str) -> dict:
+    applied = {"nice": None, "io_priority": None}
+    # On Linux the nice value is per thread. Raising it only affects this job thread and the
+    # decode threads, torch threads and OCR processes it starts afterwards.
+    try:
+        thread_id = threading.get_native_id()
+        current = os.getpriority(os.PRIO_PROCESS, thread_id)
+        if nice > current:
+            os.setpriority(os.PRIO_PROCESS, thread_id, nice)
+        applied["nice"] = os.getpriority(os.PRIO_PROCESS, thread_id)
+    except (AttributeError, OSError) as exc:
+        logger.warning("could not lower job CPU priority: %s", exc)
+    if io_priority != "off":
+        try:
+            if set_io_priority(io_priority):
+                applied["io_priority"] = io_priority
+        except OSError as exc:
+            logger.warning("could not lower job I/O priority: %s", exc)
+    return applied
+
+
+def publish(control: JobControl, **fields: object) -> None:
+    status_store.status_bus(control.db_path).publish(
+        {"job_id": control.job_id, "job_state": control.state, **fields, "updated_at": now_iso()}
+    )
+
+
+def begin(db_path: Path, kind: str, windowed: bool = True) -> JobControl:
+    global _ACTIVE
+    # Settings are checked before the row exists, so a bad value cannot leave it running.
+    windows = job_windows() if windowed else []
+    settings = priority_settings()
+    with database.connection(db_path) as conn, conn:
+        job_id = conn.execute(
+            "INSERT INTO job_run(kind, state, started_at) VALUES (?, 'running', ?)",
+            (kind, now_iso()),
+        ).lastrowid
+    control = JobControl(
+        int(job_id), db_path, kind, threading.current_thread(), time.monotonic(), windowed
+    )
+    with _STATE_LOCK:
+        _ACTIVE = control
+    priority = apply_priority(*settings)
+    publish(control, job_kind=kind, job_priority=priority, job_windows=windows_text(windows))
+    return control
+
+
+def finish(control: JobControl, state: str, error: str = "", processed_images: int = 0) -> None:
+    global _ACTIVE
+    with _STATE_LOCK:
+        if _ACTIVE is control:
+            _ACTIVE = None
+        control.state = state
+        _STATE_LOCK.notify_all()
+    duration = time.monotonic() - control.started
+    with database.connection(control.db_path) as conn, conn:
+        conn.execute(
+            """
+            UPDATE job_run SET
+                state = ?, finished_at = ?, duration_seconds = ?, paused_seconds = ?,
+                processed_images = ?, error = ?
+            WHERE id = ?
+            """,
+            (
+                state,
+                now_iso(),
+                round(duration, 3),
+                round(control.paused_seconds, 3),
+                processed_images,
+                error,
+                control.job_id,
+            ),
+        )
+        conn.execute(
+            "DELETE FROM job_run WHERE id <= (SELECT MAX(id) FROM job_run) - ?",
+            (HISTORY_LIMIT,),
+        )
+    publish(control)
+
+
+def windows_text(windows: list[tuple[int, int]]) -> list[str]:
+    return [
+        f"{start // 60:02d}:{start % 60:02d}-{end // 60:02d}:{end % 60:02d}"
+        for start, end in windows
+    ]
+
+
+def checkpoint() -> None:
+    # Called between units of work in the job thread; cheap when nothing is requested.
+    control = _ACTIVE
+    if control is None or control.thread is not threading.current_thread():
+        return
+    windows = job_windows() if control.windowed else []
+    if not (control.cancelled or control.paused or windows):
+        return
+    with _STATE_LOCK:
+        blocked_since = None
+        while not control.cancelled:
+            if control.paused:
+                state = "paused"
+            elif not within_windows(windows, time.localtime()):
+                state = "waiting"
+            else:
+                break
+            if blocked_since is None:
+                blocked_since = time.monotonic()
+            if control.state != state:
+                control.state = state
+                publish(control)
+            _STATE_LOCK.wait(WINDOW_RECHECK_SECONDS)
+            windows = job_windows() if control.windowed else []
+        if blocked_since is not None:
+            control.paused_seconds += time.monotonic() - blocked_since
+            control.state = "cancelling" if control.cancelled else "running"
+            publish(control)
+        if control.cancelled:
+            raise JobCancelled(f"job {control.job_id} cancelled")
+
+
+def request(action: str) -> dict | None:
+    with _STATE_LOCK:
+        control = _ACTIVE
+        if control is None:
+            return None
+        if action == "cancel":
+            control.cancelled = True
+            control.state = "cancelling"
+        elif action == "pause":
+            control.paused = True
+        elif action == "resume":
+            control.paused = False
+        else:
+            raise ValueError(f"unknown job action: {action}")
+        _STATE_LOCK.notify_all()
+        # The job thread reports paused/running itself once it reaches a checkpoint.
+        publish(control, job_paused=control.paused)
+        return {"job_id": control.job_id, "kind": control.kind, "state": control.state}
+
+
+def history(db_path: Path, limit: int) -> list[dict]:
+    with database.connection(db_path) as conn:
+        rows = conn.execute(
+            """
+            SELECT id, kind, state, started_at, finished_at, duration_seconds,
+                   paused_seconds, processed_images, error
+            FROM job_run ORDER BY id DESC LIMIT ?
+            """,
+            (limit,),
+        ).fetchall()
+    active = _ACTIVE
+    jobs = []
+    for (
+        job_id,
+        kind,
+        state,
+        started_at,
+        finished_at,
+        duration,
+        paused,
+        processed,
+        error,
+    ) in rows:
+        if active is not None and active.job_id == job_id:
+            state = active.state
+            duration = round(time.monotonic() - active.started, 3)
+            paused = round(active.paused_seconds, 3)
+        jobs.append(
+            {
+                "id": int(job_id),
+                "kind": kind,
+                "state": state,
+                "started_at": started_at,
+                "finished_at": finished_at,
+                "duration_seconds": duration,
+                "paused_seconds": paused,
+                "active_seconds": None if duration is None else round(duration - paused, 3),
+                "processed_images": processed,
+                "error": error,
+            }
+        )
+    return jobs
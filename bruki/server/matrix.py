@@ -0,0 +1,325 @@
+import os
+import sqlite3
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+
+MATRIX_DTYPE_ENV = "TAGGER_MATRIX_DTYPE"
+DEFAULT_MATRIX_DTYPE = "float16"
+MATRIX_DTYPES = ("float16", "float32")
+MATRIX_FILE_PREFIX = "clip_matrix"
+APPEND_CHUNK_ROWS = 4096
+COMPACT_DEAD_FRACTION = 0.25
+COMPACT_MIN_DEAD_ROWS = 1024
+
+
+@dataclass(frozen=True)
+class StoreInfo:
+    model: str
+    dtype: str
+    dim: int
+    file_name: str
+    row_count: int
+    generation: int
+
+
+@dataclass(frozen=True)
+class MatrixView:
+    model: str
+    generation: int
+    paths: list[str]
+    rows: np.ndarray
+    valid: np.ndarray
+    matrix: np.ndarray
+
+    def vectors(self, dtype: type = np.float32) -> np.ndarray:
+        return np.asarray(self.matrix[self.rows], dtype=dtype)
+
+
+def matrix_dtype() -> str:
+    value = os.environ.get(MATRIX_DTYPE_ENV, DEFAULT_MATRIX_DTYPE).strip().lower()
+    if value not in MATRIX_DTYPES:
+        raise ValueError(f"{MATRIX_DTYPE_ENV} must be one of {', '.join(MATRIX_DTYPES)}")
+    return value
+
+
+def matrix_file_name(db_path: Path, dtype: str, generation: int) -> str:
+    # Named after the database, so stores of several databases can share a directory.
+    return f"{db_path.stem}.{MATRIX_FILE_PREFIX}.g{generation}.{dtype}"
+
+
+def read_store_info(conn: sqlite3.Connection) -> StoreInfo | None:
+    row = conn.execute(
+        """
+        SELECT model, dtype, dim, file_name, row_count, generation
+        FROM matrix_store WHERE id = 1
+        """
+    ).fetchone()
+    return None if row is None else StoreInfo(*row)
+
+
+def write_store_info(conn: sqlite3.Connection, info: StoreInfo) -> None:
+    conn.execute(
+        """
+        INSERT INTO matrix_store(
+            id, model, dtype, dim, file_name, row_count, generation, updated_at
+        )
+        VALUES (1, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(id) DO UPDATE SET
+            model = excluded.model,
+            dtype = excluded.dtype,
+            dim = excluded.dim,
+            file_name = excluded.file_name,
+            row_count = excluded.row_count,
+            generation = excluded.generation,
+            updated_at = excluded.updated_at
+        """,
+        (
+            info.model,
+            info.dtype,
+            info.dim,
+            info.file_name,
+            info.row_count,
+            info.generation,
+            time.time(),
+        ),
+    )
+
+
+def remove_stale_files(db_path: Path, keep: str, previous: StoreInfo | None) -> None:
+    stale = set(db_path.parent.glob(f"{db_path.stem}.{MATRIX_FILE_PREFIX}.g*"))
+    if previous is not None:
+        # Stores written before the file names carried the database name.
+        stale.add(db_path.parent / previous.file_name)
+    for path in stale:
+        if path.name != keep:
+            path.unlink(missing_ok=True)
+
+
+def reset_store(
+    conn: sqlite3.Connection, db_path: Path, model: str, dim: int, dtype: str
+) -> StoreInfo:
+    previous = read_store_info(conn)
+    generation = previous.generation + 1 if previous is not None else 1
+    file_name = matrix_file_name(db_path, dtype, generation)
+    info = StoreInfo(model, dtype, dim, file_name, 0, generation)
+    (db_path.parent / info.file_name).write_bytes(b"")
+    with conn:
+        conn.execute("DELETE FROM matrix_row")
+        write_store_info(conn, info)
+    remove_stale_files(db_path, info.file_name, previous)
+    return info
+
+
+def open_store(
+    conn: sqlite3.Connection,
+    db_path: Path,
+    model: str,
+    dim: int,
+    dtype: str,
+) -> StoreInfo:
+    info = read_store_info(conn)
+    if info is None or (info.model, info.dim, info.dtype) != (model, dim, dtype):
+        return reset_store(conn, db_path, model, dim, dtype)
+    path = db_path.parent / info.file_name
+    expected = info.row_count * info.dim * np.dtype(info.dtype).itemsize
+    size = path.stat().st_size if path.exists() else -1
+    if size < expected:
+        return reset_store(conn, db_path, model, dim, dtype)
+    if size > expected:
+        # Rows appended by an interrupted run were never indexed.
+        os.truncate(path, expected)
+    return info
+
+
+def append_rows(
+    conn: sqlite3.Connection,
+    db_path: Path,
+    info: StoreInfo,
+    rows: list[tuple[str, int, int, bytes, int]],
+) -> StoreInfo:
+    block = np.frombuffer(bytearray().join(vector for _, _, _, vector, _ in rows), dtype=np.float32)
+    block = block.reshape(len(rows), info.dim).astype(info.dtype)
+    with open(db_path.parent / info.file_name, "ab") as handle:
+        handle.write(block.tobytes())
+        handle.flush()
+        os.fsync(handle.fileno())
+    updated = StoreInfo(
+        info.model,
+        info.dtype,
+        info.dim,
+        info.file_name,
+        info.row_count + len(rows),
+        info.generation,
+    )
+    with conn:
+        conn.executemany(
+            """
+            INSERT INTO matrix_row(input_path, row, mtime_ns, size_bytes, valid)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(input_path) DO UPDATE SET
+                row = excluded.row,
+                mtime_ns = excluded.mtime_ns,
+                size_bytes = excluded.size_bytes,
+                valid = excluded.valid
+            """,
+            [
+                (input_path, info.row_count + offset, mtime_ns, size_bytes, valid)
+                for offset, (input_path, mtime_ns, size_bytes, _, valid) in enumerate(rows)
+            ],
+        )
+        write_store_info(conn, updated)
+    return updated
+
+
+def compact_store(conn: sqlite3.Connection, db_path: Path, info: StoreInfo) -> StoreInfo:
+    live = conn.execute("SELECT input_path, row FROM matrix_row ORDER BY row").fetchall()
+    source = open_memmap(db_path.parent, info)
+    generation = info.generation + 1
+    compacted = StoreInfo(
+        info.model,
+        info.dtype,
+        info.dim,
+        matrix_file_name(db_path, info.dtype, generation),
+        len(live),
+        generation,
+    )
+    target = db_path.parent / compacted.file_name
+    with open(target, "wb") as handle:
+        for start in range(0, len(live), APPEND_CHUNK_ROWS):
+            rows = np.fromiter(
+                (row for _, row in live[start : start + APPEND_CHUNK_ROWS]),
+                dtype=np.int64,
+            )
+            handle.write(np.ascontiguousarray(source[rows]).tobytes())
+        handle.flush()
+        os.fsync(handle.fileno())
+    del source
+    with conn:
+        conn.executemany(
+            "UPDATE matrix_row SET row = ? WHERE input_path = ?",
+            [(new_row, input_path) for new_row, (input_path, _) in enumerate(live)],
+        )
+        write_store_info(conn, compacted)
+    # Readers still holding the previous generation keep their mapping after the unlink.
+    remove_stale_files(db_path, compacted.file_name, info)
+    return compacted
+
+
+def sync_store(
+    conn: sqlite3.Connection,
+    db_path: Path,
+    model: str,
+    dim: int,
+    dtype: str | None = None,
+) -> dict:
+    dtype = dtype or matrix_dtype()
+    info = open_store(conn, db_path, model, dim, dtype)
+    with conn:
+        removed_rows = conn.execute(
+            """
+            DELETE FROM matrix_row
+            WHERE NOT EXISTS (
+                SELECT 1 FROM clip_embedding
+                WHERE clip_embedding.input_path = matrix_row.input_path
+                  AND clip_embedding.model = ?
+            )
+            """,
+            (model,),
+        ).rowcount
+    pending = [
+        input_path
+        for (input_path,) in conn.execute(
+            """
+            SELECT clip_embedding.input_path
+            FROM clip_embedding
+            LEFT JOIN matrix_row ON matrix_row.input_path = clip_embedding.input_path
+            WHERE clip_embedding.model = :model
+              AND clip_embedding.dim = :dim
+              AND length(clip_embedding.vector) = :dim * 4
+              AND (
+                  matrix_row.input_path IS NULL
+                  OR matrix_row.mtime_ns != clip_embedding.mtime_ns
+                  OR matrix_row.size_bytes != clip_embedding.size_bytes
+                  OR matrix_row.valid != clip_embedding.valid
+              )
+            """,
+            {"model": model, "dim": dim},
+        )
+    ]
+    for start in range(0, len(pending), APPEND_CHUNK_ROWS):
+        chunk = pending[start : start + APPEND_CHUNK_ROWS]
+        placeholders = ", ".join("?" for _ in chunk)
+        rows = conn.execute(
+            f"""
+            SELECT input_path, mtime_ns, size_bytes, vector, valid
+            FROM clip_embedding WHERE input_path IN ({placeholders})
+            """,
+            chunk,
+        ).fetchall()
+        info = append_rows(conn, db_path, info, rows)
+    if removed_rows or pending:
+        # Removals leave the generation and row count alone, so readers key caches on this too.
+        with conn:
+            conn.execute("UPDATE matrix_store SET revision = revision + 1 WHERE id = 1")
+
+    (live_rows,) = conn.execute("SELECT COUNT(*) FROM matrix_row").fetchone()
+    dead_rows = info.row_count - live_rows
+    compacted = dead_rows >= max(COMPACT_MIN_DEAD_ROWS, info.row_count * COMPACT_DEAD_FRACTION)
+    if compacted:
+        info = compact_store(conn, db_path, info)
+    return {
+        "appended_rows": len(pending),
+        "removed_rows": int(removed_rows),
+        "live_rows": int(live_rows),
+        "dead_rows": 0 if compacted else int(dead_rows),
+        "compacted": compacted,
+        "generation": info.generation,
+        "dtype": info.dtype,
+    }
+
+
+def open_memmap(directory: Path, info: StoreInfo) -> np.ndarray:
+    if info.row_count == 0:
+        return np.zeros((0, info.dim), dtype=info.dtype)
+    return np.memmap(
+        directory / info.file_name,
+        dtype=info.dtype,
+        mode="r",
+        shape=(info.row_count, info.dim),
+    )
+
+
+def open_matrix(db_path: Path, paths: list[str] | None = None) -> MatrixView | None:
+    conn = sqlite3.connect(f"{db_path.resolve().as_uri()}?mode=ro", uri=True)
+    try:
+        info = read_store_info(conn)
+        if info is None:
+            return None
+        if paths is None:
+            index = conn.execute(
+                "SELECT input_path, row, valid FROM matrix_row ORDER BY row"
+            ).fetchall()
+        else:
+            known = {
+                input_path: (row, valid)
+                for input_path, row, valid in conn.execute(
+                    "SELECT input_path, row, valid FROM matrix_row"
+                )
+            }
+            missing = next((path for path in paths if path not in known), None)
+            if missing is not None:
+                raise ValueError(f"Missing CLIP vector for {missing}")
+            index = [(path, *known[path]) for path in paths]
+    finally:
+        conn.close()
+    return MatrixView(
+        model=info.model,
+        generation=info.generation,
+        paths=[input_path for input_path, _, _ in index],
+        rows=np.fromiter((row for _, row, _ in index), dtype=np.int64, count=len(index)),
+        valid=np.fromiter((valid for _, _, valid in index), dtype=bool, count=len(index)),
+        matrix=open_memmap(db_path.parent, info),
+    )
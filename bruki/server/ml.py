@@ -1,158 +1,917 @@
+import argparse
+import ctypes
+import ctypes.util
+import difflib
 import hashlib
 import importlib
+import itertools
 import json
+import multiprocessing
+import multiprocessing.util
+import os
 import sqlite3
 import threading
 import time
-from collections import Counter
-from collections.abc import Callable
+from abc import ABC, abstractmethod
+from collections import Counter, deque
+from collections.abc import Callable, Iterator
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from dataclasses import asdict, dataclass, replace
 from pathlib import Path
 
 import numpy as np
 
-from bruki.config import load_config, resolve_paths
+from bruki import inventory
+from bruki.config import load_config
+from bruki.server import ann, database, dedupe, jobs
+from bruki.server import matrix as matrix_store
+from bruki.server import status as status_store
 
 MODEL_NAME = "openai/clip-vit-base-patch32"
 CLIP_EMBED_DIM = 512
+DEFAULT_BATCH_SIZE = 24
+MIN_IMAGE_SIZE = 10
+DECODE_SIZE = 448
+MAX_DECODE_PIXELS = 64_000_000
+DECODE_PREFETCH_BATCHES = 2
+EMBED_COMMIT_EVERY = 512
+PIPELINE_STAGES = ("embedding", "clustering", "ocr", "duplicates")
+DIGEST_CHUNK_BYTES = 64 * 1024
+DIGEST_WORKERS = 8
+MAX_BATCH_SIZE = 128
+BATCH_BYTES_PER_IMAGE = 48 * 1024 * 1024
+BATCH_MEMORY_FRACTION = 0.25
+OCR_COMMIT_EVERY = 64
+OCR_COMMIT_SECONDS = 10.0
+OCR_TASKS_PER_WORKER = 4
+OCR_ENGINE_ENV = "TAGGER_OCR_ENGINE"
+OCR_LANG = "eng"
+OCR_DEFAULT_DPI = 70
+OCR_PROBE_WIDTH = 640
+OCR_EDGE_STEP = 24
+OCR_TEXT_ROW_ACTIVITY = 0.03
+OCR_MIN_TEXT_ROWS = 0.005
+OCR_TARGET_DPI = 300
+OCR_MAX_WIDTH = 1600
+OCR_TILE_HEIGHT = 2048
+OCR_TILE_SEARCH = 96
+OCR_FTS_OPTIMIZE_ROWS = 5000
+# REPLACE deletes without firing delete triggers, which would leave stale FTS rows behind.
+# The row remembers which content its text was read from, so an in-place edit is noticed.
+OCR_DOC_UPSERT = """
+    INSERT INTO ocr_doc(input_path, text, ocr_mode, content_digest)
+    VALUES (?1, ?2, ?3, (SELECT content_digest FROM file_digest WHERE input_path = ?1))
+    ON CONFLICT(input_path) DO UPDATE SET
+        text = excluded.text,
+        ocr_mode = excluded.ocr_mode,
+        content_digest = excluded.content_digest
+"""
+CORES_ENV = "TAGGER_CORES"
+TORCH_SHARE_ENV = "TAGGER_TORCH_SHARE"
+DEFAULT_TORCH_SHARE = 0.25
+PIPELINE_ENV = "TAGGER_PIPELINE"
+PIPELINE_MODES = ("concurrent", "sequential")
+SHARED_OCR_TASKS_PER_WORKER = 2
+# Larger decoded images go to the OCR workers as paths; pickling their pixels costs more than
+# decoding the file again in the worker.
+SHARED_OCR_MAX_PIXEL_BYTES = 4 * 1024 * 1024
+CLUSTER_DRIFT_RATIO = 1.2
+CLUSTER_CHURN_FRACTION = 0.5
+CLUSTER_K_TOLERANCE = 0.25
+CLUSTER_EXEMPLARS = 8
+CLUSTER_TOP_TAGS = 5
 
 _JOB_LOCK = threading.Lock()
 _JOB_THREAD: threading.Thread | None = None
+_ROOTS_LOCK = threading.Lock()
+_ROOTS_CACHE: dict[Path, tuple[int, list[str]]] = {}
+_RUN_LOCK = threading.Lock()
 
 
 def now_iso() -> str:
     return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
 
 
-def migrate_clip_embedding_schema(conn: sqlite3.Connection) -> None:
-    columns = {row[1] for row in conn.execute("PRAGMA table_info(clip_embedding)").fetchall()}
-    if "valid" not in columns:
+def init_db(db_path: Path) -> None:
+    database.ensure_schema(db_path)
+
+
+def read_status(db_path: Path, default: dict | None = None) -> dict:
+    _, payload = status_store.status_bus(db_path).snapshot()
+    if not payload:
+        return {} if default is None else default
+    return payload
+
+
+def update_status(db_path: Path, **fields: object) -> dict:
+    # Progress ticks only reach the in-memory bus; ml_status is written at most every few
+    # seconds unless a stage, signature or error changes.
+    return status_store.status_bus(db_path).publish({**fields, "updated_at": now_iso()})
+
+
+def cached_screenshot_roots(config_path: Path) -> list[str]:
+    try:
+        mtime_ns = config_path.stat().st_mtime_ns
+    except OSError:
+        mtime_ns = 0
+    with _ROOTS_LOCK:
+        cached = _ROOTS_CACHE.get(config_path)
+        if cached is None or cached[0] != mtime_ns:
+            cached = (mtime_ns, screenshot_roots(config_path))
+            _ROOTS_CACHE[config_path] = cached
+        return cached[1]
+
+
+def screenshot_roots(config_path: Path) -> list[str]:
+    config = load_config(str(config_path))
+    roots = {
+        str(Path(source_spec.path).expanduser().resolve())
+        for series_name, series_config in config.data.items()
+        if series_name.startswith("screenshot")
+        for source_spec in series_config.sources.values()
+    }
+    return sorted(roots)
+
+
+def screenshot_sources(
+    config_path: Path,
+    db_path: Path,
+    dirs: set[str] | None = None,
+) -> list[inventory.SourceScan]:
+    config = load_config(str(config_path))
+    return inventory.scan_sources(config, db_path, prefix="screenshot", dirs=dirs)
+
+
+def describe_sources(sources: list[inventory.SourceScan]) -> tuple[list[dict], list[str]]:
+    source_stats = [
+        {
+            "series": source.series,
+            "source": source.source,
+            "root": str(source.root.resolve()),
+            "count": source.file_count,
+        }
+        for source in sources
+    ]
+    return source_stats, sorted({stats["root"] for stats in source_stats})
+
+
+def resolve_screenshot_records(
+    db_path: Path,
+    sources: list[inventory.SourceScan],
+) -> tuple[list[dict], list[dict], list[str]]:
+    # Overlapping sources can list a file twice. Every row must be a distinct path, because the
+    # embedding mask returned for these paths is indexed by row, so the first source wins.
+    rows: dict[str, dict] = {}
+    for source in sources:
+        for path in inventory.read_paths(db_path, source):
+            rows.setdefault(
+                str(path),
+                {
+                    "series": source.series,
+                    "source": source.source,
+                    "input_path": str(path),
+                },
+            )
+    return list(rows.values()), *describe_sources(sources)
+
+
+def records_signature(sources: list[inventory.SourceScan]) -> str:
+    joined = "\n".join(
+        f"{source.series}\t{source.source}\t{source.root}\t{source.generation}"
+        for source in sources
+    )
+    return hashlib.sha1(joined.encode("utf-8")).hexdigest()
+
+
+def stat_paths(paths: list[str]) -> dict[str, tuple[int, int]]:
+    path_stats: dict[str, tuple[int, int]] = {}
+    for path in paths:
         try:
-            conn.execute("ALTER TABLE clip_embedding ADD COLUMN valid INTEGER NOT NULL DEFAULT 1")
-        except sqlite3.OperationalError as exc:
-            if "duplicate column name: valid" not in str(exc).lower():
-                raise
+            stat = Path(path).stat()
+            path_stats[path] = (int(stat.st_mtime_ns), int(stat.st_size))
+        except OSError:
+            path_stats[path] = (0, 0)
+    return path_stats
 
 
-def init_db(db_path: Path) -> None:
-    db_path.parent.mkdir(parents=True, exist_ok=True)
-    conn = sqlite3.connect(db_path)
+def partial_digest(path: str, size_bytes: int) -> str:
+    hasher = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as handle:
+        if size_bytes <= 2 * DIGEST_CHUNK_BYTES:
+            hasher.update(handle.read())
+            return "f" + hasher.hexdigest()
+        hasher.update(size_bytes.to_bytes(8, "little"))
+        hasher.update(handle.read(DIGEST_CHUNK_BYTES))
+        handle.seek(-DIGEST_CHUNK_BYTES, os.SEEK_END)
+        hasher.update(handle.read(DIGEST_CHUNK_BYTES))
+    return "p" + hasher.hexdigest()
+
+
+def full_digest(path: str) -> str:
+    hasher = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as handle:
+        for chunk in iter(lambda: handle.read(1024 * 1024), b""):
+            hasher.update(chunk)
+    return "f" + hasher.hexdigest()
+
+
+def _try_partial_digest(item: tuple[str, int]) -> str | None:
+    try:
+        return partial_digest(*item)
+    except OSError:
+        return None
+
+
+def load_temp_paths(conn: sqlite3.Connection, table: str, paths: list[str]) -> None:
+    conn.execute(f"CREATE TEMP TABLE IF NOT EXISTS {table}(input_path TEXT PRIMARY KEY)")
+    conn.execute(f"DELETE FROM {table}")
+    conn.executemany(
+        f"INSERT OR IGNORE INTO {table}(input_path) VALUES (?)",
+        [(input_path,) for input_path in paths],
+    )
+
+
+def update_file_digests(
+    conn: sqlite3.Connection,
+    paths: list[str],
+    path_stats: dict[str, tuple[int, int]],
+) -> dict:
+    known = {
+        input_path: (int(mtime_ns), int(size_bytes))
+        for input_path, mtime_ns, size_bytes in conn.execute(
+            "SELECT input_path, mtime_ns, size_bytes FROM file_digest"
+        )
+    }
+    stale = [
+        path
+        for path in paths
+        if path_stats.get(path, (0, 0)) != (0, 0) and known.get(path) != path_stats[path]
+    ]
+    with ThreadPoolExecutor(max_workers=DIGEST_WORKERS, thread_name_prefix="digest") as pool:
+        digests = list(
+            pool.map(_try_partial_digest, [(path, path_stats[path][1]) for path in stale])
+        )
+    rows = [
+        (path, *path_stats[path], digest, digest)
+        for path, digest in zip(stale, digests, strict=True)
+        if digest is not None
+    ]
     with conn:
-        conn.executescript(
-            """
-            CREATE TABLE IF NOT EXISTS ml_status (
-                id INTEGER PRIMARY KEY CHECK(id = 1),
-                payload TEXT NOT NULL
-            );
-            CREATE TABLE IF NOT EXISTS clip_item (
-                input_path TEXT PRIMARY KEY,
-                series TEXT NOT NULL,
-                source TEXT NOT NULL,
-                cluster INTEGER NOT NULL
-            );
-            CREATE TABLE IF NOT EXISTS clip_cluster (
-                cluster_id INTEGER PRIMARY KEY,
-                count INTEGER NOT NULL
-            );
-            CREATE TABLE IF NOT EXISTS clip_embedding (
-                input_path TEXT PRIMARY KEY,
-                model TEXT NOT NULL,
-                mtime_ns INTEGER NOT NULL,
-                size_bytes INTEGER NOT NULL,
-                dim INTEGER NOT NULL,
-                vector BLOB NOT NULL,
-                valid INTEGER NOT NULL DEFAULT 1
-            );
-            CREATE TABLE IF NOT EXISTS ocr_doc (
-                input_path TEXT PRIMARY KEY,
-                text TEXT NOT NULL
-            );
+        conn.executemany(
             """
+            INSERT INTO file_digest(
+                input_path, mtime_ns, size_bytes, partial_digest, content_digest
+            )
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(input_path) DO UPDATE SET
+                mtime_ns = excluded.mtime_ns,
+                size_bytes = excluded.size_bytes,
+                partial_digest = excluded.partial_digest,
+                content_digest = excluded.content_digest
+            """,
+            rows,
         )
-        migrate_clip_embedding_schema(conn)
-    conn.close()
 
+    # Partial digests shared by two current files are settled with a full-content hash.
+    load_temp_paths(conn, "digest_path", paths)
+    collisions = conn.execute(
+        """
+        SELECT file_digest.input_path, file_digest.partial_digest
+        FROM file_digest JOIN digest_path USING(input_path)
+        WHERE file_digest.content_digest LIKE 'p%'
+          AND file_digest.partial_digest IN (
+            SELECT partial_digest FROM file_digest JOIN digest_path USING(input_path)
+            WHERE partial_digest LIKE 'p%'
+            GROUP BY partial_digest HAVING COUNT(*) > 1
+          )
+        """
+    ).fetchall()
+    rehashed = {row[0] for row in rows}
+    promoted = 0
+    with conn:
+        for input_path, partial in collisions:
+            try:
+                content = full_digest(input_path)
+            except OSError:
+                continue
+            if input_path not in rehashed:
+                for table, columns in (
+                    ("clip_feature", "model, dim, vector, valid"),
+                    ("ocr_feature", "text"),
+                ):
+                    conn.execute(
+                        f"""
+                        INSERT OR IGNORE INTO {table}(content_digest, {columns})
+                        SELECT ?, {columns} FROM {table} WHERE content_digest = ?
+                        """,
+                        (content, partial),
+                    )
+            conn.execute(
+                "UPDATE file_digest SET content_digest = ? WHERE input_path = ?",
+                (content, input_path),
+            )
+            promoted += 1
+
+    total, distinct = conn.execute(
+        """
+        SELECT COUNT(*), COUNT(DISTINCT content_digest)
+        FROM file_digest JOIN digest_path USING(input_path)
+        """
+    ).fetchone()
+    return {
+        "hashed_files": len(rows),
+        "full_hashed_files": promoted,
+        "duplicate_files": int(total) - int(distinct),
+    }
 
-def read_status(db_path: Path, default: dict | None = None) -> dict:
-    init_db(db_path)
-    conn = sqlite3.connect(db_path)
-    row = conn.execute("SELECT payload FROM ml_status WHERE id = 1").fetchone()
-    conn.close()
-    if row is None:
-        return {} if default is None else default
-    return json.loads(row[0])
 
+def content_digests(conn: sqlite3.Connection, paths: list[str]) -> dict[str, str]:
+    load_temp_paths(conn, "digest_lookup", paths)
+    return dict(
+        conn.execute(
+            """
+            SELECT input_path, content_digest
+            FROM file_digest JOIN digest_lookup USING(input_path)
+            """
+        ).fetchall()
+    )
 
-def update_status(db_path: Path, **fields: object) -> dict:
-    payload = read_status(db_path, default={})
-    payload.update(fields)
-    payload["updated_at"] = now_iso()
-    init_db(db_path)
-    conn = sqlite3.connect(db_path)
+
+def split_duplicates(paths: list[str], digests: dict[str, str]) -> tuple[list[str], list[str]]:
+    seen: set[str] = set()
+    unique: list[str] = []
+    duplicates: list[str] = []
+    for path in paths:
+        digest = digests.get(path)
+        if digest is None:
+            unique.append(path)
+        elif digest in seen:
+            duplicates.append(path)
+        else:
+            seen.add(digest)
+            unique.append(path)
+    return unique, duplicates
+
+
+def prune_file_digests(conn: sqlite3.Connection, paths: list[str]) -> None:
+    load_temp_paths(conn, "digest_path", paths)
     with conn:
         conn.execute(
             """
-            INSERT INTO ml_status(id, payload) VALUES (1, ?)
-            ON CONFLICT(id) DO UPDATE SET payload = excluded.payload
-            """,
-            (json.dumps(payload, sort_keys=True),),
+            DELETE FROM file_digest
+            WHERE input_path NOT IN (SELECT input_path FROM digest_path)
+            """
         )
-    conn.close()
-    return payload
+        for table in ("clip_feature", "ocr_feature"):
+            conn.execute(
+                f"""
+                DELETE FROM {table}
+                WHERE content_digest NOT IN (SELECT content_digest FROM file_digest)
+                """
+            )
 
 
-def resolve_screenshot_records(config_path: Path) -> tuple[list[dict], list[dict], list[str]]:
-    config = load_config(str(config_path))
-    rows: list[dict] = []
-    source_stats: list[dict] = []
-    source_roots: list[str] = []
-    for series_name, source_name, image_paths in resolve_paths(config, prefix="screenshot"):
-        source_spec = config.data[series_name].sources[source_name]
-        root = Path(source_spec.path).expanduser().resolve()
-        source_roots.append(str(root))
-        source_stats.append(
-            {
-                "series": series_name,
-                "source": source_name,
-                "root": str(root),
-                "count": len(image_paths),
-            }
+def reuse_clip_features(
+    conn: sqlite3.Connection,
+    paths: list[str],
+    path_stats: dict[str, tuple[int, int]],
+    model_key: str,
+) -> set[str]:
+    load_temp_paths(conn, "reuse_path", paths)
+    with conn:
+        conn.execute(
+            """
+            INSERT OR IGNORE INTO clip_feature(content_digest, model, dim, vector, valid, norm)
+            SELECT file_digest.content_digest, clip_embedding.model, clip_embedding.dim,
+                   clip_embedding.vector, clip_embedding.valid, clip_embedding.norm
+            FROM clip_embedding JOIN file_digest USING(input_path)
+            WHERE clip_embedding.mtime_ns = file_digest.mtime_ns
+              AND clip_embedding.size_bytes = file_digest.size_bytes
+            """
         )
-        for path in image_paths:
-            rows.append(
-                {
-                    "series": series_name,
-                    "source": source_name,
-                    "input_path": str(path),
-                }
-            )
-    return rows, source_stats, sorted(set(source_roots))
+    found = conn.execute(
+        """
+        SELECT reuse_path.input_path, clip_feature.dim, clip_feature.vector,
+               clip_feature.valid, clip_feature.norm
+        FROM reuse_path
+        JOIN file_digest ON file_digest.input_path = reuse_path.input_path
+        JOIN clip_feature ON clip_feature.content_digest = file_digest.content_digest
+        WHERE clip_feature.model = ?
+        """,
+        (model_key,),
+    ).fetchall()
+    rows = [
+        (input_path, model_key, *path_stats[input_path], dim, vector, valid, norm)
+        for input_path, dim, vector, valid, norm in found
+    ]
+    with conn:
+        upsert_embedding_rows(conn, rows)
+    return {row[0] for row in rows}
+
+
+def reuse_ocr_features(conn: sqlite3.Connection, paths: list[str]) -> set[str]:
+    load_temp_paths(conn, "reuse_path", paths)
+    found = conn.execute(
+        """
+        SELECT reuse_path.input_path, ocr_feature.text, ocr_feature.ocr_mode
+        FROM reuse_path
+        JOIN file_digest ON file_digest.input_path = reuse_path.input_path
+        JOIN ocr_feature ON ocr_feature.content_digest = file_digest.content_digest
+        """
+    ).fetchall()
+    with conn:
+        conn.executemany(
+            OCR_DOC_UPSERT,
+            found,
+        )
+    return {input_path for input_path, _, _ in found}
 
 
-def records_signature(rows: list[dict]) -> str:
-    values: list[str] = []
-    for row in rows:
-        input_path = row["input_path"]
+class OcrEngine(ABC):
+    name = "base"
+
+    @abstractmethod
+    def recognize(self, image, psm: int) -> str: ...
+
+    def close(self) -> None:
+        pass
+
+
+class PytesseractEngine(OcrEngine):
+    name = "pytesseract"
+
+    def __init__(self, oem: int = 3) -> None:
+        self.pytesseract = importlib.import_module("pytesseract")
+        self.oem = oem
+
+    def recognize(self, image, psm: int) -> str:
+        return self.pytesseract.image_to_string(
+            image,
+            lang=OCR_LANG,
+            config=f"--psm {psm} --oem {self.oem}",
+        )
+
+
+class TesseractApiEngine(OcrEngine):
+    name = "capi"
+
+    def __init__(self, oem: int = 3) -> None:
+        library = ctypes.util.find_library("tesseract")
+        if library is None:
+            raise OSError("libtesseract not found")
+        lib = ctypes.CDLL(library)
+        lib.TessBaseAPICreate.restype = ctypes.c_void_p
+        lib.TessBaseAPIInit2.argtypes = [
+            ctypes.c_void_p,
+            ctypes.c_char_p,
+            ctypes.c_char_p,
+            ctypes.c_int,
+        ]
+        lib.TessBaseAPIInit2.restype = ctypes.c_int
+        lib.TessBaseAPISetPageSegMode.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        lib.TessBaseAPISetImage.argtypes = [
+            ctypes.c_void_p,
+            ctypes.c_char_p,
+            ctypes.c_int,
+            ctypes.c_int,
+            ctypes.c_int,
+            ctypes.c_int,
+        ]
+        lib.TessBaseAPISetSourceResolution.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        lib.TessBaseAPIGetUTF8Text.argtypes = [ctypes.c_void_p]
+        lib.TessBaseAPIGetUTF8Text.restype = ctypes.c_void_p
+        lib.TessDeleteText.argtypes = [ctypes.c_void_p]
+        lib.TessBaseAPIClear.argtypes = [ctypes.c_void_p]
+        lib.TessBaseAPIEnd.argtypes = [ctypes.c_void_p]
+        lib.TessBaseAPIDelete.argtypes = [ctypes.c_void_p]
+        self.lib = lib
+        self.handle = lib.TessBaseAPICreate()
+        # A NULL datapath lets tesseract resolve TESSDATA_PREFIX the way the CLI does.
+        if lib.TessBaseAPIInit2(self.handle, None, OCR_LANG.encode("ascii"), oem) != 0:
+            lib.TessBaseAPIDelete(self.handle)
+            self.handle = None
+            raise OSError(f"tesseract could not load {OCR_LANG} traineddata")
+
+    def recognize(self, image, psm: int) -> str:
+        width, height = image.size
+        pixels = image.tobytes()
+        dpi = image.info.get("dpi", (OCR_DEFAULT_DPI,))[0]
+        self.lib.TessBaseAPISetPageSegMode(self.handle, psm)
+        self.lib.TessBaseAPISetImage(self.handle, pixels, width, height, 3, 3 * width)
+        self.lib.TessBaseAPISetSourceResolution(self.handle, int(dpi) or OCR_DEFAULT_DPI)
+        text = self.lib.TessBaseAPIGetUTF8Text(self.handle)
         try:
-            stat = Path(input_path).stat()
-            values.append(f"{input_path}\t{int(stat.st_mtime_ns)}\t{int(stat.st_size)}")
-        except OSError:
-            values.append(f"{input_path}\t0\t0")
-    joined = "\n".join(sorted(values))
-    return hashlib.sha1(joined.encode("utf-8")).hexdigest()
+            return ctypes.string_at(text).decode("utf-8", errors="replace") if text else ""
+        finally:
+            if text:
+                self.lib.TessDeleteText(text)
+            self.lib.TessBaseAPIClear(self.handle)
+
+    def close(self) -> None:
+        if self.handle:
+            self.lib.TessBaseAPIEnd(self.handle)
+            self.lib.TessBaseAPIDelete(self.handle)
+            self.handle = None
+
+
+_OCR_ENGINES: dict[str, type[OcrEngine]] = {
+    PytesseractEngine.name: PytesseractEngine,
+    TesseractApiEngine.name: TesseractApiEngine,
+}
+_OCR_ENGINE_NAME = ""
+_OCR_TILE_THREADS = 1
+_OCR_TILE_POOL: ThreadPoolExecutor | None = None
+_OCR_LOCAL = threading.local()
+_OCR_OPEN_ENGINES: list[OcrEngine] = []
+_OCR_ENGINES_LOCK = threading.Lock()
+
+
+def ocr_engine_name() -> str:
+    value = os.environ.get(OCR_ENGINE_ENV, "auto").strip().lower() or "auto"
+    if value != "auto" and value not in _OCR_ENGINES:
+        raise ValueError(f"{OCR_ENGINE_ENV} must be auto or one of {', '.join(_OCR_ENGINES)}")
+    return value
+
+
+def load_ocr_engine(name: str = "auto") -> OcrEngine:
+    if name != "auto":
+        return _OCR_ENGINES[name]()
+    try:
+        return TesseractApiEngine()
+    except (OSError, AttributeError):
+        return PytesseractEngine()
+
+
+def configure_ocr_worker(engine: str, tile_threads: int) -> None:
+    global _OCR_ENGINE_NAME, _OCR_TILE_THREADS
+    if (engine, max(1, tile_threads)) != (_OCR_ENGINE_NAME, _OCR_TILE_THREADS):
+        close_ocr_worker()
+    _OCR_ENGINE_NAME = engine
+    _OCR_TILE_THREADS = max(1, tile_threads)
+
+
+def worker_ocr_engine() -> OcrEngine:
+    # Tesseract handles are not shareable, so every thread (tile workers included) owns one.
+    engine = getattr(_OCR_LOCAL, "engine", None)
+    if engine is None:
+        engine = load_ocr_engine(_OCR_ENGINE_NAME or ocr_engine_name())
+        _OCR_LOCAL.engine = engine
+        with _OCR_ENGINES_LOCK:
+            _OCR_OPEN_ENGINES.append(engine)
+    return engine
+
+
+def tile_pool() -> ThreadPoolExecutor:
+    global _OCR_TILE_POOL
+    if _OCR_TILE_POOL is None:
+        _OCR_TILE_POOL = ThreadPoolExecutor(
+            max_workers=_OCR_TILE_THREADS,
+            thread_name_prefix="ocr-tile",
+        )
+    return _OCR_TILE_POOL
+
 
+def close_ocr_worker() -> None:
+    global _OCR_TILE_POOL, _OCR_LOCAL
+    if _OCR_TILE_POOL is not None:
+        _OCR_TILE_POOL.shutdown(wait=True)
+        _OCR_TILE_POOL = None
+    with _OCR_ENGINES_LOCK:
+        engines = list(_OCR_OPEN_ENGINES)
+        _OCR_OPEN_ENGINES.clear()
+    # A fresh thread-local drops every thread's reference to the closed engines.
+    _OCR_LOCAL = threading.local()
+    for engine in engines:
+        engine.close()
 
-def ocr_image(path: Path, psm: int = 6, oem: int = 3) -> str:
+
+def ocr_image(path: Path, psm: int = 6, engine: OcrEngine | None = None) -> str:
     from PIL import Image
 
-    pytesseract = importlib.import_module("pytesseract")
+    engine = engine or worker_ocr_engine()
     with Image.open(path) as image:
         if image.size[0] < 10 or image.size[1] < 10:
             return ""
-        return pytesseract.image_to_string(
-            image.convert("RGB"),
-            lang="eng",
-            config=f"--psm {psm} --oem {oem}",
+        return engine.recognize(image.convert("RGB"), psm)
+
+
+def row_text_activity(image) -> np.ndarray:
+    factor = max(1, image.width // OCR_PROBE_WIDTH)
+    probe = np.asarray(image.reduce(factor).convert("L"), dtype=np.int16)
+    steps = np.abs(np.diff(probe, axis=1)) > OCR_EDGE_STEP
+    return steps.mean(axis=1)
+
+
+def tile_bounds(height: int, row_activity: np.ndarray) -> list[tuple[int, int]]:
+    # Cut tall pages at the quietest row near each nominal boundary, i.e. between text lines.
+    ratio = height / max(len(row_activity), 1)
+    cuts = [0]
+    while height - cuts[-1] > OCR_TILE_HEIGHT * 1.25:
+        target = cuts[-1] + OCR_TILE_HEIGHT
+        low = max(int(cuts[-1] / ratio) + 1, int((target - OCR_TILE_SEARCH) / ratio))
+        high = min(len(row_activity), int((target + OCR_TILE_SEARCH) / ratio) + 1)
+        if high > low:
+            cut = int(round((low + int(np.argmin(row_activity[low:high]))) * ratio))
+        else:
+            cut = target
+        cuts.append(max(cut, cuts[-1] + 1))
+    cuts.append(height)
+    return list(zip(cuts[:-1], cuts[1:], strict=True))
+
+
+def ocr_adaptive(path: Path, psm: int = 6) -> tuple[str, str]:
+    from PIL import Image
+
+    with Image.open(path) as source:
+        if source.size[0] < MIN_IMAGE_SIZE or source.size[1] < MIN_IMAGE_SIZE:
+            return "", "empty"
+        dpi = float(source.info.get("dpi", (0,))[0] or 0)
+        image = source.convert("RGB")
+    return ocr_decoded(image, dpi, psm)
+
+
+def ocr_decoded(image, dpi: float, psm: int = 6) -> tuple[str, str]:
+    from PIL import Image
+
+    row_activity = row_text_activity(image)
+    if (row_activity > OCR_TEXT_ROW_ACTIVITY).mean() < OCR_MIN_TEXT_ROWS:
+        return "", "skipped"
+
+    modes: list[str] = []
+    scale = min(1.0, OCR_MAX_WIDTH / image.width)
+    if dpi > OCR_TARGET_DPI:
+        scale = min(scale, OCR_TARGET_DPI / dpi)
+    if scale < 1.0:
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        image = image.resize(size, Image.Resampling.LANCZOS)
+        if dpi:
+            image.info["dpi"] = (dpi * scale, dpi * scale)
+        modes.append("scaled")
+
+    tiles = tile_bounds(image.height, row_activity)
+    if len(tiles) == 1:
+        return worker_ocr_engine().recognize(image, psm), "+".join(modes) or "full"
+    crops = [image.crop((0, top, image.width, bottom)) for top, bottom in tiles]
+    for crop in crops:
+        crop.info = dict(image.info)
+    if _OCR_TILE_THREADS > 1:
+        texts = tile_pool().map(lambda crop: worker_ocr_engine().recognize(crop, psm), crops)
+    else:
+        engine = worker_ocr_engine()
+        texts = [engine.recognize(crop, psm) for crop in crops]
+    modes.append("tiled")
+    return "\n".join(texts), "+".join(modes)
+
+
+def ocr_benchmark(paths: list[str], engines: list[str], sample_size: int = 64) -> dict:
+    if len(paths) > sample_size:
+        rng = np.random.default_rng(0)
+        paths = sorted(rng.choice(paths, size=sample_size, replace=False).tolist())
+    results: dict[str, dict] = {}
+    texts: dict[str, list[str]] = {}
+    for name in engines:
+        started = time.perf_counter()
+        engine = load_ocr_engine(name)
+        load_seconds = time.perf_counter() - started
+        outputs: list[str] = []
+        started = time.perf_counter()
+        for input_path in paths:
+            try:
+                outputs.append(ocr_image(Path(input_path), engine=engine).lower())
+            except OSError:
+                outputs.append("")
+        elapsed = time.perf_counter() - started
+        engine.close()
+        texts[name] = outputs
+        results[name] = {
+            "images": len(paths),
+            "load_seconds": round(load_seconds, 3),
+            "seconds": round(elapsed, 3),
+            "ms_per_image": round(1000 * elapsed / len(paths), 2) if paths else 0.0,
+            "rate_images_per_second": round(len(paths) / elapsed, 3) if elapsed > 0 else 0.0,
+        }
+    reference = texts[engines[0]]
+    for name in engines[1:]:
+        pairs = list(zip(reference, texts[name], strict=True))
+        ratios = [difflib.SequenceMatcher(None, left, right).ratio() for left, right in pairs]
+        results[name]["text_similarity"] = round(float(np.mean(ratios)), 4) if ratios else 0.0
+        results[name]["identical_texts"] = sum(left == right for left, right in pairs)
+    return results
+
+
+def available_cores() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _init_ocr_worker(engine: str, tile_threads: int) -> None:
+    # tesseract's OpenMP threads only contend with the other worker processes.
+    os.environ["OMP_THREAD_LIMIT"] = "1"
+    configure_ocr_worker(engine, tile_threads)
+    worker_ocr_engine()
+    # Pool workers leave through multiprocessing's exit hooks, which skip atexit.
+    multiprocessing.util.Finalize(None, close_ocr_worker, exitpriority=10)
+
+
+def ocr_task(input_path: str) -> tuple[str, str, bool, str]:
+    try:
+        text, mode = ocr_adaptive(Path(input_path))
+        return input_path, text.lower(), False, mode
+    except OSError:
+        return input_path, "", True, "failed"
+
+
+def ocr_pixels_task(
+    input_path: str,
+    size: tuple[int, int],
+    pixels: bytes,
+    dpi: float,
+) -> tuple[str, str, bool, str]:
+    from PIL import Image
+
+    image = Image.frombytes("RGB", size, pixels)
+    if dpi:
+        image.info["dpi"] = (dpi, dpi)
+    try:
+        text, mode = ocr_decoded(image, dpi)
+        return input_path, text.lower(), False, mode
+    except OSError:
+        return input_path, "", True, "failed"
+
+
+def iter_ocr_results(
+    paths: list[str],
+    workers: int,
+    engine: str = "auto",
+) -> Iterator[tuple[str, str, bool, str]]:
+    pool_size = min(workers, len(paths))
+    # Tiles only get their own threads from cores the worker pool leaves idle.
+    tile_threads = 1 + max(0, available_cores() - max(pool_size, 1)) // max(pool_size, 1)
+    if pool_size <= 1:
+        configure_ocr_worker(engine, tile_threads)
+        try:
+            yield from map(ocr_task, paths)
+        finally:
+            close_ocr_worker()
+        return
+    pool = ProcessPoolExecutor(
+        max_workers=pool_size,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_ocr_worker,
+        initargs=(engine, tile_threads),
+    )
+    try:
+        queued = iter(paths)
+        pending: deque[Future] = deque(
+            pool.submit(ocr_task, input_path)
+            for input_path in itertools.islice(queued, workers * OCR_TASKS_PER_WORKER)
+        )
+        while pending:
+            result = pending.popleft().result()
+            next_path = next(queued, None)
+            if next_path is not None:
+                pending.append(pool.submit(ocr_task, next_path))
+            yield result
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def write_ocr_docs(conn: sqlite3.Connection, docs: list[tuple[str, str, str]]) -> None:
+    with conn:
+        conn.executemany(
+            OCR_DOC_UPSERT,
+            docs,
+        )
+        conn.executemany(
+            """
+            INSERT OR REPLACE INTO ocr_feature(content_digest, text, ocr_mode)
+            SELECT content_digest, ?, ? FROM file_digest WHERE input_path = ?
+            """,
+            [(text, mode, input_path) for input_path, text, mode in docs],
+        )
+
+
+class OcrWriter:
+    def __init__(self, conn: sqlite3.Connection) -> None:
+        self.conn = conn
+        self.docs: list[tuple[str, str, str]] = []
+        self.new_rows = 0
+        self.failed = 0
+        self.modes: Counter[str] = Counter()
+        self.last_commit = time.time()
+
+    def add(self, result: tuple[str, str, bool, str]) -> None:
+        input_path, text, failed, mode = result
+        self.failed += int(failed)
+        self.modes[mode] += 1
+        self.docs.append((input_path, text, mode))
+        if (
+            len(self.docs) >= OCR_COMMIT_EVERY
+            or time.time() - self.last_commit >= OCR_COMMIT_SECONDS
+        ):
+            self.flush()
+
+    def flush(self) -> None:
+        write_ocr_docs(self.conn, self.docs)
+        self.new_rows += len(self.docs)
+        self.docs = []
+        self.last_commit = time.time()
+
+
+@dataclass
+class OcrPlan:
+    paths: list[str]
+    pending: list[str]
+    duplicates: list[str]
+    reused: set[str]
+    digest_stats: dict
+
+
+def plan_ocr(
+    conn: sqlite3.Connection,
+    paths: list[str],
+    digest_stats: dict | None = None,
+) -> OcrPlan:
+    if digest_stats is None:
+        digest_stats = update_file_digests(conn, paths, stat_paths(paths))
+    # Text read from older content of the same path is redone. Rows written before digests
+    # were recorded on ocr_doc cannot be checked and are kept.
+    known_paths = {
+        input_path
+        for (input_path,) in conn.execute(
+            """
+            SELECT ocr_doc.input_path
+            FROM ocr_doc LEFT JOIN file_digest USING(input_path)
+            WHERE ocr_doc.content_digest IS NULL
+               OR file_digest.content_digest IS NULL
+               OR ocr_doc.content_digest = file_digest.content_digest
+            """
         )
+    }
+    unknown = [input_path for input_path in paths if input_path not in known_paths]
+    reused = reuse_ocr_features(conn, unknown)
+    unknown = [input_path for input_path in unknown if input_path not in reused]
+    pending, duplicates = split_duplicates(unknown, content_digests(conn, unknown))
+    return OcrPlan(paths, pending, duplicates, reused, digest_stats)
+
+
+def finish_ocr(
+    conn: sqlite3.Connection,
+    plan: OcrPlan,
+    writer: OcrWriter,
+    workers: int,
+    engine: str,
+    prune: bool = True,
+) -> dict:
+    plan.reused |= reuse_ocr_features(conn, plan.duplicates)
+
+    deleted_rows = 0
+    if prune:
+        with conn:
+            conn.execute("CREATE TEMP TABLE current_path(input_path TEXT PRIMARY KEY)")
+            conn.executemany(
+                "INSERT INTO current_path(input_path) VALUES (?)",
+                [(input_path,) for input_path in plan.paths],
+            )
+            deleted_rows = conn.execute(
+                """
+                DELETE FROM ocr_doc
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM current_path
+                    WHERE current_path.input_path = ocr_doc.input_path
+                )
+                """
+            ).rowcount
+            conn.execute("DROP TABLE current_path")
+        prune_file_digests(conn, plan.paths)
+
+    if writer.new_rows + deleted_rows >= OCR_FTS_OPTIMIZE_ROWS and database.create_ocr_fts(conn):
+        with conn:
+            conn.execute("INSERT INTO ocr_fts(ocr_fts) VALUES ('optimize')")
+
+    total_rows = conn.execute("SELECT COUNT(*) FROM ocr_doc").fetchone()[0]
+    pending = len(plan.pending)
+    return {
+        "resolved_paths": len(plan.paths),
+        "new_rows": writer.new_rows,
+        "workers": workers,
+        "engine": engine,
+        "modes": dict(writer.modes),
+        "skip_ratio": round(writer.modes["skipped"] / pending, 4) if pending else 0.0,
+        "reused_rows": len(plan.reused),
+        "duplicate_files": plan.digest_stats["duplicate_files"],
+        "deleted_rows": int(deleted_rows),
+        "skipped_rows": writer.failed,
+        "total_rows": int(total_rows),
+    }
 
 
 def sync_ocr_db(
@@ -160,81 +919,61 @@ def sync_ocr_db(
     db_path: Path,
     paths: list[str] | None = None,
     progress: Callable[[int, int, float, int], None] | None = None,
+    prune: bool = True,
+    workers: int = 0,
+    engine: str = "",
 ) -> dict:
     if paths is None:
-        records, _, _ = resolve_screenshot_records(config_path)
+        sources = screenshot_sources(config_path, db_path)
+        records, _, _ = resolve_screenshot_records(db_path, sources)
         paths = list(dict.fromkeys(record["input_path"] for record in records))
     else:
         paths = list(dict.fromkeys(paths))
 
     tqdm = importlib.import_module("tqdm").tqdm
-    init_db(db_path)
-    conn = sqlite3.connect(db_path)
-    known_paths = {input_path for (input_path,) in conn.execute("SELECT input_path FROM ocr_doc")}
-    new_docs: list[tuple[str, str]] = []
-    skipped = 0
+    conn = database.connect(db_path)
+    plan = plan_ocr(conn, paths)
+    workers = workers if workers > 0 else available_cores()
+    engine = engine or ocr_engine_name()
+    writer = OcrWriter(conn)
     total = len(paths)
     status_every_images = 10
     status_every_seconds = 0.5
     last_status_time = 0.0
-    with tqdm(total=total, desc="ocr") as progress_bar:
-        for index, input_path in enumerate(paths, start=1):
-            if input_path in known_paths:
-                progress_bar.update(1)
-            else:
-                try:
-                    text = ocr_image(Path(input_path)).lower()
-                except OSError:
-                    skipped += 1
-                    text = ""
-                new_docs.append((input_path, text))
+    with tqdm(total=total, initial=total - len(plan.pending), desc="ocr") as progress_bar:
+        try:
+            for result in iter_ocr_results(plan.pending, workers, engine):
+                writer.add(result)
                 progress_bar.update(1)
 
-            now = time.time()
-            should_report = (
-                index == total
-                or index % status_every_images == 0
-                or (now - last_status_time) >= status_every_seconds
-            )
-            if should_report:
-                rate = progress_bar.format_dict.get("rate") or 0.0
-                remaining = max(total - progress_bar.n, 0)
-                eta_seconds = int(remaining / rate) if rate > 0 else 0
-                progress_bar.set_postfix(rate=f"{rate:.3f}/s", eta=eta_seconds, skipped=skipped)
-                if progress is not None:
-                    progress(index, total, float(rate), eta_seconds)
-                last_status_time = now
-
-    if new_docs:
-        with conn:
-            conn.executemany("INSERT INTO ocr_doc(input_path, text) VALUES (?, ?)", new_docs)
-
-    with conn:
-        conn.execute("CREATE TEMP TABLE current_path(input_path TEXT PRIMARY KEY)")
-        conn.executemany(
-            "INSERT INTO current_path(input_path) VALUES (?)",
-            [(input_path,) for input_path in paths],
-        )
-        deleted_rows = conn.execute(
-            """
-            DELETE FROM ocr_doc
-            WHERE NOT EXISTS (
-                SELECT 1 FROM current_path
-                WHERE current_path.input_path = ocr_doc.input_path
-            )
-            """
-        ).rowcount
-        conn.execute("DROP TABLE current_path")
-
-    total_rows = conn.execute("SELECT COUNT(*) FROM ocr_doc").fetchone()[0]
+                now = time.time()
+                index = progress_bar.n
+                should_report = (
+                    index == total
+                    or index % status_every_images == 0
+                    or (now - last_status_time) >= status_every_seconds
+                )
+                if should_report:
+                    rate = progress_bar.format_dict.get("rate") or 0.0
+                    remaining = max(total - progress_bar.n, 0)
+                    eta_seconds = int(remaining / rate) if rate > 0 else 0
+                    progress_bar.set_postfix(
+                        rate=f"{rate:.3f}/s",
+                        eta=eta_seconds,
+                        skipped=writer.failed,
+                    )
+                    if progress is not None:
+                        progress(index, total, float(rate), eta_seconds)
+                    last_status_time = now
+                jobs.checkpoint()
+        finally:
+            writer.flush()
+
+    if progress is not None:
+        progress(total, total, 0.0, 0)
+    stats = finish_ocr(conn, plan, writer, workers, engine, prune=prune)
     conn.close()
-    return {
-        "resolved_paths": total,
-        "new_rows": len(new_docs),
-        "deleted_rows": int(deleted_rows),
-        "skipped_rows": skipped,
-        "total_rows": int(total_rows),
-    }
+    return stats
 
 
 def default_cluster_count(total: int) -> int:
@@ -245,6 +984,447 @@ def default_cluster_count(total: int) -> int:
     return int(np.clip(round(total**0.5), 8, 128))
 
 
+def available_memory_bytes() -> int:
+    try:
+        with open("/proc/meminfo", encoding="utf-8") as handle:
+            for line in handle:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return int(os.sysconf("SC_AVPHYS_PAGES")) * int(os.sysconf("SC_PAGE_SIZE"))
+    except (AttributeError, OSError, ValueError):
+        return 0
+
+
+def resolve_batch_size(batch_size: int) -> int:
+    available = available_memory_bytes()
+    if available > 0:
+        fits = int(available * BATCH_MEMORY_FRACTION) // BATCH_BYTES_PER_IMAGE
+        ceiling = int(np.clip(fits, 1, MAX_BATCH_SIZE))
+    else:
+        ceiling = MAX_BATCH_SIZE
+    if batch_size <= 0:
+        return ceiling
+    return max(1, min(batch_size, ceiling))
+
+
+def default_decode_workers() -> int:
+    return max(1, min(4, (os.cpu_count() or 2) // 2))
+
+
+def shrink_image(image, target_size: int = DECODE_SIZE):
+    from PIL import Image
+
+    width, height = image.size
+    scale = target_size / min(width, height) if target_size > 0 else 1.0
+    if scale >= 1.0:
+        return image
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return image.resize(size, Image.Resampling.BICUBIC, reducing_gap=2.0)
+
+
+def decode_image(
+    path: str,
+    target_size: int = DECODE_SIZE,
+    min_size: int = MIN_IMAGE_SIZE,
+    max_pixels: int = MAX_DECODE_PIXELS,
+):
+    from PIL import Image
+
+    try:
+        with Image.open(path) as image:
+            width, height = image.size
+            if width < min_size or height < min_size:
+                return None
+            if width * height > max_pixels:
+                return None
+            scale = target_size / min(width, height) if target_size > 0 else 1.0
+            if scale >= 1.0:
+                return image.convert("RGB")
+            size = (max(1, round(width * scale)), max(1, round(height * scale)))
+            image.draft("RGB", size)
+            return shrink_image(image.convert("RGB"), target_size)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+
+def decode_with_hash(path: str, target_size: int = DECODE_SIZE) -> tuple[object, int | None]:
+    image = decode_image(path, target_size)
+    return image, None if image is None else dedupe.perceptual_hash(image)
+
+
+def iter_decoded_batches(
+    paths: list[str],
+    batch_size: int,
+    target_size: int = DECODE_SIZE,
+    workers: int = 0,
+    prefetch_batches: int = DECODE_PREFETCH_BATCHES,
+) -> Iterator[tuple[list[str], list]]:
+    workers = workers if workers > 0 else default_decode_workers()
+    pending: deque[tuple[list[str], list[Future]]] = deque()
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="decode")
+    try:
+        for start in range(0, len(paths), batch_size):
+            batch_paths = paths[start : start + batch_size]
+            futures = [pool.submit(decode_image, path, target_size) for path in batch_paths]
+            pending.append((batch_paths, futures))
+            if len(pending) > prefetch_batches:
+                batch_paths, futures = pending.popleft()
+                yield batch_paths, [future.result() for future in futures]
+        while pending:
+            batch_paths, futures = pending.popleft()
+            yield batch_paths, [future.result() for future in futures]
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    finite = np.isfinite(norms) & (norms > 0)
+    return np.where(finite, vectors / np.where(finite, norms, 1.0), 0.0).astype(np.float32)
+
+
+@dataclass(frozen=True)
+class BackendConfig:
+    name: str = "torch"
+    quantize: bool = False
+
+    def model_key(self, model_name: str) -> str:
+        if self.name == "torch" and not self.quantize:
+            return model_name
+        return f"{model_name}@{self.name}{'-int8' if self.quantize else ''}"
+
+
+def load_clip_processor(model_name: str, local_files_only: bool = True):
+    transformers = importlib.import_module("transformers")
+    return transformers.CLIPProcessor.from_pretrained(
+        model_name,
+        use_fast=False,
+        local_files_only=local_files_only,
+    )
+
+
+def vision_graph_dir(cache_dir: Path, model_name: str) -> Path:
+    return cache_dir / model_name.replace("/", "__")
+
+
+def export_onnx_vision(
+    model_name: str,
+    cache_dir: Path,
+    quantize: bool = False,
+    local_files_only: bool = True,
+) -> Path:
+    graph_dir = vision_graph_dir(cache_dir, model_name)
+    fp32_path = graph_dir / "vision.onnx"
+    if not fp32_path.exists():
+        torch = importlib.import_module("torch")
+        transformers = importlib.import_module("transformers")
+        clip = transformers.CLIPModel.from_pretrained(model_name, local_files_only=local_files_only)
+        clip.eval()
+
+        class VisionTower(torch.nn.Module):
+            def __init__(self) -> None:
+                super().__init__()
+                self.vision_model = clip.vision_model
+                self.visual_projection = clip.visual_projection
+
+            def forward(self, pixel_values):
+                outputs = self.vision_model(pixel_values=pixel_values)
+                return self.visual_projection(outputs.pooler_output)
+
+        image_size = int(clip.config.vision_config.image_size)
+        graph_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = graph_dir / "vision.tmp.onnx"
+        with torch.no_grad():
+            torch.onnx.export(
+                VisionTower(),
+                (torch.zeros(1, 3, image_size, image_size),),
+                str(tmp_path),
+                input_names=["pixel_values"],
+                output_names=["image_embeds"],
+                dynamic_axes={"pixel_values": {0: "batch"}, "image_embeds": {0: "batch"}},
+                opset_version=17,
+            )
+        tmp_path.replace(fp32_path)
+    if not quantize:
+        return fp32_path
+
+    int8_path = graph_dir / "vision-int8.onnx"
+    if not int8_path.exists():
+        quantization = importlib.import_module("onnxruntime.quantization")
+        tmp_path = graph_dir / "vision-int8.tmp.onnx"
+        quantization.quantize_dynamic(
+            str(fp32_path),
+            str(tmp_path),
+            weight_type=quantization.QuantType.QInt8,
+        )
+        tmp_path.replace(int8_path)
+    return int8_path
+
+
+def export_openvino_vision(
+    model_name: str,
+    cache_dir: Path,
+    quantize: bool = False,
+    local_files_only: bool = True,
+) -> Path:
+    xml_path = vision_graph_dir(cache_dir, model_name) / (
+        "vision-int8.xml" if quantize else "vision.xml"
+    )
+    if xml_path.exists():
+        return xml_path
+    ov = importlib.import_module("openvino")
+    onnx_path = export_onnx_vision(model_name, cache_dir, local_files_only=local_files_only)
+    graph = ov.convert_model(str(onnx_path))
+    if quantize:
+        graph = importlib.import_module("nncf").compress_weights(graph)
+    ov.save_model(graph, str(xml_path), compress_to_fp16=False)
+    return xml_path
+
+
+class VisionBackend(ABC):
+    processor: object
+    embed_dim: int
+
+    @abstractmethod
+    def encode(self, images: list) -> np.ndarray: ...
+
+
+class TorchVisionBackend(VisionBackend):
+    def __init__(
+        self,
+        model_name: str,
+        quantize: bool,
+        cache_dir: Path,
+        local_files_only: bool,
+        threads: int = 0,
+    ) -> None:
+        del cache_dir
+        torch = importlib.import_module("torch")
+        transformers = importlib.import_module("transformers")
+        if threads > 0:
+            torch.set_num_threads(threads)
+        self.processor = load_clip_processor(model_name, local_files_only)
+        model = transformers.CLIPModel.from_pretrained(
+            model_name,
+            local_files_only=local_files_only,
+        )
+        model.eval()
+        model.cpu()
+        if quantize:
+            model = torch.ao.quantization.quantize_dynamic(
+                model,
+                {torch.nn.Linear},
+                dtype=torch.qint8,
+            )
+        self.model = model
+        self.embed_dim = int(model.visual_projection.out_features)
+
+    def encode(self, images: list) -> np.ndarray:
+        torch = importlib.import_module("torch")
+        inputs = self.processor(images=images, return_tensors="pt")
+        with torch.no_grad():
+            outputs = self.model.vision_model(pixel_values=inputs["pixel_values"])
+            image_embeds = self.model.visual_projection(outputs.pooler_output)
+        return normalize_rows(image_embeds.cpu().numpy())
+
+
+class OnnxVisionBackend(VisionBackend):
+    def __init__(
+        self,
+        model_name: str,
+        quantize: bool,
+        cache_dir: Path,
+        local_files_only: bool,
+        threads: int = 0,
+    ) -> None:
+        ort = importlib.import_module("onnxruntime")
+        self.processor = load_clip_processor(model_name, local_files_only)
+        graph_path = export_onnx_vision(model_name, cache_dir, quantize, local_files_only)
+        options = ort.SessionOptions()
+        if threads > 0:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(
+            str(graph_path),
+            sess_options=options,
+            providers=["CPUExecutionProvider"],
+        )
+        self.embed_dim = int(self.session.get_outputs()[0].shape[-1])
+
+    def encode(self, images: list) -> np.ndarray:
+        pixel_values = self.processor(images=images, return_tensors="np")["pixel_values"]
+        (image_embeds,) = self.session.run(None, {"pixel_values": pixel_values.astype(np.float32)})
+        return normalize_rows(image_embeds)
+
+
+class OpenVinoVisionBackend(VisionBackend):
+    def __init__(
+        self,
+        model_name: str,
+        quantize: bool,
+        cache_dir: Path,
+        local_files_only: bool,
+        threads: int = 0,
+    ) -> None:
+        ov = importlib.import_module("openvino")
+        self.processor = load_clip_processor(model_name, local_files_only)
+        graph_path = export_openvino_vision(model_name, cache_dir, quantize, local_files_only)
+        config = {"INFERENCE_NUM_THREADS": threads} if threads > 0 else {}
+        self.model = ov.Core().compile_model(str(graph_path), "CPU", config)
+        self.embed_dim = int(self.model.output(0).get_partial_shape()[-1].get_length())
+
+    def encode(self, images: list) -> np.ndarray:
+        pixel_values = self.processor(images=images, return_tensors="np")["pixel_values"]
+        image_embeds = self.model(pixel_values.astype(np.float32))[self.model.output(0)]
+        return normalize_rows(image_embeds)
+
+
+_BACKENDS: dict[str, type[VisionBackend]] = {
+    "torch": TorchVisionBackend,
+    "onnx": OnnxVisionBackend,
+    "openvino": OpenVinoVisionBackend,
+}
+
+
+def load_backend(
+    model_name: str,
+    backend: BackendConfig,
+    cache_dir: Path,
+    local_files_only: bool = True,
+    threads: int = 0,
+) -> VisionBackend:
+    backend_cls = _BACKENDS.get(backend.name)
+    if backend_cls is None:
+        raise ValueError(f"Unknown inference backend: {backend.name}")
+    return backend_cls(model_name, backend.quantize, cache_dir, local_files_only, threads)
+
+
+def model_cache_dir(db_path: Path) -> Path:
+    return db_path.parent / "models"
+
+
+def iter_local_embeddings(
+    paths: list[str],
+    batch_size: int,
+    encoder: VisionBackend,
+) -> Iterator[tuple[list[str], np.ndarray, np.ndarray]]:
+    for batch_paths, images in iter_decoded_batches(paths, batch_size):
+        yield batch_paths, *encode_batch(encoder, images)
+
+
+def iter_service_embeddings(
+    client,
+    paths: list[str],
+    db_path: Path,
+    model_name: str,
+    batch_size: int,
+    backend: BackendConfig,
+) -> Iterator[tuple[list[str], np.ndarray, np.ndarray]]:
+    from bruki.server import service
+
+    done = 0
+    try:
+        for batch_paths, vectors, batch_mask in client.iter_embeddings(
+            paths,
+            model_name,
+            backend,
+            chunk_size=max(batch_size, service.REQUEST_CHUNK),
+        ):
+            done += len(batch_paths)
+            yield batch_paths, vectors, batch_mask
+        return
+    except service.ServiceError as exc:
+        # The service went away or failed mid-job; chunks come back in order, so the rest
+        # of the list is embedded in-process.
+        update_status(db_path, embedding_via="local", embedding_fallback=str(exc))
+    encoder = load_backend(model_name, backend, model_cache_dir(db_path))
+    yield from iter_local_embeddings(paths[done:], batch_size, encoder)
+
+
+def encode_batch(encoder: VisionBackend, images: list) -> tuple[np.ndarray, np.ndarray]:
+    batch_mask = np.array([image is not None for image in images], dtype=bool)
+    vectors = np.zeros((len(images), encoder.embed_dim), dtype=np.float32)
+    if batch_mask.any():
+        vectors[batch_mask] = encoder.encode([image for image in images if image is not None])
+    batch_mask &= np.any(vectors != 0, axis=1)
+    return vectors, batch_mask
+
+
+EmbeddingRow = tuple[str, str, int, int, int, bytes, int, float]
+
+
+def upsert_embedding_rows(conn: sqlite3.Connection, rows: list[EmbeddingRow]) -> None:
+    conn.executemany(
+        """
+        INSERT INTO clip_embedding(
+            input_path, model, mtime_ns, size_bytes, dim, vector, valid, norm
+        )
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(input_path) DO UPDATE SET
+            model = excluded.model,
+            mtime_ns = excluded.mtime_ns,
+            size_bytes = excluded.size_bytes,
+            dim = excluded.dim,
+            vector = excluded.vector,
+            valid = excluded.valid,
+            norm = excluded.norm
+        """,
+        rows,
+    )
+
+
+def embedding_rows(
+    batch_paths: list[str],
+    vectors: np.ndarray,
+    batch_mask: np.ndarray,
+    path_stats: dict[str, tuple[int, int]],
+    model_key: str,
+) -> list[EmbeddingRow]:
+    norms = np.linalg.norm(vectors, axis=1)
+    return [
+        (
+            path_str,
+            model_key,
+            *path_stats[path_str],
+            CLIP_EMBED_DIM,
+            vector.tobytes(),
+            int(valid),
+            float(norm),
+        )
+        for path_str, vector, valid, norm in zip(
+            batch_paths, vectors, batch_mask, norms, strict=True
+        )
+    ]
+
+
+def write_embedding_rows(db_path: Path, rows: list[EmbeddingRow]) -> None:
+    if not rows:
+        return
+    conn = database.connect(db_path)
+    with conn:
+        upsert_embedding_rows(conn, rows)
+        conn.executemany(
+            """
+            INSERT INTO clip_feature(content_digest, model, dim, vector, valid, norm)
+            SELECT content_digest, ?, ?, ?, ?, ? FROM file_digest
+            WHERE input_path = ? AND mtime_ns = ? AND size_bytes = ?
+            ON CONFLICT(content_digest, model) DO UPDATE SET
+                dim = excluded.dim,
+                vector = excluded.vector,
+                valid = excluded.valid,
+                norm = excluded.norm
+            """,
+            [
+                (model, dim, vector, valid, norm, input_path, mtime_ns, size_bytes)
+                for input_path, model, mtime_ns, size_bytes, dim, vector, valid, norm in rows
+            ],
+        )
+    conn.close()
+
+
 def embed_images(
     paths: list[str],
     path_stats: dict[str, tuple[int, int]],
@@ -252,16 +1432,11 @@ def embed_images(
     model_name: str,
     batch_size: int,
     cached_images: int,
+    backend: BackendConfig = BackendConfig(),
+    use_service: bool = True,
 ) -> tuple[int, int]:
-    from PIL import Image
-
-    torch = importlib.import_module("torch")
     tqdm = importlib.import_module("tqdm").tqdm
-    transformers = importlib.import_module("transformers")
-    clip_processor = transformers.CLIPProcessor
-    clip_model = transformers.CLIPModel
 
-    del batch_size
     total = len(paths)
     if total == 0:
         update_status(
@@ -276,334 +1451,1253 @@ def embed_images(
         )
         return 0, 0
 
-    processor = clip_processor.from_pretrained(
-        model_name,
-        use_fast=False,
-        local_files_only=True,
-    )
-    model = clip_model.from_pretrained(
-        model_name,
-        local_files_only=True,
-    )
-    model.eval()
-    model.cpu()
-    embed_dim = int(model.visual_projection.out_features)
-    if embed_dim != CLIP_EMBED_DIM:
-        raise ValueError(f"Unexpected CLIP projection dim: {embed_dim}")
+    batch_size = resolve_batch_size(batch_size)
+    model_key = backend.model_key(model_name)
+    from bruki.server import service
 
-    rows: list[tuple[str, str, int, int, int, bytes, int]] = []
+    client = service.connect() if use_service else None
+    init_db(db_path)
+    if client is not None:
+        update_status(db_path, embedding_via="service", embedding_fallback="")
+        batches = iter_service_embeddings(client, paths, db_path, model_name, batch_size, backend)
+    else:
+        update_status(db_path, embedding_via="local", embedding_fallback="")
+        encoder = load_backend(model_name, backend, model_cache_dir(db_path))
+        batches = iter_local_embeddings(paths, batch_size, encoder)
+
+    rows: list[EmbeddingRow] = []
+    committed = 0
     skipped = 0
-    min_size = 10
     status_every_images = 10
     status_every_seconds = 0.5
     last_status_time = 0.0
+    index = 0
     with tqdm(total=total, desc="embedding") as progress:
-        for index, path_str in enumerate(paths, start=1):
-            vector = np.zeros(embed_dim, dtype=np.float32)
-            valid = 0
+        for batch_paths, vectors, batch_mask in batches:
+            if vectors.shape[1] != CLIP_EMBED_DIM:
+                raise ValueError(f"Unexpected CLIP projection dim: {vectors.shape[1]}")
+            skipped += int((~batch_mask).sum())
+            rows.extend(embedding_rows(batch_paths, vectors, batch_mask, path_stats, model_key))
             try:
-                with Image.open(path_str) as image:
-                    if image.size[0] < min_size or image.size[1] < min_size:
-                        skipped += 1
-                    else:
-                        inputs = processor(images=image.convert("RGB"), return_tensors="pt")
-                        with torch.no_grad():
-                            outputs = model.vision_model(pixel_values=inputs["pixel_values"])
-                            image_embeds = model.visual_projection(outputs.pooler_output)
-                        vector = image_embeds.squeeze(0).cpu().numpy().astype(np.float32)
-                        norm = float(np.linalg.norm(vector))
-                        if np.isfinite(norm) and norm > 0:
-                            vector /= norm
-                            valid = 1
-                        else:
-                            skipped += 1
-            except OSError:
-                skipped += 1
+                jobs.checkpoint()
+            except jobs.JobCancelled:
+                write_embedding_rows(db_path, rows)
+                raise
+
+            index += len(batch_paths)
+            if len(rows) >= EMBED_COMMIT_EVERY:
+                write_embedding_rows(db_path, rows)
+                committed += len(rows)
+                rows = []
+            progress.update(len(batch_paths))
+            now = time.time()
+            should_report = (
+                index == total
+                or index % status_every_images < len(batch_paths)
+                or (now - last_status_time) >= status_every_seconds
+            )
+            if should_report:
+                rate = progress.format_dict.get("rate") or 0.0
+                remaining = max(total - progress.n, 0)
+                eta_seconds = int(remaining / rate) if rate > 0 else 0
+                progress.set_postfix(
+                    skipped=skipped,
+                    batch=batch_size,
+                    rate=f"{rate:.3f}/s",
+                    eta=eta_seconds,
+                )
+                update_status(
+                    db_path,
+                    stage="embedding",
+                    stage_progress={
+                        "embedding": progress_entry(index, total, rate, eta_seconds),
+                    },
+                    processed_images=index,
+                    total_images=total,
+                    skipped_images=skipped,
+                    cached_images=cached_images,
+                    committed_images=committed,
+                    batch_size=batch_size,
+                    rate_images_per_second=round(rate, 3),
+                    eta_seconds=eta_seconds,
+                )
+                last_status_time = now
+
+    write_embedding_rows(db_path, rows)
+    update_status(db_path, committed_images=total)
+    return total, skipped
+
+
+def backfill_embedding_norms(conn: sqlite3.Connection, chunk_size: int = 4096) -> int:
+    cursor = conn.execute("SELECT rowid, vector FROM clip_embedding WHERE norm IS NULL")
+    updated = 0
+    while chunk := cursor.fetchmany(chunk_size):
+        norms = [
+            float(np.linalg.norm(np.frombuffer(vector_blob, dtype=np.float32)))
+            if len(vector_blob) % 4 == 0
+            else 0.0
+            for _, vector_blob in chunk
+        ]
+        with conn:
+            conn.executemany(
+                "UPDATE clip_embedding SET norm = ? WHERE rowid = ?",
+                [
+                    (norm if np.isfinite(norm) else 0.0, rowid)
+                    for (rowid, _), norm in zip(chunk, norms, strict=True)
+                ],
+            )
+        updated += len(chunk)
+    return updated
+
+
+def load_current_stats(
+    conn: sqlite3.Connection,
+    paths: list[str],
+    path_stats: dict[str, tuple[int, int]],
+) -> None:
+    conn.execute(
+        """
+        CREATE TEMP TABLE IF NOT EXISTS current_stat (
+            input_path TEXT PRIMARY KEY,
+            ord INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            size_bytes INTEGER NOT NULL
+        )
+        """
+    )
+    conn.execute("DELETE FROM current_stat")
+    conn.executemany(
+        """
+        INSERT OR IGNORE INTO current_stat(input_path, ord, mtime_ns, size_bytes)
+        VALUES (?, ?, ?, ?)
+        """,
+        [(path, index, *path_stats[path]) for index, path in enumerate(paths)],
+    )
+
+
+def stale_embedding_paths(conn: sqlite3.Connection, model_key: str) -> list[str]:
+    return [
+        input_path
+        for (input_path,) in conn.execute(
+            """
+            SELECT current_stat.input_path
+            FROM current_stat
+            LEFT JOIN clip_embedding ON clip_embedding.input_path = current_stat.input_path
+            WHERE clip_embedding.input_path IS NULL
+               OR clip_embedding.model != :model
+               OR clip_embedding.mtime_ns != current_stat.mtime_ns
+               OR clip_embedding.size_bytes != current_stat.size_bytes
+               OR clip_embedding.dim != :dim
+               OR length(clip_embedding.vector) != :dim * 4
+               OR clip_embedding.valid NOT IN (0, 1)
+               OR (clip_embedding.valid = 1 AND NOT clip_embedding.norm > 0)
+            ORDER BY current_stat.ord
+            """,
+            {"model": model_key, "dim": CLIP_EMBED_DIM},
+        )
+    ]
+
+
+@dataclass
+class EmbeddingPlan:
+    paths: list[str]
+    path_stats: dict[str, tuple[int, int]]
+    pending: list[str]
+    duplicates: list[str]
+    reused: set[str]
+    cached_images: int
+    digest_stats: dict
+    deleted_rows: int
+
+
+def plan_embeddings(
+    conn: sqlite3.Connection,
+    paths: list[str],
+    path_stats: dict[str, tuple[int, int]],
+    model_key: str,
+) -> EmbeddingPlan:
+    backfill_embedding_norms(conn)
+    load_current_stats(conn, paths, path_stats)
+    needs_embed = stale_embedding_paths(conn, model_key)
+    cached_images = len(paths) - len(needs_embed)
+    digest_stats = update_file_digests(conn, paths, path_stats)
+    reused = reuse_clip_features(conn, needs_embed, path_stats, model_key)
+    needs_embed = [path for path in needs_embed if path not in reused]
+    needs_embed, duplicates = split_duplicates(needs_embed, content_digests(conn, needs_embed))
+
+    with conn:
+        deleted_rows = conn.execute(
+            """
+            DELETE FROM clip_embedding
+            WHERE NOT EXISTS (
+                SELECT 1 FROM current_stat
+                WHERE current_stat.input_path = clip_embedding.input_path
+            )
+            """
+        ).rowcount
+    return EmbeddingPlan(
+        paths,
+        path_stats,
+        needs_embed,
+        duplicates,
+        reused,
+        cached_images,
+        digest_stats,
+        int(deleted_rows),
+    )
+
+
+def finish_embeddings(
+    conn: sqlite3.Connection,
+    db_path: Path,
+    plan: EmbeddingPlan,
+    model_key: str,
+    embedded_images: int,
+    skipped_images: int,
+) -> tuple[np.ndarray, np.ndarray, dict]:
+    plan.reused |= reuse_clip_features(conn, plan.duplicates, plan.path_stats, model_key)
+    prune_file_digests(conn, plan.paths)
+    store_stats = matrix_store.sync_store(conn, db_path, model_key, CLIP_EMBED_DIM)
+    ann_stats = ann.update_index(conn, db_path, model_key)
+    view = matrix_store.open_matrix(db_path, plan.paths)
+    if view is None:
+        raise ValueError(f"No CLIP matrix store next to {db_path}")
+    embeddings, valid_array = view.vectors(), view.valid
+    return (
+        embeddings,
+        valid_array,
+        {
+            "embedded_images": embedded_images,
+            "cached_images": plan.cached_images,
+            "reused_images": len(plan.reused),
+            "hashed_files": plan.digest_stats["hashed_files"],
+            "duplicate_files": plan.digest_stats["duplicate_files"],
+            "deleted_rows": plan.deleted_rows,
+            "skipped_images": skipped_images,
+            "valid_images": int(valid_array.sum()),
+            "invalid_images": int((~valid_array).sum()),
+            "matrix": store_stats,
+            "ann": ann_stats,
+        },
+    )
+
+
+def resolve_embeddings(
+    paths: list[str],
+    db_path: Path,
+    model_name: str,
+    batch_size: int,
+    backend: BackendConfig = BackendConfig(),
+) -> tuple[np.ndarray, np.ndarray, dict]:
+    model_key = backend.model_key(model_name)
+    paths = list(dict.fromkeys(paths))
+
+    conn = database.connect(db_path)
+    plan = plan_embeddings(conn, paths, stat_paths(paths), model_key)
+    embedded_images, skipped_images = embed_images(
+        plan.pending,
+        path_stats=plan.path_stats,
+        db_path=db_path,
+        model_name=model_name,
+        batch_size=batch_size,
+        cached_images=plan.cached_images + len(plan.reused),
+        backend=backend,
+    )
+    try:
+        return finish_embeddings(conn, db_path, plan, model_key, embedded_images, skipped_images)
+    finally:
+        conn.close()
+
+
+@dataclass(frozen=True)
+class CoreBudget:
+    cores: int
+    torch_threads: int
+    ocr_workers: int
+    decode_threads: int
+
+
+def pipeline_mode() -> str:
+    value = os.environ.get(PIPELINE_ENV, "concurrent").strip().lower() or "concurrent"
+    if value not in PIPELINE_MODES:
+        raise ValueError(f"{PIPELINE_ENV} must be one of {', '.join(PIPELINE_MODES)}")
+    return value
+
+
+def concurrent_pipeline(completed: list[str]) -> bool:
+    if "embedding" in completed or "ocr" in completed or pipeline_mode() == "sequential":
+        return False
+    from bruki.server import service
+
+    # The shared pass embeds in-process; with the resident service up that would load a second
+    # copy of the model, so the stages run one after the other through the service instead.
+    return service.connect() is None
+
+
+def core_budget(embed_count: int, ocr_count: int) -> CoreBudget:
+    cores = int(os.environ.get(CORES_ENV, "0") or 0) or available_cores()
+    share = float(os.environ.get(TORCH_SHARE_ENV, DEFAULT_TORCH_SHARE))
+    if not 0.0 < share < 1.0:
+        raise ValueError(f"{TORCH_SHARE_ENV} must be between 0 and 1")
+    if not ocr_count:
+        torch_threads = cores
+    elif not embed_count:
+        torch_threads = 0
+    else:
+        # tesseract is the slower consumer, so OCR keeps the larger share of the cores.
+        torch_threads = min(max(1, round(cores * share)), max(1, cores - 1))
+    ocr_workers = max(1, cores - torch_threads) if ocr_count else 0
+    # Decoding runs next to torch in this process and comes out of its share.
+    decode_threads = max(1, min(default_decode_workers(), torch_threads))
+    return CoreBudget(cores, torch_threads, ocr_workers, decode_threads)
+
+
+def progress_entry(processed: int, total: int, rate: float, eta_seconds: int) -> dict:
+    return {
+        "processed_images": processed,
+        "total_images": total,
+        "rate_images_per_second": round(rate, 3),
+        "eta_seconds": eta_seconds,
+    }
+
+
+class SharedDecodeIndexer:
+    def __init__(
+        self,
+        db_path: Path,
+        embedding: EmbeddingPlan,
+        ocr: OcrPlan,
+        writer: OcrWriter,
+        encoder: VisionBackend | None,
+        model_key: str,
+        batch_size: int,
+        budget: CoreBudget,
+        engine: str,
+    ) -> None:
+        self.db_path = db_path
+        self.embedding = embedding
+        self.ocr = ocr
+        self.writer = writer
+        self.encoder = encoder
+        self.model_key = model_key
+        self.batch_size = batch_size
+        self.budget = budget
+        self.engine = engine
+        self.embedded = 0
+        self.skipped = 0
+        self.rows: list[EmbeddingRow] = []
+        self.hashes: list[dedupe.HashRow] = []
+        self.batch_paths: list[str] = []
+        self.batch_images: list = []
+        self.in_flight: set[Future] = set()
+        self.bars: dict = {}
+        self.last_status = 0.0
+
+    def run(self) -> None:
+        tqdm = importlib.import_module("tqdm").tqdm
+        embed_set = set(self.embedding.pending)
+        ocr_set = set(self.ocr.pending)
+        stream = [path for path in self.embedding.paths if path in embed_set or path in ocr_set]
+        ocr_pool = None
+        if ocr_set:
+            ocr_pool = ProcessPoolExecutor(
+                max_workers=min(self.budget.ocr_workers, len(ocr_set)),
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_ocr_worker,
+                initargs=(self.engine, 1),
+            )
+        ocr_limit = self.budget.ocr_workers * SHARED_OCR_TASKS_PER_WORKER
+        decode_pool = ThreadPoolExecutor(
+            max_workers=self.budget.decode_threads,
+            thread_name_prefix="decode",
+        )
+        self.bars = {
+            "embedding": tqdm(total=len(embed_set), desc="embedding", position=0),
+            "ocr": tqdm(total=len(ocr_set), desc="ocr", position=1),
+        }
+        decoded: deque[tuple[str, Future]] = deque()
+        try:
+            for input_path in stream:
+                jobs.checkpoint()
+                # OCR needs full resolution; CLIP-only images keep the cheaper draft decode.
+                target_size = 0 if input_path in ocr_set else DECODE_SIZE
+                # The perceptual hash rides along on the decode threads.
+                decoded.append(
+                    (input_path, decode_pool.submit(decode_with_hash, input_path, target_size))
+                )
+                if len(decoded) > 2 * self.budget.decode_threads:
+                    input_path, future = decoded.popleft()
+                    self._dispatch(
+                        input_path, *future.result(), embed_set, ocr_set, ocr_pool, ocr_limit
+                    )
+            while decoded:
+                input_path, future = decoded.popleft()
+                self._dispatch(
+                    input_path, *future.result(), embed_set, ocr_set, ocr_pool, ocr_limit
+                )
+            if self.batch_paths:
+                self._encode()
+            while self.in_flight:
+                self._collect(block=True)
+        finally:
+            decode_pool.shutdown(wait=True, cancel_futures=True)
+            if ocr_pool is not None:
+                ocr_pool.shutdown(wait=True, cancel_futures=True)
+            write_embedding_rows(self.db_path, self.rows)
+            self.rows = []
+            dedupe.write_hashes(self.writer.conn, self.hashes)
+            self.hashes = []
+            self.writer.flush()
+            for bar in self.bars.values():
+                bar.close()
+        self._report(force=True)
+
+    def _dispatch(
+        self,
+        input_path: str,
+        image,
+        phash: int | None,
+        embed_set: set[str],
+        ocr_set: set[str],
+        ocr_pool: ProcessPoolExecutor | None,
+        ocr_limit: int,
+    ) -> None:
+        if image is not None:
+            self.hashes.append((input_path, *self.embedding.path_stats[input_path], phash))
+        if input_path in embed_set:
+            self.batch_paths.append(input_path)
+            self.batch_images.append(None if image is None else shrink_image(image))
+            if len(self.batch_paths) >= self.batch_size:
+                self._encode()
+        if input_path in ocr_set and ocr_pool is not None:
+            while len(self.in_flight) >= ocr_limit:
+                self._collect(block=True)
+            if image is None or image.width * image.height * 3 > SHARED_OCR_MAX_PIXEL_BYTES:
+                # Let the worker open it: tiny and oversized images have their own OCR modes.
+                self.in_flight.add(ocr_pool.submit(ocr_task, input_path))
+            else:
+                dpi = float(image.info.get("dpi", (0,))[0] or 0)
+                self.in_flight.add(
+                    ocr_pool.submit(ocr_pixels_task, input_path, image.size, image.tobytes(), dpi)
+                )
+        self._collect(block=False)
+        self._report()
+
+    def _encode(self) -> None:
+        if self.encoder is None:
+            raise ValueError("No CLIP encoder loaded for pending embeddings")
+        vectors, batch_mask = encode_batch(self.encoder, self.batch_images)
+        if vectors.shape[1] != CLIP_EMBED_DIM:
+            raise ValueError(f"Unexpected CLIP projection dim: {vectors.shape[1]}")
+        self.skipped += int((~batch_mask).sum())
+        self.rows.extend(
+            embedding_rows(
+                self.batch_paths,
+                vectors,
+                batch_mask,
+                self.embedding.path_stats,
+                self.model_key,
+            )
+        )
+        self.embedded += len(self.batch_paths)
+        self.bars["embedding"].update(len(self.batch_paths))
+        self.batch_paths = []
+        self.batch_images = []
+        if len(self.rows) >= EMBED_COMMIT_EVERY:
+            write_embedding_rows(self.db_path, self.rows)
+            self.rows = []
+
+    def _collect(self, block: bool) -> None:
+        if not self.in_flight:
+            return
+        done, self.in_flight = wait(
+            self.in_flight,
+            timeout=None if block else 0,
+            return_when=FIRST_COMPLETED,
+        )
+        for future in done:
+            self.writer.add(future.result())
+            self.bars["ocr"].update(1)
+
+    def _report(self, force: bool = False) -> None:
+        now = time.time()
+        if not force and now - self.last_status < 0.5:
+            return
+        self.last_status = now
+        progress: dict[str, dict] = {}
+        for stage, bar in self.bars.items():
+            rate = bar.format_dict.get("rate") or 0.0
+            remaining = max(bar.total - bar.n, 0)
+            eta_seconds = int(remaining / rate) if rate > 0 else 0
+            progress[stage] = progress_entry(bar.n, bar.total, rate, eta_seconds)
+        update_status(
+            self.db_path,
+            stage="indexing",
+            stage_progress=progress,
+            skipped_images=self.skipped,
+            eta_seconds=max(entry["eta_seconds"] for entry in progress.values()),
+        )
+
+
+def index_concurrently(
+    paths: list[str],
+    db_path: Path,
+    model_name: str,
+    batch_size: int,
+    backend: BackendConfig = BackendConfig(),
+    engine: str = "",
+) -> tuple[np.ndarray, np.ndarray, dict, dict]:
+    model_key = backend.model_key(model_name)
+    paths = list(dict.fromkeys(paths))
+
+    conn = database.connect(db_path)
+    try:
+        embedding = plan_embeddings(conn, paths, stat_paths(paths), model_key)
+        ocr = plan_ocr(conn, paths, embedding.digest_stats)
+        budget = core_budget(len(embedding.pending), len(ocr.pending))
+        engine = engine or ocr_engine_name()
+        batch_size = resolve_batch_size(batch_size)
+        update_status(
+            db_path,
+            stage="indexing",
+            core_budget=asdict(budget),
+            batch_size=batch_size,
+            embedding_via="local",
+            cached_images=embedding.cached_images + len(embedding.reused),
+        )
+        encoder = None
+        if embedding.pending:
+            encoder = load_backend(
+                model_name,
+                backend,
+                model_cache_dir(db_path),
+                threads=budget.torch_threads,
+            )
+        indexer = SharedDecodeIndexer(
+            db_path,
+            embedding,
+            ocr,
+            OcrWriter(conn),
+            encoder,
+            model_key,
+            batch_size,
+            budget,
+            engine,
+        )
+        indexer.run()
+        embeddings, valid_mask, clip_stats = finish_embeddings(
+            conn, db_path, embedding, model_key, indexer.embedded, indexer.skipped
+        )
+        ocr_stats = finish_ocr(conn, ocr, indexer.writer, budget.ocr_workers, engine)
+    finally:
+        conn.close()
+    return embeddings, valid_mask, clip_stats, ocr_stats
+
+
+def backend_parity(
+    db_path: Path,
+    backend: BackendConfig,
+    model_name: str = MODEL_NAME,
+    reference: BackendConfig = BackendConfig(),
+    sample_size: int = 256,
+    batch_size: int = 16,
+) -> dict:
+    conn = database.connect(db_path)
+    candidates = [
+        input_path
+        for (input_path,) in conn.execute(
+            "SELECT input_path FROM clip_embedding WHERE model = ? AND valid = 1",
+            (reference.model_key(model_name),),
+        )
+    ]
+    if len(candidates) > sample_size:
+        rng = np.random.default_rng(0)
+        candidates = sorted(rng.choice(candidates, size=sample_size, replace=False).tolist())
+    stored: dict[str, np.ndarray] = {}
+    for input_path in candidates:
+        (vector_blob,) = conn.execute(
+            "SELECT vector FROM clip_embedding WHERE input_path = ?",
+            (input_path,),
+        ).fetchone()
+        stored[input_path] = np.frombuffer(vector_blob, dtype=np.float32)
+    conn.close()
+    if not stored:
+        raise ValueError(f"No stored {reference.model_key(model_name)} embeddings to compare.")
+
+    encoder = load_backend(model_name, backend, model_cache_dir(db_path))
+    compared_paths: list[str] = []
+    vectors: list[np.ndarray] = []
+    started = time.perf_counter()
+    for batch_paths, images in iter_decoded_batches(list(stored), batch_size):
+        kept = [
+            (path, image)
+            for path, image in zip(batch_paths, images, strict=True)
+            if image is not None
+        ]
+        if not kept:
+            continue
+        compared_paths.extend(path for path, _ in kept)
+        vectors.append(encoder.encode([image for _, image in kept]))
+    elapsed = time.perf_counter() - started
+    if not vectors:
+        raise ValueError("None of the sampled images could be decoded.")
+
+    candidate = np.vstack(vectors)
+    baseline = np.vstack([stored[path] for path in compared_paths])
+    cosine = np.sum(candidate * baseline, axis=1)
+    baseline_sim = baseline @ baseline.T
+    candidate_sim = candidate @ candidate.T
+    np.fill_diagonal(baseline_sim, -np.inf)
+    np.fill_diagonal(candidate_sim, -np.inf)
+    neighbour_match = np.argmax(baseline_sim, axis=1) == np.argmax(candidate_sim, axis=1)
+    return {
+        "reference": reference.model_key(model_name),
+        "backend": backend.model_key(model_name),
+        "images": len(compared_paths),
+        "mean_cosine": round(float(cosine.mean()), 6),
+        "min_cosine": round(float(cosine.min()), 6),
+        "p05_cosine": round(float(np.percentile(cosine, 5)), 6),
+        "top1_neighbour_agreement": round(float(neighbour_match.mean()), 4),
+        "rate_images_per_second": round(len(compared_paths) / elapsed, 3) if elapsed > 0 else 0.0,
+    }
+
+
+def find_duplicates(
+    db_path: Path,
+    paths: list[str],
+    progress: Callable[[int, int], None] | None = None,
+    prune: bool = True,
+    removed: list[str] | None = None,
+) -> dict:
+    conn = database.connect(db_path)
+    try:
+        path_stats = stat_paths(paths)
+        update_file_digests(conn, paths, path_stats)
+        hash_stats = dedupe.update_hashes(
+            conn,
+            paths,
+            path_stats,
+            content_digests(conn, paths),
+            progress=progress,
+            prune=prune,
+        )
+        # Partial updates regroup around the given and removed paths only.
+        changed = None if prune else [*paths, *(removed or [])]
+        group_stats = dedupe.update_groups(conn, db_path, changed)
+    finally:
+        conn.close()
+    return {**hash_stats, **group_stats}
+
+
+def completed_stages(status: dict, signature: str, model_key: str) -> list[str]:
+    if status.get("records_signature") != signature or status.get("model") != model_key:
+        return []
+    done = set(status.get("completed_stages", []))
+    completed: list[str] = []
+    for stage in PIPELINE_STAGES:
+        if stage not in done:
+            break
+        completed.append(stage)
+    return completed
+
+
+def next_stage(completed: list[str]) -> str:
+    return next((stage for stage in PIPELINE_STAGES if stage not in completed), "done")
+
+
+def mark_stage_done(db_path: Path, completed: list[str], stage: str, **fields: object) -> None:
+    completed.append(stage)
+    update_status(
+        db_path,
+        completed_stages=list(completed),
+        resume_stage=next_stage(completed),
+        **fields,
+    )
+
+
+@dataclass(frozen=True)
+class ClusterModel:
+    model: str
+    cluster_count: int
+    fitted_images: int
+    baseline_distance: float
+    changed_images: int
+    fitted_at: str
+
+
+def read_cluster_model(conn: sqlite3.Connection) -> ClusterModel | None:
+    row = conn.execute(
+        """
+        SELECT model, cluster_count, fitted_images, baseline_distance, changed_images, fitted_at
+        FROM clip_cluster_model WHERE id = 1
+        """
+    ).fetchone()
+    return None if row is None else ClusterModel(*row)
+
 
-            mtime_ns, size_bytes = path_stats[path_str]
-            rows.append(
-                (
-                    path_str,
-                    model_name,
-                    mtime_ns,
-                    size_bytes,
-                    embed_dim,
-                    vector.astype(np.float32).tobytes(),
-                    valid,
-                )
-            )
+def write_cluster_model(conn: sqlite3.Connection, info: ClusterModel) -> None:
+    conn.execute(
+        """
+        INSERT INTO clip_cluster_model(
+            id, model, cluster_count, fitted_images, baseline_distance, changed_images, fitted_at
+        )
+        VALUES (1, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(id) DO UPDATE SET
+            model = excluded.model,
+            cluster_count = excluded.cluster_count,
+            fitted_images = excluded.fitted_images,
+            baseline_distance = excluded.baseline_distance,
+            changed_images = excluded.changed_images,
+            fitted_at = excluded.fitted_at
+        """,
+        (
+            info.model,
+            info.cluster_count,
+            info.fitted_images,
+            info.baseline_distance,
+            info.changed_images,
+            info.fitted_at,
+        ),
+    )
 
-            progress.update(1)
-            now = time.time()
-            should_report = (
-                index == total
-                or index % status_every_images == 0
-                or (now - last_status_time) >= status_every_seconds
-            )
-            if should_report:
-                rate = progress.format_dict.get("rate") or 0.0
-                remaining = max(total - progress.n, 0)
-                eta_seconds = int(remaining / rate) if rate > 0 else 0
-                progress.set_postfix(skipped=skipped, rate=f"{rate:.3f}/s", eta=eta_seconds)
-                update_status(
-                    db_path,
-                    stage="embedding",
-                    processed_images=index,
-                    total_images=total,
-                    skipped_images=skipped,
-                    cached_images=cached_images,
-                    rate_images_per_second=round(rate, 3),
-                    eta_seconds=eta_seconds,
-                )
-                last_status_time = now
 
-    init_db(db_path)
-    conn = sqlite3.connect(db_path)
+def load_centroids(conn: sqlite3.Connection) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    rows = conn.execute(
+        """
+        SELECT cluster_id, centroid, weight FROM clip_cluster
+        WHERE length(centroid) = ?
+        ORDER BY cluster_id
+        """,
+        (CLIP_EMBED_DIM * 4,),
+    ).fetchall()
+    cluster_ids = np.array([int(cluster_id) for cluster_id, _, _ in rows], dtype=np.int64)
+    centroids = np.zeros((len(rows), CLIP_EMBED_DIM), dtype=np.float32)
+    for index, (_, blob, _) in enumerate(rows):
+        centroids[index] = np.frombuffer(blob, dtype=np.float32)
+    weights = np.array([float(weight) for _, _, weight in rows], dtype=np.float64)
+    return cluster_ids, centroids, weights
+
+
+def nearest_centroids(vectors: np.ndarray, centroids: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # Nearest centroid by squared distance, without materialising the difference tensor.
+    scores = vectors @ centroids.T - 0.5 * np.sum(centroids * centroids, axis=1)
+    labels = np.argmax(scores, axis=1)
+    best = scores[np.arange(len(labels)), labels]
+    distances = np.maximum(np.sum(vectors * vectors, axis=1) - 2.0 * best, 0.0)
+    return labels, distances
+
+
+def assigned_distances(
+    vectors: np.ndarray, centroids: np.ndarray, labels: np.ndarray
+) -> np.ndarray:
+    distances = np.empty(len(labels), dtype=np.float64)
+    for start in range(0, len(labels), 4096):
+        chunk = slice(start, start + 4096)
+        delta = vectors[chunk] - centroids[labels[chunk]]
+        distances[chunk] = np.sum(delta * delta, axis=1)
+    return distances
+
+
+def partial_fit_centroids(
+    centroids: np.ndarray,
+    weights: np.ndarray,
+    labels: np.ndarray,
+    vectors: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray]:
+    # Same per-centre running mean as MiniBatchKMeans.partial_fit: the more a centre has
+    # absorbed, the less one new sample moves it.
+    counts = np.bincount(labels, minlength=len(centroids)).astype(np.float64)
+    sums = np.zeros(centroids.shape, dtype=np.float64)
+    np.add.at(sums, labels, vectors)
+    totals = weights + counts
+    updated = centroids.astype(np.float64)
+    touched = counts > 0
+    updated[touched] = (updated[touched] * weights[touched, None] + sums[touched]) / totals[
+        touched, None
+    ]
+    return updated.astype(np.float32), totals
+
+
+def match_cluster_ids(
+    old_ids: np.ndarray,
+    old_centroids: np.ndarray,
+    new_centroids: np.ndarray,
+) -> np.ndarray:
+    # Refits keep the id of the closest previous centre, so a refit does not renumber clusters.
+    linear_sum_assignment = importlib.import_module("scipy.optimize").linear_sum_assignment
+
+    next_id = int(old_ids.max()) + 1 if old_ids.size else 0
+    new_ids = np.full(len(new_centroids), -1, dtype=np.int64)
+    if old_ids.size:
+        cost = (
+            np.sum(new_centroids * new_centroids, axis=1)[:, None]
+            - 2.0 * new_centroids @ old_centroids.T
+            + np.sum(old_centroids * old_centroids, axis=1)[None, :]
+        )
+        new_rows, old_cols = linear_sum_assignment(cost)
+        new_ids[new_rows] = old_ids[old_cols]
+    for index in np.flatnonzero(new_ids < 0):
+        new_ids[index] = next_id
+        next_id += 1
+    return new_ids
+
+
+def refit_reason(
+    model: ClusterModel | None,
+    model_key: str,
+    cluster_ids: np.ndarray,
+    target_k: int,
+    explicit_k: bool,
+    changed_images: int,
+) -> str:
+    if model is None or model.model != model_key or cluster_ids.size == 0:
+        return "initial"
+    if explicit_k and target_k != model.cluster_count:
+        return "cluster_count"
+    if not explicit_k and abs(target_k - model.cluster_count) > CLUSTER_K_TOLERANCE * max(
+        model.cluster_count, 1
+    ):
+        return "corpus_size"
+    if model.changed_images + changed_images > CLUSTER_CHURN_FRACTION * max(model.fitted_images, 1):
+        return "churn"
+    return ""
+
+
+def write_clusters(
+    conn: sqlite3.Connection,
+    item_rows: list[tuple[str, str, str, int, int, int]],
+    removed_paths: list[str],
+    cluster_ids: np.ndarray,
+    centroids: np.ndarray,
+    weights: np.ndarray,
+    model: ClusterModel,
+    summaries: list[tuple[list[dict], float]] | None = None,
+) -> None:
+    if summaries is None:
+        # Incremental assignment sees only the new images; keep the last full summary.
+        stored = {
+            int(cluster_id): (json.loads(exemplars), float(spread))
+            for cluster_id, exemplars, spread in conn.execute(
+                "SELECT cluster_id, exemplars, spread FROM clip_cluster"
+            )
+        }
+        summaries = [stored.get(int(cluster_id), ([], 0.0)) for cluster_id in cluster_ids]
     with conn:
+        conn.executemany(
+            "DELETE FROM clip_item WHERE input_path = ?",
+            [(input_path,) for input_path in removed_paths],
+        )
         conn.executemany(
             """
-            INSERT INTO clip_embedding(input_path, model, mtime_ns, size_bytes, dim, vector, valid)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
+            INSERT INTO clip_item(input_path, series, source, cluster, mtime_ns, size_bytes)
+            VALUES (?, ?, ?, ?, ?, ?)
             ON CONFLICT(input_path) DO UPDATE SET
-                model = excluded.model,
+                series = excluded.series,
+                source = excluded.source,
+                cluster = excluded.cluster,
                 mtime_ns = excluded.mtime_ns,
-                size_bytes = excluded.size_bytes,
-                dim = excluded.dim,
-                vector = excluded.vector,
-                valid = excluded.valid
+                size_bytes = excluded.size_bytes
             """,
-            rows,
+            item_rows,
         )
-    conn.close()
-    return total, skipped
-
+        kept = {int(cluster_id) for cluster_id in cluster_ids}
+        conn.executemany(
+            "DELETE FROM clip_cluster WHERE cluster_id = ?",
+            [
+                (cluster_id,)
+                for (cluster_id,) in conn.execute("SELECT cluster_id FROM clip_cluster").fetchall()
+                if int(cluster_id) not in kept
+            ],
+        )
+        conn.executemany(
+            """
+            INSERT INTO clip_cluster(cluster_id, count, centroid, weight, exemplars, spread)
+            VALUES (?, 0, ?, ?, ?, ?)
+            ON CONFLICT(cluster_id) DO UPDATE SET
+                centroid = excluded.centroid,
+                weight = excluded.weight,
+                exemplars = excluded.exemplars,
+                spread = excluded.spread
+            """,
+            [
+                (
+                    int(cluster_id),
+                    centroid.tobytes(),
+                    float(weight),
+                    json.dumps(exemplars),
+                    spread,
+                )
+                for cluster_id, centroid, weight, (exemplars, spread) in zip(
+                    cluster_ids, centroids, weights, summaries, strict=True
+                )
+            ],
+        )
+        refresh_cluster_counts(conn)
+        write_cluster_model(conn, model)
+    refresh_cluster_tags(conn)
 
-def resolve_embeddings(
-    paths: list[str],
-    db_path: Path,
-    model_name: str,
-    batch_size: int,
-) -> tuple[np.ndarray, np.ndarray, dict]:
-    path_stats: dict[str, tuple[int, int]] = {}
-    for path in paths:
-        try:
-            stat = Path(path).stat()
-            path_stats[path] = (int(stat.st_mtime_ns), int(stat.st_size))
-        except OSError:
-            path_stats[path] = (0, 0)
 
-    init_db(db_path)
-    conn = sqlite3.connect(db_path)
-    cache_rows = conn.execute(
-        "SELECT input_path, model, mtime_ns, size_bytes, dim, vector, valid FROM clip_embedding",
-    ).fetchall()
-    cached_meta: dict[str, tuple[str, int, int, int, int, bool]] = {}
-    for input_path, model, mtime_ns, size_bytes, dim, vector_blob, valid in cache_rows:
-        dim_value = int(dim)
-        valid_value = int(valid)
-        has_nonzero_vector = False
-        if dim_value == CLIP_EMBED_DIM:
-            vector = np.frombuffer(vector_blob, dtype=np.float32)
-            if vector.size == dim_value:
-                norm = float(np.linalg.norm(vector))
-                has_nonzero_vector = np.isfinite(norm) and norm > 0
-        cached_meta[input_path] = (
-            model,
-            int(mtime_ns),
-            int(size_bytes),
-            dim_value,
-            valid_value,
-            has_nonzero_vector,
-        )
-    needs_embed = [
-        path
-        for path in paths
-        if (
-            cached_meta.get(path) is None
-            or cached_meta[path][0] != model_name
-            or cached_meta[path][1] != path_stats[path][0]
-            or cached_meta[path][2] != path_stats[path][1]
-            or cached_meta[path][3] != CLIP_EMBED_DIM
-            or cached_meta[path][4] not in (0, 1)
-            or (cached_meta[path][4] == 1 and not cached_meta[path][5])
+def refresh_cluster_counts(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        """
+        UPDATE clip_cluster SET count = (
+            SELECT COUNT(*) FROM clip_item WHERE clip_item.cluster = clip_cluster.cluster_id
         )
-    ]
-    cached_images = len(paths) - len(needs_embed)
+        """
+    )
 
+
+def summarize_clusters(
+    vectors: np.ndarray, labels: np.ndarray, paths: list[str], cluster_count: int
+) -> list[tuple[list[dict], float]]:
+    counts = np.bincount(labels, minlength=cluster_count)
+    order = np.argsort(labels, kind="stable")
+    starts = np.cumsum(counts) - counts
+    # Means of the current members, not the stored centroids, which drift under partial fits.
+    # The member nearest the mean is then the squared-distance medoid.
+    means = np.zeros((cluster_count, vectors.shape[1]), dtype=np.float64)
+    present = np.flatnonzero(counts)
+    means[present] = np.add.reduceat(vectors[order], starts[present], axis=0, dtype=np.float64)
+    means[present] /= counts[present, None]
+    distances = assigned_distances(vectors, means.astype(np.float32), labels)
+    spread = np.sqrt(
+        np.bincount(labels, weights=distances, minlength=cluster_count) / np.maximum(counts, 1)
+    )
+    central = np.lexsort((distances, labels))
+    summaries = []
+    for label in range(cluster_count):
+        members = central[starts[label] : starts[label] + min(counts[label], CLUSTER_EXEMPLARS)]
+        exemplars = [
+            {"input_path": paths[member], "distance": round(float(np.sqrt(distances[member])), 4)}
+            for member in members
+        ]
+        summaries.append((exemplars, round(float(spread[label]), 4)))
+    return summaries
+
+
+def refresh_cluster_tags(conn: sqlite3.Connection) -> None:
+    # tag_assignment belongs to the review tables; a pipeline-only database has no labels yet.
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'tag_assignment'").fetchone():
+        return
+    top_tags: dict[int, list[dict]] = {}
+    for cluster_id, tag, count in conn.execute(
+        """
+        SELECT clip_item.cluster, tag_assignment.tag, COUNT(*) AS tagged
+        FROM tag_assignment JOIN clip_item USING(input_path)
+        WHERE tag_assignment.source = 'human'
+        GROUP BY clip_item.cluster, tag_assignment.tag
+        ORDER BY clip_item.cluster, tagged DESC, tag_assignment.tag
+        """
+    ):
+        entries = top_tags.setdefault(int(cluster_id), [])
+        if len(entries) < CLUSTER_TOP_TAGS:
+            entries.append({"tag": tag, "count": int(count)})
     with conn:
-        conn.execute("CREATE TEMP TABLE current_path(input_path TEXT PRIMARY KEY)")
         conn.executemany(
-            "INSERT INTO current_path(input_path) VALUES (?)",
-            [(input_path,) for input_path in paths],
+            "UPDATE clip_cluster SET top_tags = ? WHERE cluster_id = ?",
+            [
+                (json.dumps(top_tags.get(int(cluster_id), [])), int(cluster_id))
+                for (cluster_id,) in conn.execute("SELECT cluster_id FROM clip_cluster").fetchall()
+            ],
         )
-        deleted_rows = conn.execute(
+
+
+def cluster_items(
+    rows: list[dict],
+    embeddings: np.ndarray,
+    valid_mask: np.ndarray,
+    db_path: Path,
+    cluster_count: int,
+    model_key: str = MODEL_NAME,
+) -> dict:
+    valid_indices = np.flatnonzero(valid_mask)
+    valid_images = int(valid_indices.size)
+    if valid_images < 2:
+        raise ValueError("Found fewer than 2 valid screenshot images for CLIP clustering.")
+    target_k = cluster_count if cluster_count > 0 else default_cluster_count(valid_images)
+    target_k = min(target_k, valid_images)
+    update_status(
+        db_path,
+        stage="clustering",
+        valid_images=valid_images,
+        invalid_images=len(rows) - valid_images,
+    )
+
+    conn = database.connect(db_path)
+    model = read_cluster_model(conn)
+    cluster_ids, centroids, weights = load_centroids(conn)
+    existing = {
+        input_path: (series, source, int(cluster), int(mtime_ns), int(size_bytes))
+        for input_path, series, source, cluster, mtime_ns, size_bytes in conn.execute(
+            "SELECT input_path, series, source, cluster, mtime_ns, size_bytes FROM clip_item"
+        )
+    }
+    load_temp_paths(conn, "cluster_path", [row["input_path"] for row in rows])
+    embedded_stats = {
+        input_path: (int(mtime_ns), int(size_bytes))
+        for input_path, mtime_ns, size_bytes in conn.execute(
             """
-            DELETE FROM clip_embedding
-            WHERE NOT EXISTS (
-                SELECT 1 FROM current_path
-                WHERE current_path.input_path = clip_embedding.input_path
-            )
+            SELECT clip_embedding.input_path, clip_embedding.mtime_ns, clip_embedding.size_bytes
+            FROM clip_embedding JOIN cluster_path USING(input_path)
             """
-        ).rowcount
-        conn.execute("DROP TABLE current_path")
-    conn.close()
+        )
+    }
 
-    embedded_images, skipped_images = embed_images(
-        needs_embed,
-        path_stats=path_stats,
-        db_path=db_path,
-        model_name=model_name,
-        batch_size=batch_size,
-        cached_images=cached_images,
+    vectors = embeddings[valid_mask]
+    valid_rows = [rows[int(row_idx)] for row_idx in valid_indices]
+    current = {row["input_path"] for row in valid_rows}
+    removed_paths = [input_path for input_path in existing if input_path not in current]
+    known_ids = {int(cluster_id): index for index, cluster_id in enumerate(cluster_ids)}
+    changed = np.zeros(len(valid_rows), dtype=bool)
+    labels = np.zeros(len(valid_rows), dtype=np.int64)
+    for index, row in enumerate(valid_rows):
+        item = existing.get(row["input_path"])
+        stats = embedded_stats.get(row["input_path"], (0, 0))
+        if item is None or item[2] not in known_ids or item[3:] != stats:
+            changed[index] = True
+        else:
+            labels[index] = known_ids[item[2]]
+    changed_images = int(changed.sum()) + len(removed_paths)
+    reason = refit_reason(
+        model, model_key, cluster_ids, target_k, cluster_count > 0, changed_images
     )
 
-    conn = sqlite3.connect(db_path)
-    embedding_rows = conn.execute(
-        "SELECT input_path, dim, vector, valid FROM clip_embedding",
-    ).fetchall()
-    conn.close()
-    vectors_by_path = {}
-    valid_by_path = {}
-    for input_path, _, vector_blob, valid in embedding_rows:
-        vectors_by_path[input_path] = np.frombuffer(vector_blob, dtype=np.float32)
-        valid_by_path[input_path] = bool(int(valid))
-
-    vectors = []
-    valid_mask: list[bool] = []
-    for path in paths:
-        vector = vectors_by_path.get(path)
-        if vector is None:
-            raise ValueError(f"Missing CLIP vector for {path}")
-        vectors.append(vector)
-        valid_mask.append(valid_by_path[path])
-    embeddings = np.vstack(vectors).astype(np.float32)
-    valid_array = np.asarray(valid_mask, dtype=bool)
-    return (
-        embeddings,
-        valid_array,
-        {
-            "embedded_images": embedded_images,
-            "cached_images": cached_images,
-            "deleted_rows": int(deleted_rows),
-            "skipped_images": skipped_images,
-            "valid_images": int(valid_array.sum()),
-            "invalid_images": int((~valid_array).sum()),
-        },
+    drift = 0.0
+    if model is not None and not reason:
+        if changed.any():
+            labels[changed], _ = nearest_centroids(vectors[changed], centroids)
+            centroids, weights = partial_fit_centroids(
+                centroids, weights, labels[changed], vectors[changed]
+            )
+        mean_distance = float(assigned_distances(vectors, centroids, labels).mean())
+        drift = mean_distance / model.baseline_distance if model.baseline_distance > 0 else 0.0
+        if drift > CLUSTER_DRIFT_RATIO:
+            reason = "drift"
+        else:
+            model = replace(model, changed_images=model.changed_images + changed_images)
+
+    if reason:
+        mini_batch_k_means = importlib.import_module("sklearn.cluster").MiniBatchKMeans
+        clusterer = mini_batch_k_means(
+            n_clusters=target_k,
+            random_state=0,
+            batch_size=max(256, min(4096, target_k * 16)),
+            n_init="auto",
+        )
+        labels = clusterer.fit_predict(vectors)
+        new_centroids = clusterer.cluster_centers_.astype(np.float32)
+        cluster_ids = match_cluster_ids(cluster_ids, centroids, new_centroids)
+        centroids = new_centroids
+        weights = np.bincount(labels, minlength=target_k).astype(np.float64)
+        mean_distance = float(assigned_distances(vectors, centroids, labels).mean())
+        model = ClusterModel(model_key, target_k, valid_images, mean_distance, 0, now_iso())
+
+    item_rows = []
+    for row, label in zip(valid_rows, labels, strict=True):
+        input_path = row["input_path"]
+        item = (
+            row["series"],
+            row["source"],
+            int(cluster_ids[label]),
+            *embedded_stats.get(input_path, (0, 0)),
+        )
+        if existing.get(input_path) != item:
+            item_rows.append((input_path, *item))
+    summaries = summarize_clusters(
+        vectors, labels, [row["input_path"] for row in valid_rows], len(cluster_ids)
+    )
+    write_clusters(
+        conn, item_rows, removed_paths, cluster_ids, centroids, weights, model, summaries
     )
+    conn.close()
+    return {
+        "cluster_count": int(len(cluster_ids)),
+        "mode": "refit" if reason else "incremental",
+        "refit_reason": reason,
+        "drift": round(drift, 4),
+        "changed_images": changed_images,
+        "updated_rows": len(item_rows),
+        "removed_rows": len(removed_paths),
+    }
 
 
 def run(
     config_path: Path,
     db_path: Path,
     model_name: str = MODEL_NAME,
-    batch_size: int = 24,
+    batch_size: int = DEFAULT_BATCH_SIZE,
     cluster_count: int = 0,
+    backend: BackendConfig = BackendConfig(),
 ) -> dict:
-    mini_batch_k_means = importlib.import_module("sklearn.cluster").MiniBatchKMeans
-
+    model_key = backend.model_key(model_name)
+    previous = read_status(db_path, default={})
     init_db(db_path)
     update_status(
         db_path,
         stage="scanning",
         error="",
         started_at=now_iso(),
-        model=model_name,
+        # A full run covers whatever a cancelled ingest left behind.
+        ingest_pending={},
         processed_images=0,
         total_images=0,
+        stage_progress={},
         rate_images_per_second=0.0,
         eta_seconds=0,
     )
 
-    rows, source_stats, source_roots = resolve_screenshot_records(config_path)
+    sources = screenshot_sources(config_path, db_path)
+    rows, source_stats, source_roots = resolve_screenshot_records(db_path, sources)
     total_images = len(rows)
-    signature = records_signature(rows)
+    signature = records_signature(sources)
+    completed = completed_stages(previous, signature, model_key)
+    if cluster_count > 0 and previous.get("cluster_count") != cluster_count:
+        completed = [stage for stage in completed if stage == "embedding"]
     update_status(
         db_path,
         stage="scanning",
+        model=model_key,
         source_stats=source_stats,
         source_roots=source_roots,
         total_images=total_images,
         records_signature=signature,
+        completed_stages=list(completed),
+        resume_stage=next_stage(completed),
+        resumed=bool(completed),
     )
     if total_images < 2:
         raise ValueError("Found fewer than 2 screenshot images.")
 
     paths = [row["input_path"] for row in rows]
-    embeddings, valid_mask, clip_stats = resolve_embeddings(
-        paths,
-        db_path=db_path,
-        model_name=model_name,
-        batch_size=batch_size,
-    )
+    k = int(previous.get("cluster_count") or 0)
+    ocr_stats: dict | None = None
+    jobs.checkpoint()
+    if "clustering" not in completed:
+        if not concurrent_pipeline(completed):
+            embeddings, valid_mask, clip_stats = resolve_embeddings(
+                paths,
+                db_path=db_path,
+                model_name=model_name,
+                batch_size=batch_size,
+                backend=backend,
+            )
+        else:
+            embeddings, valid_mask, clip_stats, ocr_stats = index_concurrently(
+                paths,
+                db_path=db_path,
+                model_name=model_name,
+                batch_size=batch_size,
+                backend=backend,
+            )
+        if "embedding" not in completed:
+            mark_stage_done(
+                db_path,
+                completed,
+                "embedding",
+                clip_embedded_images=clip_stats["embedded_images"],
+                clip_cached_images=clip_stats["cached_images"],
+                clip_reused_images=clip_stats["reused_images"],
+                content_hashed_files=clip_stats["hashed_files"],
+                content_duplicate_files=clip_stats["duplicate_files"],
+                clip_deleted_embeddings=clip_stats["deleted_rows"],
+                clip_skipped_images=clip_stats["skipped_images"],
+                clip_valid_images=clip_stats["valid_images"],
+                clip_invalid_images=clip_stats["invalid_images"],
+                clip_matrix=clip_stats["matrix"],
+                clip_ann=clip_stats["ann"],
+            )
+        jobs.checkpoint()
+        cluster_stats = cluster_items(
+            rows, embeddings, valid_mask, db_path, cluster_count, model_key=model_key
+        )
+        k = cluster_stats["cluster_count"]
+        mark_stage_done(
+            db_path,
+            completed,
+            "clustering",
+            cluster_count=k,
+            cluster_mode=cluster_stats["mode"],
+            cluster_refit_reason=cluster_stats["refit_reason"],
+            cluster_drift=cluster_stats["drift"],
+            cluster_changed_images=cluster_stats["changed_images"],
+            cluster_updated_rows=cluster_stats["updated_rows"],
+        )
 
-    valid_indices = np.flatnonzero(valid_mask)
-    valid_images = int(valid_indices.size)
-    if valid_images < 2:
-        raise ValueError("Found fewer than 2 valid screenshot images for CLIP clustering.")
-    k = cluster_count if cluster_count > 0 else default_cluster_count(valid_images)
-    update_status(
-        db_path,
-        stage="clustering",
-        cluster_count=k,
-        valid_images=valid_images,
-        invalid_images=total_images - valid_images,
-    )
-    clusterer = mini_batch_k_means(
-        n_clusters=k,
-        random_state=0,
-        batch_size=max(256, min(4096, k * 16)),
-        n_init="auto",
-    )
-    labels = clusterer.fit_predict(embeddings[valid_mask])
-    counts = Counter(int(label) for label in labels)
-
-    clip_rows = []
-    for label_idx, row_idx in enumerate(valid_indices):
-        row = rows[int(row_idx)]
-        clip_rows.append(
-            (
-                row["input_path"],
-                row["series"],
-                row["source"],
-                int(labels[label_idx]),
+    jobs.checkpoint()
+    if "ocr" not in completed:
+        if ocr_stats is None:
+            update_status(
+                db_path,
+                stage="ocr",
+                processed_images=0,
+                total_images=total_images,
+                rate_images_per_second=0.0,
+                eta_seconds=0,
+            )
+            ocr_stats = sync_ocr_db(
+                config_path=config_path,
+                db_path=db_path,
+                paths=paths,
+                progress=lambda done, total, rate, eta: update_status(
+                    db_path,
+                    stage="ocr",
+                    stage_progress={"ocr": progress_entry(done, total, rate, eta)},
+                    processed_images=done,
+                    total_images=total,
+                    rate_images_per_second=round(rate, 3),
+                    eta_seconds=eta,
+                ),
             )
+        mark_stage_done(
+            db_path,
+            completed,
+            "ocr",
+            ocr_new_rows=ocr_stats["new_rows"],
+            ocr_workers=ocr_stats["workers"],
+            ocr_engine=ocr_stats["engine"],
+            ocr_modes=ocr_stats["modes"],
+            ocr_skip_ratio=ocr_stats["skip_ratio"],
+            ocr_reused_rows=ocr_stats["reused_rows"],
+            ocr_deleted_rows=ocr_stats["deleted_rows"],
+            ocr_skipped_rows=ocr_stats["skipped_rows"],
+            ocr_total_rows=ocr_stats["total_rows"],
         )
-    cluster_rows = [(int(cluster_id), int(count)) for cluster_id, count in sorted(counts.items())]
-    conn = sqlite3.connect(db_path)
-    with conn:
-        conn.execute("DELETE FROM clip_item")
-        conn.execute("DELETE FROM clip_cluster")
-        conn.executemany(
-            "INSERT INTO clip_item(input_path, series, source, cluster) VALUES (?, ?, ?, ?)",
-            clip_rows,
+    jobs.checkpoint()
+    if "duplicates" not in completed:
+        update_status(
+            db_path,
+            stage="duplicates",
+            processed_images=0,
+            total_images=total_images,
+            rate_images_per_second=0.0,
+            eta_seconds=0,
         )
-        conn.executemany(
-            "INSERT INTO clip_cluster(cluster_id, count) VALUES (?, ?)",
-            cluster_rows,
+        duplicate_stats = find_duplicates(
+            db_path,
+            paths,
+            progress=lambda done, total: (
+                update_status(
+                    db_path,
+                    stage_progress={"duplicates": progress_entry(done, total, 0.0, 0)},
+                    processed_images=done,
+                    total_images=total,
+                )
+                if done % 64 == 0 or done == total
+                else None
+            ),
         )
-    conn.close()
-
-    update_status(
-        db_path,
-        stage="ocr",
-        processed_images=0,
-        total_images=total_images,
-        rate_images_per_second=0.0,
-        eta_seconds=0,
-    )
-    ocr_stats = sync_ocr_db(
-        config_path=config_path,
-        db_path=db_path,
-        paths=paths,
-        progress=lambda done, total, rate, eta: update_status(
+        mark_stage_done(
             db_path,
-            stage="ocr",
-            processed_images=done,
-            total_images=total,
-            rate_images_per_second=round(rate, 3),
-            eta_seconds=eta,
-        ),
-    )
+            completed,
+            "duplicates",
+            duplicate_hashed_images=duplicate_stats["hashed_images"],
+            duplicate_reused_hashes=duplicate_stats["reused_hashes"],
+            duplicate_flat_images=duplicate_stats["flat_images"],
+            duplicate_candidate_pairs=duplicate_stats["candidate_pairs"],
+            duplicate_confirmed_pairs=duplicate_stats["confirmed_pairs"],
+            duplicate_groups=duplicate_stats["groups"],
+            duplicate_grouped_images=duplicate_stats["grouped_images"],
+        )
     return update_status(
         db_path,
         stage="done",
@@ -613,44 +2707,283 @@ def run(
         source_stats=source_stats,
         source_roots=source_roots,
         records_signature=signature,
-        clip_embedded_images=clip_stats["embedded_images"],
-        clip_cached_images=clip_stats["cached_images"],
-        clip_deleted_embeddings=clip_stats["deleted_rows"],
-        clip_skipped_images=clip_stats["skipped_images"],
-        clip_valid_images=clip_stats["valid_images"],
-        clip_invalid_images=clip_stats["invalid_images"],
-        ocr_new_rows=ocr_stats["new_rows"],
-        ocr_deleted_rows=ocr_stats["deleted_rows"],
-        ocr_skipped_rows=ocr_stats["skipped_rows"],
-        ocr_total_rows=ocr_stats["total_rows"],
         rate_images_per_second=0.0,
         eta_seconds=0,
     )
 
 
-def _run_job(config_path: Path, db_path: Path, model_name: str, batch_size: int) -> None:
+def remove_paths(conn: sqlite3.Connection, paths: list[str]) -> int:
+    with conn:
+        for table in ("clip_embedding", "clip_item", "ocr_doc", "file_digest", "image_hash"):
+            conn.executemany(
+                f"DELETE FROM {table} WHERE input_path = ?",
+                [(input_path,) for input_path in paths],
+            )
+    return len(paths)
+
+
+def assign_clusters(conn: sqlite3.Connection, records: list[dict]) -> int:
+    model = read_cluster_model(conn)
+    cluster_ids, centroids, weights = load_centroids(conn)
+    if model is None or not cluster_ids.size or not records:
+        return 0
+
+    load_temp_paths(conn, "ingest_path", [record["input_path"] for record in records])
+    embedded = conn.execute(
+        """
+        SELECT clip_embedding.input_path, clip_embedding.vector,
+               clip_embedding.mtime_ns, clip_embedding.size_bytes
+        FROM ingest_path
+        JOIN clip_embedding ON clip_embedding.input_path = ingest_path.input_path
+        WHERE clip_embedding.valid = 1 AND length(clip_embedding.vector) = ?
+        """,
+        (CLIP_EMBED_DIM * 4,),
+    ).fetchall()
+    item_rows = []
+    if embedded:
+        vectors = np.frombuffer(
+            bytearray().join(vector_blob for _, vector_blob, _, _ in embedded),
+            dtype=np.float32,
+        ).reshape(len(embedded), CLIP_EMBED_DIM)
+        labels, _ = nearest_centroids(vectors, centroids)
+        centroids, weights = partial_fit_centroids(centroids, weights, labels, vectors)
+        by_path = {record["input_path"]: record for record in records}
+        for (input_path, _, mtime_ns, size_bytes), label in zip(embedded, labels, strict=True):
+            record = by_path[input_path]
+            item_rows.append(
+                (
+                    input_path,
+                    record["series"],
+                    record["source"],
+                    int(cluster_ids[label]),
+                    int(mtime_ns),
+                    int(size_bytes),
+                )
+            )
+    assigned = {row[0] for row in item_rows}
+    unassigned = [
+        record["input_path"] for record in records if record["input_path"] not in assigned
+    ]
+    write_clusters(
+        conn,
+        item_rows,
+        unassigned,
+        cluster_ids,
+        centroids,
+        weights,
+        replace(model, changed_images=model.changed_images + len(records)),
+    )
+    return len(item_rows)
+
+
+def ingest_changes(
+    config_path: Path,
+    db_path: Path,
+    dirs: set[str] | None = None,
+    model_name: str = MODEL_NAME,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    backend: BackendConfig = BackendConfig(),
+) -> dict | None:
+    if not _RUN_LOCK.acquire(blocking=False):
+        return None
+    control = None
+    state, error, processed = "error", "", 0
     try:
-        run(
-            config_path=config_path,
-            db_path=db_path,
-            model_name=model_name,
-            batch_size=batch_size,
+        status = read_status(db_path, default={})
+        sources = screenshot_sources(config_path, db_path, dirs=dirs)
+        # The inventory already records a cancelled ingest's changes, so they are carried over
+        # in the status and retried with the next batch.
+        pending = status.get("ingest_pending") or {}
+        changed = {record["input_path"]: record for record in pending.get("records", [])}
+        gone = dict.fromkeys(pending.get("removed", []))
+        for source in sources:
+            for input_path in source.changed_paths:
+                changed[input_path] = {
+                    "series": source.series,
+                    "source": source.source,
+                    "input_path": input_path,
+                }
+                gone.pop(input_path, None)
+            for input_path in source.removed_paths:
+                gone[input_path] = None
+                changed.pop(input_path, None)
+        records = list(changed.values())
+        removed = list(gone)
+        if not records and not removed:
+            return {"ingested_images": 0, "removed_images": 0, "full_run": False}
+        model_key = backend.model_key(model_name)
+        if (
+            status.get("stage") != "done"
+            or status.get("model") != model_key
+            or not set(PIPELINE_STAGES) <= set(status.get("completed_stages", []))
+        ):
+            return {"ingested_images": 0, "removed_images": 0, "full_run": True}
+
+        paths = [record["input_path"] for record in records]
+        # Ingest batches are small, so they run outside the allowed windows but still yield
+        # to pause, cancel and the priority budget.
+        control = jobs.begin(db_path, "ingest", windowed=False)
+        path_stats = stat_paths(paths)
+        conn = database.connect(db_path)
+        try:
+            remove_paths(conn, removed)
+            with conn:
+                conn.executemany(
+                    "DELETE FROM ocr_doc WHERE input_path = ?",
+                    [(input_path,) for input_path in paths],
+                )
+            load_current_stats(conn, paths, path_stats)
+            needs_embed = stale_embedding_paths(conn, model_key)
+            update_file_digests(conn, paths, path_stats)
+            reused = reuse_clip_features(conn, needs_embed, path_stats, model_key)
+            needs_embed = [path for path in needs_embed if path not in reused]
+            needs_embed, duplicates = split_duplicates(
+                needs_embed, content_digests(conn, needs_embed)
+            )
+            embedded_images, skipped_images = embed_images(
+                needs_embed,
+                path_stats=path_stats,
+                db_path=db_path,
+                model_name=model_name,
+                batch_size=batch_size,
+                cached_images=len(paths) - len(needs_embed),
+                backend=backend,
+            )
+            reuse_clip_features(conn, duplicates, path_stats, model_key)
+            matrix_store.sync_store(conn, db_path, model_key, CLIP_EMBED_DIM)
+            ann.update_index(conn, db_path, model_key)
+            assigned = assign_clusters(conn, records)
+            if removed:
+                # assign_clusters only rewrites counts when something was assigned; deletions
+                # alone would leave them stale. Removed exemplars are filtered when read.
+                with conn:
+                    refresh_cluster_counts(conn)
+        finally:
+            conn.close()
+        ocr_stats = sync_ocr_db(config_path, db_path, paths=paths, prune=False)
+        duplicate_stats = find_duplicates(db_path, paths, prune=False, removed=removed)
+
+        source_stats, source_roots = describe_sources(sources)
+        total_images = sum(source.file_count for source in sources)
+        summary = {
+            "ingested_images": len(paths),
+            "removed_images": len(removed),
+            "embedded_images": embedded_images,
+            "skipped_images": skipped_images,
+            "assigned_images": assigned,
+            "ocr_new_rows": ocr_stats["new_rows"],
+            "duplicate_groups": duplicate_stats["groups"],
+            "full_run": False,
+        }
+        update_status(
+            db_path,
+            stage="done",
+            processed_images=total_images,
+            total_images=total_images,
+            source_stats=source_stats,
+            source_roots=source_roots,
+            records_signature=records_signature(sources),
+            rate_images_per_second=0.0,
+            eta_seconds=0,
+            ingested_images=int(status.get("ingested_images", 0)) + len(paths),
+            last_ingest_at=now_iso(),
+            last_ingest=summary,
+            ingest_pending={},
+        )
+        state, processed = "done", len(paths)
+        schedule_suggestions(db_path)
+        return summary
+    except jobs.JobCancelled:
+        # Only this batch stops: the library stays "done" so watching and scans carry on.
+        state = "cancelled"
+        update_status(
+            db_path,
+            stage="done",
+            error="",
+            processed_images=status.get("processed_images", 0),
+            total_images=status.get("total_images", 0),
+            rate_images_per_second=0.0,
+            eta_seconds=0,
+            ingest_pending={"records": records, "removed": removed},
         )
+        return {"ingested_images": 0, "removed_images": 0, "full_run": False}
+    except Exception as exc:
+        error = str(exc)
+        update_status(db_path, stage="error", error=error)
+        raise
+    finally:
+        if control is not None:
+            jobs.finish(control, state, error, processed)
+        _RUN_LOCK.release()
+
+
+def schedule_suggestions(db_path: Path) -> None:
+    from bruki.server import classifier
+
+    # New and changed images get model suggestions without waiting for the next label.
+    classifier.schedule_scoring(db_path)
+
+
+def _run_job(
+    config_path: Path,
+    db_path: Path,
+    model_name: str,
+    batch_size: int,
+    backend: BackendConfig,
+) -> None:
+    control = None
+    state, error = "error", ""
+    try:
+        with _RUN_LOCK:
+            control = jobs.begin(db_path, "scan")
+            run(
+                config_path=config_path,
+                db_path=db_path,
+                model_name=model_name,
+                batch_size=batch_size,
+                backend=backend,
+            )
+        state = "done"
+        schedule_suggestions(db_path)
+    except jobs.JobCancelled:
+        # Completed stages stay recorded, so the next start resumes from the cancelled stage.
+        state = "cancelled"
+        update_status(db_path, stage="cancelled", error="")
     except Exception as exc:
-        update_status(db_path, stage="error", error=str(exc))
+        error = str(exc)
+        update_status(db_path, stage="error", error=error)
+    finally:
+        if control is not None:
+            processed = read_status(db_path, default={}).get("processed_images", 0)
+            jobs.finish(control, state, error, int(processed or 0))
+        status_store.status_bus(db_path).flush()
 
 
-def start_job(config_path: Path, db_path: Path, model_name: str = MODEL_NAME) -> bool:
+def start_job(
+    config_path: Path,
+    db_path: Path,
+    model_name: str = MODEL_NAME,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    backend: BackendConfig = BackendConfig(),
+    force: bool = False,
+) -> bool:
     global _JOB_THREAD
     with _JOB_LOCK:
         status = read_status(db_path, default={})
         if _JOB_THREAD is not None and _JOB_THREAD.is_alive():
             return False
+        # A cancelled scan stays stopped across page loads and watcher ingests until resumed.
+        if status.get("stage") == "cancelled" and not force:
+            return False
         if status.get("stage") == "done":
-            rows, _, _ = resolve_screenshot_records(config_path)
-            current_signature = records_signature(rows)
+            current_signature = records_signature(screenshot_sources(config_path, db_path))
             has_validity_stats = "clip_valid_images" in status and "clip_invalid_images" in status
-            if status.get("records_signature") == current_signature and has_validity_stats:
+            same_model = status.get("model") == backend.model_key(model_name)
+            if (
+                status.get("records_signature") == current_signature
+                and has_validity_stats
+                and same_model
+            ):
                 return False
         thread = threading.Thread(
             target=_run_job,
@@ -658,7 +2991,8 @@ def start_job(config_path: Path, db_path: Path, model_name: str = MODEL_NAME) ->
                 "config_path": config_path,
                 "db_path": db_path,
                 "model_name": model_name,
-                "batch_size": 24,
+                "batch_size": batch_size,
+                "backend": backend,
             },
             daemon=True,
         )
@@ -668,32 +3002,67 @@ def start_job(config_path: Path, db_path: Path, model_name: str = MODEL_NAME) ->
 
 
 def get_status(config_path: Path, db_path: Path) -> dict:
-    payload = read_status(db_path, default={"stage": "idle"})
+    return describe_status(config_path, read_status(db_path, default={"stage": "idle"}))
+
+
+def describe_status(config_path: Path, payload: dict) -> dict:
+    payload = {"stage": "idle", **payload}
     if "source_roots" not in payload:
-        _, _, roots = resolve_screenshot_records(config_path)
-        payload["source_roots"] = roots
+        payload["source_roots"] = cached_screenshot_roots(config_path)
     if "source_stats" not in payload:
         payload["source_stats"] = []
     return payload
 
 
 def get_clusters(db_path: Path) -> list[dict]:
-    init_db(db_path)
-    conn = sqlite3.connect(db_path)
-    rows = conn.execute(
-        "SELECT cluster_id, count FROM clip_cluster ORDER BY cluster_id",
-    ).fetchall()
-    conn.close()
-    return [{"id": int(cluster_id), "count": int(count)} for cluster_id, count in rows]
+    with database.connection(db_path) as conn:
+        rows = conn.execute(
+            """
+            SELECT cluster_id, count, exemplars, spread, top_tags
+            FROM clip_cluster ORDER BY cluster_id
+            """
+        ).fetchall()
+        clusters = [
+            {
+                "id": int(cluster_id),
+                "count": int(count),
+                "exemplars": json.loads(exemplars),
+                "spread": float(spread),
+                "top_tags": json.loads(top_tags),
+            }
+            for cluster_id, count, exemplars, spread, top_tags in rows
+        ]
+        # Incremental ingest can remove an exemplar before the next clustering pass.
+        load_temp_paths(
+            conn,
+            "exemplar_path",
+            [entry["input_path"] for cluster in clusters for entry in cluster["exemplars"]],
+        )
+        present = {
+            input_path
+            for (input_path,) in conn.execute(
+                "SELECT input_path FROM exemplar_path JOIN clip_item USING(input_path)"
+            )
+        }
+    for cluster in clusters:
+        cluster["exemplars"] = [
+            entry for entry in cluster["exemplars"] if entry["input_path"] in present
+        ]
+        cluster["medoid"] = cluster["exemplars"][0]["input_path"] if cluster["exemplars"] else None
+    return clusters
+
+
+def get_duplicate_groups(db_path: Path) -> dict[str, int]:
+    with database.connection(db_path) as conn:
+        rows = conn.execute("SELECT input_path, group_id FROM duplicate_group").fetchall()
+    return {input_path: int(group_id) for input_path, group_id in rows}
 
 
 def get_items(db_path: Path) -> list[dict]:
-    init_db(db_path)
-    conn = sqlite3.connect(db_path)
-    rows = conn.execute(
-        "SELECT input_path, series, source, cluster FROM clip_item ORDER BY input_path",
-    ).fetchall()
-    conn.close()
+    with database.connection(db_path) as conn:
+        rows = conn.execute(
+            "SELECT input_path, series, source, cluster FROM clip_item ORDER BY input_path",
+        ).fetchall()
     return [
         {
             "input_path": input_path,
@@ -703,3 +3072,52 @@ def get_items(db_path: Path) -> list[dict]:
         }
         for input_path, series, source, cluster in rows
     ]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run the screenshot CLIP + OCR pipeline.")
+    parser.add_argument("-c", "--config", default="config.yaml", help="configuration file path")
+    parser.add_argument("--db", default="data/server/state.sqlite3", help="state database path")
+    parser.add_argument("--backend", choices=sorted(_BACKENDS), default="torch")
+    parser.add_argument("--quantize", action="store_true", help="use int8 weights")
+    parser.add_argument("-b", "--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument(
+        "--parity",
+        type=int,
+        default=0,
+        metavar="N",
+        help="compare N stored torch embeddings against --backend instead of running",
+    )
+    parser.add_argument(
+        "--ocr-bench",
+        type=int,
+        default=0,
+        metavar="N",
+        help="time the OCR engines on the same N screenshots instead of running",
+    )
+    args = parser.parse_args()
+
+    backend = BackendConfig(name=args.backend, quantize=args.quantize)
+    db_path = Path(args.db)
+    if args.parity > 0:
+        result = backend_parity(db_path, backend=backend, sample_size=args.parity)
+    elif args.ocr_bench > 0:
+        sources = screenshot_sources(Path(args.config), db_path)
+        records, _, _ = resolve_screenshot_records(db_path, sources)
+        result = ocr_benchmark(
+            [record["input_path"] for record in records],
+            engines=["pytesseract", "capi"],
+            sample_size=args.ocr_bench,
+        )
+    else:
+        result = run(
+            config_path=Path(args.config),
+            db_path=db_path,
+            batch_size=args.batch_size,
+            backend=backend,
+        )
+    print(json.dumps(result, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
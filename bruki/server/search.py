@@ -0,0 +1,176 @@
+import html
+import importlib
+import os
+import threading
+import time
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+
+from bruki.server import ann, database
+
+QUERY_CACHE_ENV = "TAGGER_QUERY_CACHE"
+DEFAULT_QUERY_CACHE = 512
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+SNIPPET_TOKENS = 16
+# Control characters cannot come out of tesseract, so they survive html.escape as markers.
+MARK_OPEN = "\x02"
+MARK_CLOSE = "\x03"
+
+_ENCODER_LOCK = threading.Lock()
+_ENCODERS: dict[str, "TextEncoder"] = {}
+
+
+class TextEncoder:
+    def __init__(self, model_name: str, local_files_only: bool = True) -> None:
+        torch = importlib.import_module("torch")
+        transformers = importlib.import_module("transformers")
+        self.torch = torch
+        self.tokenizer = transformers.CLIPTokenizer.from_pretrained(
+            model_name,
+            local_files_only=local_files_only,
+        )
+        # Only the text tower and its projection; the vision weights stay on disk.
+        model = transformers.CLIPTextModelWithProjection.from_pretrained(
+            model_name,
+            local_files_only=local_files_only,
+        )
+        model.eval()
+        self.model = model
+        self.lock = threading.Lock()
+
+    def encode(self, text: str) -> np.ndarray:
+        inputs = self.tokenizer([text], padding=True, truncation=True, return_tensors="pt")
+        with self.lock, self.torch.no_grad():
+            text_embeds = self.model(**inputs).text_embeds
+        vector = text_embeds.cpu().numpy()[0].astype(np.float32)
+        norm = float(np.linalg.norm(vector))
+        return vector / norm if norm > 0 else vector
+
+
+def base_model(model_key: str) -> str:
+    # Backend suffixes ("@onnx-int8") change how images were encoded, not the embedding space.
+    return model_key.split("@", 1)[0]
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.lower().split())
+
+
+def text_encoder(model_name: str) -> TextEncoder:
+    with _ENCODER_LOCK:
+        encoder = _ENCODERS.get(model_name)
+        if encoder is None:
+            encoder = TextEncoder(model_name)
+            _ENCODERS[model_name] = encoder
+        return encoder
+
+
+@lru_cache(maxsize=int(os.environ.get(QUERY_CACHE_ENV, DEFAULT_QUERY_CACHE)))
+def query_vector(model_name: str, query: str) -> np.ndarray:
+    vector = text_encoder(model_name).encode(query)
+    vector.setflags(write=False)
+    return vector
+
+
+def search(db_path: Path, query: str, offset: int = 0, limit: int = DEFAULT_LIMIT) -> dict:
+    started = time.perf_counter()
+    query = normalize_query(query)
+    if not query:
+        raise ValueError("query is empty")
+    index = ann.search_index(db_path)
+    if index is None:
+        raise LookupError(f"No CLIP matrix store next to {db_path}")
+    model_name = base_model(index.model)
+    hits_before = query_vector.cache_info().hits
+    vector = query_vector(model_name, query)
+    cached = query_vector.cache_info().hits > hits_before
+    encoded = time.perf_counter()
+    scores = index.dense @ vector
+    best = ann.ranked(scores, offset + limit)[offset:]
+    return {
+        "query": query,
+        "model": model_name,
+        "offset": offset,
+        "limit": limit,
+        "total": len(index.paths),
+        "next_offset": offset + limit if offset + limit < len(index.paths) else None,
+        "cached_query": cached,
+        "encode_ms": round(1000 * (encoded - started), 3),
+        "elapsed_ms": round(1000 * (time.perf_counter() - started), 3),
+        "items": [
+            {"input_path": index.paths[int(position)], "score": round(float(scores[position]), 6)}
+            for position in best
+        ],
+    }
+
+
+def fts_query(query: str) -> str:
+    # Every term is quoted so user input never reaches the FTS5 query grammar; "term*" keeps
+    # prefix matching.
+    terms = []
+    for term in normalize_query(query).split():
+        prefix = term.endswith("*")
+        term = term.rstrip("*").replace('"', '""')
+        if term:
+            terms.append(f'"{term}"' + ("*" if prefix else ""))
+    return " ".join(terms)
+
+
+def highlight(snippet: str) -> str:
+    return html.escape(snippet).replace(MARK_OPEN, "<mark>").replace(MARK_CLOSE, "</mark>")
+
+
+def search_ocr(db_path: Path, query: str, offset: int = 0, limit: int = DEFAULT_LIMIT) -> dict:
+    started = time.perf_counter()
+    match = fts_query(query)
+    if not match:
+        raise ValueError("query is empty")
+    with database.connection(db_path) as conn:
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'ocr_fts'").fetchone():
+            raise LookupError(f"No OCR full-text index in {db_path}")
+        total = conn.execute(
+            "SELECT COUNT(*) FROM ocr_fts WHERE ocr_fts MATCH ?",
+            (match,),
+        ).fetchone()[0]
+        hits = conn.execute(
+            """
+            SELECT rowid, rank FROM ocr_fts WHERE ocr_fts MATCH ?
+            ORDER BY rank LIMIT ? OFFSET ?
+            """,
+            (match, limit, offset),
+        ).fetchall()
+        # Snippets are built in a second pass so only the page being returned pays for them.
+        rowids = [rowid for rowid, _ in hits]
+        marks = ",".join("?" * len(rowids))
+        details = {
+            rowid: (input_path, snippet)
+            for rowid, input_path, snippet in conn.execute(
+                f"""
+                SELECT ocr_fts.rowid, ocr_doc.input_path,
+                       snippet(ocr_fts, 0, ?, ?, '…', ?)
+                FROM ocr_fts JOIN ocr_doc ON ocr_doc.rowid = ocr_fts.rowid
+                WHERE ocr_fts MATCH ? AND ocr_fts.rowid IN ({marks})
+                """,
+                (MARK_OPEN, MARK_CLOSE, SNIPPET_TOKENS, match, *rowids),
+            )
+        }
+    return {
+        "query": match,
+        "offset": offset,
+        "limit": limit,
+        "total": int(total),
+        "next_offset": offset + limit if offset + limit < total else None,
+        "elapsed_ms": round(1000 * (time.perf_counter() - started), 3),
+        "items": [
+            {
+                "input_path": details[rowid][0],
+                "score": round(-float(rank), 6),
+                "snippet": highlight(details[rowid][1]),
+            }
+            for rowid, rank in hits
+            if rowid in details
+        ],
+    }
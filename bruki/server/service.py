@@ -0,0 +1,421 @@
+import argparse
+import base64
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import deque
+from collections.abc import Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import numpy as np
+
+from bruki.server import ml as ml_pipeline
+
+DEFAULT_SERVICE_URL = "http://127.0.0.1:5010"
+SERVICE_URL_ENV = "TAGGER_EMBED_SERVICE"
+IDLE_EVICT_SECONDS = 600.0
+COALESCE_WAIT_SECONDS = 0.05
+REQUEST_CHUNK = 256
+REQUESTS_IN_FLIGHT = 2
+PROBE_TIMEOUT_SECONDS = 0.25
+REQUEST_TIMEOUT_SECONDS = 900.0
+
+logger = logging.getLogger(__name__)
+
+
+class ServiceError(RuntimeError):
+    pass
+
+
+@dataclass
+class PendingImage:
+    path: str
+    image: Future
+    done: threading.Event = field(default_factory=threading.Event)
+    vector: np.ndarray | None = None
+    error: str = ""
+
+
+class ResidentModel:
+    def __init__(
+        self,
+        model_name: str,
+        backend: ml_pipeline.BackendConfig,
+        cache_dir: Path,
+        batch_size: int,
+        decode_pool: ThreadPoolExecutor,
+    ) -> None:
+        self.model_key = backend.model_key(model_name)
+        self.encoder = ml_pipeline.load_backend(model_name, backend, cache_dir)
+        self.batch_size = batch_size
+        self.decode_pool = decode_pool
+        self.pending: queue.Queue[PendingImage] = queue.Queue()
+        self.last_used = time.monotonic()
+        self.images = 0
+        self.batches = 0
+        self._closed = threading.Event()
+        self._thread = threading.Thread(
+            target=self._serve,
+            name=f"embed:{self.model_key}",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def submit(self, paths: list[str]) -> list[PendingImage]:
+        self.last_used = time.monotonic()
+        items = [
+            PendingImage(path, self.decode_pool.submit(ml_pipeline.decode_image, path))
+            for path in paths
+        ]
+        for item in items:
+            self.pending.put(item)
+        return items
+
+    def idle_seconds(self) -> float:
+        return time.monotonic() - self.last_used
+
+    def close(self) -> None:
+        self._closed.set()
+        self._thread.join()
+
+    def _next_batch(self) -> list[PendingImage]:
+        try:
+            batch = [self.pending.get(timeout=1.0)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + COALESCE_WAIT_SECONDS
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.pending.get(timeout=max(deadline - time.monotonic(), 0.0)))
+            except queue.Empty:
+                break
+        return batch
+
+    def _serve(self) -> None:
+        while not self._closed.is_set():
+            batch = self._next_batch()
+            if not batch:
+                continue
+            try:
+                images = [item.image.result() for item in batch]
+                kept = [index for index, image in enumerate(images) if image is not None]
+                if kept:
+                    vectors = self.encoder.encode([images[index] for index in kept])
+                    for slot, index in enumerate(kept):
+                        batch[index].vector = vectors[slot]
+            except Exception as exc:
+                for item in batch:
+                    item.error = str(exc)
+            finally:
+                for item in batch:
+                    item.done.set()
+            self.images += len(batch)
+            self.batches += 1
+            self.last_used = time.monotonic()
+
+
+class EmbeddingService:
+    def __init__(
+        self,
+        cache_dir: Path,
+        batch_size: int = ml_pipeline.DEFAULT_BATCH_SIZE,
+        idle_seconds: float = IDLE_EVICT_SECONDS,
+        decode_workers: int = 0,
+    ) -> None:
+        self.cache_dir = cache_dir
+        self.batch_size = ml_pipeline.resolve_batch_size(batch_size)
+        self.idle_seconds = idle_seconds
+        self.decode_pool = ThreadPoolExecutor(
+            max_workers=decode_workers or ml_pipeline.default_decode_workers(),
+            thread_name_prefix="decode",
+        )
+        self._models: dict[str, ResidentModel] = {}
+        self._loading: dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def _load(
+        self,
+        model_key: str,
+        model_name: str,
+        backend: ml_pipeline.BackendConfig,
+        loading: Future,
+    ) -> None:
+        # Loading takes seconds to minutes; only requests for this model wait on it.
+        logger.info("loading %s", model_key)
+        try:
+            model = ResidentModel(
+                model_name,
+                backend,
+                self.cache_dir,
+                self.batch_size,
+                self.decode_pool,
+            )
+        except Exception as exc:
+            with self._lock:
+                del self._loading[model_key]
+            loading.set_exception(exc)
+            return
+        with self._lock:
+            self._models[model_key] = model
+            del self._loading[model_key]
+        loading.set_result(model)
+
+    def embed(
+        self,
+        model_name: str,
+        backend: ml_pipeline.BackendConfig,
+        paths: list[str],
+    ) -> tuple[str, np.ndarray, np.ndarray]:
+        model_key = backend.model_key(model_name)
+        while True:
+            with self._lock:
+                model = self._models.get(model_key)
+                if model is not None:
+                    items = model.submit(paths)
+                    break
+                loading = self._loading.get(model_key)
+                owner = loading is None
+                if owner:
+                    loading = Future()
+                    self._loading[model_key] = loading
+            if owner:
+                self._load(model_key, model_name, backend, loading)
+            # Re-checks the registry: the model may be evicted again before this request submits.
+            loading.result()
+
+        vectors = np.zeros((len(items), model.encoder.embed_dim), dtype=np.float32)
+        valid = np.zeros(len(items), dtype=bool)
+        for index, item in enumerate(items):
+            item.done.wait()
+            if item.error:
+                raise ServiceError(item.error)
+            if item.vector is not None and np.any(item.vector):
+                vectors[index] = item.vector
+                valid[index] = True
+        return model_key, vectors, valid
+
+    def evict_idle(self) -> list[str]:
+        evicted: list[ResidentModel] = []
+        with self._lock:
+            for model_key, model in list(self._models.items()):
+                if model.pending.empty() and model.idle_seconds() >= self.idle_seconds:
+                    evicted.append(self._models.pop(model_key))
+        for model in evicted:
+            logger.info("evicting idle %s", model.model_key)
+            model.close()
+        return [model.model_key for model in evicted]
+
+    def status(self) -> dict:
+        with self._lock:
+            models = list(self._models.values())
+            loading = sorted(self._loading)
+        return {
+            "status": "ok",
+            "batch_size": self.batch_size,
+            "idle_evict_seconds": self.idle_seconds,
+            "loading": loading,
+            "models": [
+                {
+                    "model": model.model_key,
+                    "images": model.images,
+                    "batches": model.batches,
+                    "queued": model.pending.qsize(),
+                    "idle_seconds": round(model.idle_seconds(), 1),
+                }
+                for model in models
+            ],
+        }
+
+
+class EmbeddingServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], service: EmbeddingService) -> None:
+        super().__init__(address, ServiceHandler)
+        self.service = service
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    server: EmbeddingServer
+
+    def log_message(self, format: str, *args: object) -> None:
+        logger.debug(format, *args)
+
+    def _send_json(self, status: int, payload: dict) -> None:
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        if self.path != "/health":
+            self._send_json(404, {"error": "not found"})
+            return
+        self._send_json(200, self.server.service.status())
+
+    def do_POST(self) -> None:
+        if self.path != "/embed":
+            self._send_json(404, {"error": "not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", "0"))
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self._send_json(400, {"error": "invalid JSON body"})
+            return
+        paths = body.get("paths")
+        if not isinstance(paths, list) or any(not isinstance(path, str) for path in paths):
+            self._send_json(400, {"error": "paths must be a list of strings"})
+            return
+        backend = ml_pipeline.BackendConfig(
+            name=str(body.get("backend", "torch")),
+            quantize=bool(body.get("quantize", False)),
+        )
+        model_name = str(body.get("model", ml_pipeline.MODEL_NAME))
+        try:
+            model_key, vectors, valid = self.server.service.embed(model_name, backend, paths)
+        except (ServiceError, ValueError, OSError) as exc:
+            self._send_json(500, {"error": str(exc)})
+            return
+        except Exception as exc:
+            # Model loading can fail with ImportError or a torch RuntimeError; the client
+            # still gets an answer instead of a dropped connection.
+            logger.exception("embedding failed")
+            self._send_json(500, {"error": f"{type(exc).__name__}: {exc}"})
+            return
+        self._send_json(
+            200,
+            {
+                "model": model_key,
+                "dim": int(vectors.shape[1]),
+                "vectors": base64.b64encode(vectors.tobytes()).decode("ascii"),
+                "valid": valid.tolist(),
+            },
+        )
+
+
+def service_url() -> str | None:
+    value = os.environ.get(SERVICE_URL_ENV, DEFAULT_SERVICE_URL).strip()
+    if value.lower() in {"", "0", "false", "no", "off"}:
+        return None
+    return value.rstrip("/")
+
+
+class ServiceClient:
+    def __init__(self, url: str) -> None:
+        self.url = url
+
+    def embed(
+        self,
+        paths: list[str],
+        model_name: str,
+        backend: ml_pipeline.BackendConfig,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        body = {
+            "model": model_name,
+            "backend": backend.name,
+            "quantize": backend.quantize,
+            "paths": [str(Path(path).resolve()) for path in paths],
+        }
+        request = urllib.request.Request(
+            f"{self.url}/embed",
+            data=json.dumps(body).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+            method="POST",
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=REQUEST_TIMEOUT_SECONDS) as response:
+                payload = json.loads(response.read())
+        except urllib.error.HTTPError as exc:
+            raise ServiceError(exc.read().decode("utf-8", errors="replace")) from exc
+        except OSError as exc:
+            raise ServiceError(str(exc)) from exc
+        dim = int(payload["dim"])
+        vectors = np.frombuffer(base64.b64decode(payload["vectors"]), dtype=np.float32)
+        return vectors.reshape(len(paths), dim).copy(), np.asarray(payload["valid"], dtype=bool)
+
+    def iter_embeddings(
+        self,
+        paths: list[str],
+        model_name: str,
+        backend: ml_pipeline.BackendConfig,
+        chunk_size: int = REQUEST_CHUNK,
+    ) -> Iterator[tuple[list[str], np.ndarray, np.ndarray]]:
+        pending: deque[tuple[list[str], Future]] = deque()
+        pool = ThreadPoolExecutor(max_workers=REQUESTS_IN_FLIGHT, thread_name_prefix="embed-client")
+        try:
+            for start in range(0, len(paths), chunk_size):
+                chunk = paths[start : start + chunk_size]
+                pending.append((chunk, pool.submit(self.embed, chunk, model_name, backend)))
+                if len(pending) >= REQUESTS_IN_FLIGHT:
+                    chunk, future = pending.popleft()
+                    yield chunk, *future.result()
+            while pending:
+                chunk, future = pending.popleft()
+                yield chunk, *future.result()
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+
+def connect(url: str | None = None) -> ServiceClient | None:
+    url = url or service_url()
+    if url is None:
+        return None
+    try:
+        with urllib.request.urlopen(f"{url}/health", timeout=PROBE_TIMEOUT_SECONDS) as response:
+            if json.loads(response.read()).get("status") != "ok":
+                return None
+    except (OSError, ValueError):
+        return None
+    return ServiceClient(url)
+
+
+def serve(
+    host: str,
+    port: int,
+    cache_dir: Path,
+    batch_size: int,
+    idle_seconds: float,
+) -> None:
+    service = EmbeddingService(cache_dir, batch_size=batch_size, idle_seconds=idle_seconds)
+
+    def evict_loop() -> None:
+        while True:
+            time.sleep(min(idle_seconds, 30.0))
+            service.evict_idle()
+
+    threading.Thread(target=evict_loop, name="embed-evict", daemon=True).start()
+    with EmbeddingServer((host, port), service) as httpd:
+        logger.info("embedding service on http://%s:%d", host, port)
+        httpd.serve_forever()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run the resident CLIP embedding service.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5010)
+    parser.add_argument("--cache-dir", default="data/server/models", help="exported graph cache")
+    parser.add_argument("-b", "--batch-size", type=int, default=ml_pipeline.DEFAULT_BATCH_SIZE)
+    parser.add_argument(
+        "--idle",
+        type=float,
+        default=IDLE_EVICT_SECONDS,
+        help="seconds before an unused model is unloaded",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    serve(args.host, args.port, Path(args.cache_dir), args.batch_size, args.idle)
+
+
+if __name__ == "__main__":
+    main()
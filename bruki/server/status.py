@@ -0,0 +1,111 @@
+import json
+import threading
+import time
+from pathlib import Path
+
+from bruki.server import database
+
+STATUS_PERSIST_SECONDS = 2.0
+STATUS_IDLE_SECONDS = 10.0
+# Fields that move on every progress tick; changes to anything else are written at once so a
+# restart still sees completed stages, signatures and errors.
+PROGRESS_FIELDS = frozenset(
+    {
+        "processed_images",
+        "total_images",
+        "rate_images_per_second",
+        "eta_seconds",
+        "stage_progress",
+        "skipped_images",
+        "cached_images",
+        "committed_images",
+        "updated_at",
+    }
+)
+
+_BUS_LOCK = threading.Lock()
+_BUSES: dict[Path, "StatusBus"] = {}
+
+
+class StatusBus:
+    def __init__(self, db_path: Path) -> None:
+        self.db_path = db_path
+        self.condition = threading.Condition()
+        self.payload: dict | None = None
+        self.version = 0
+        self.dirty = False
+        self.persisted_at = 0.0
+        self.published_at = 0.0
+
+    def _read(self) -> dict:
+        with database.connection(self.db_path) as conn:
+            row = conn.execute("SELECT payload FROM ml_status WHERE id = 1").fetchone()
+        return {} if row is None else json.loads(row[0])
+
+    def _write(self) -> None:
+        with database.connection(self.db_path) as conn, conn:
+            conn.execute(
+                """
+                INSERT INTO ml_status(id, payload) VALUES (1, ?)
+                ON CONFLICT(id) DO UPDATE SET payload = excluded.payload
+                """,
+                (json.dumps(self.payload, sort_keys=True),),
+            )
+        self.dirty = False
+        self.persisted_at = time.monotonic()
+
+    def _refresh(self) -> None:
+        # Another process (the CLI, a notebook) may own the job; once this process has been
+        # quiet for a while, the database is the source of truth again.
+        if self.payload is not None and time.monotonic() - self.published_at < STATUS_IDLE_SECONDS:
+            return
+        if self.dirty:
+            self._write()
+            return
+        payload = self._read()
+        if payload != self.payload:
+            self.payload = payload
+            self.version += 1
+            self.condition.notify_all()
+
+    def snapshot(self) -> tuple[int, dict]:
+        with self.condition:
+            self._refresh()
+            return self.version, dict(self.payload)
+
+    def publish(self, fields: dict) -> dict:
+        with self.condition:
+            if self.payload is None:
+                self.payload = self._read()
+            changed = {key for key, value in fields.items() if self.payload.get(key) != value}
+            self.payload = {**self.payload, **fields}
+            self.version += 1
+            self.published_at = time.monotonic()
+            self.dirty = True
+            if (
+                changed - PROGRESS_FIELDS
+                or self.published_at - self.persisted_at >= STATUS_PERSIST_SECONDS
+            ):
+                self._write()
+            self.condition.notify_all()
+            return dict(self.payload)
+
+    def flush(self) -> None:
+        with self.condition:
+            if self.dirty:
+                self._write()
+
+    def wait(self, version: int, timeout: float) -> tuple[int, dict]:
+        with self.condition:
+            self.condition.wait_for(lambda: self.version != version, timeout)
+        return self.snapshot()
+
+
+def status_bus(db_path: Path) -> StatusBus:
+    key = db_path.resolve()
+    with _BUS_LOCK:
+        bus = _BUSES.get(key)
+        if bus is None:
+            bus = StatusBus(key)
+            _BUSES[key] = bus
+        return bus
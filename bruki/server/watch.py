@@ -0,0 +1,312 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import threading
+import time
+from pathlib import Path
+
+from bruki import inventory
+from bruki.server import ml as ml_pipeline
+
+WATCH_ENV = "TAGGER_WATCH"
+WATCH_INTERVAL_ENV = "TAGGER_WATCH_INTERVAL"
+WATCH_MODES = ("auto", "inotify", "poll", "off")
+DEFAULT_POLL_SECONDS = 30.0
+DEBOUNCE_SECONDS = 2.0
+MAX_DEBOUNCE_SECONDS = 30.0
+WAIT_SECONDS = 1.0
+NETWORK_FILESYSTEMS = {
+    "9p",
+    "afs",
+    "ceph",
+    "cifs",
+    "davfs",
+    "fuse.rclone",
+    "fuse.sshfs",
+    "glusterfs",
+    "nfs",
+    "nfs4",
+    "smb3",
+    "smbfs",
+}
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+WATCH_MASK = (
+    IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+)
+EVENT_HEADER = struct.Struct("iIII")
+
+logger = logging.getLogger(__name__)
+
+
+class Inotify:
+    def __init__(self) -> None:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code))
+        self.fd = fd
+        self.paths: dict[int, str] = {}
+        self.watched: set[str] = set()
+
+    def add(self, dir_path: str) -> None:
+        if dir_path in self.watched:
+            return
+        wd = self._add_watch(self.fd, os.fsencode(dir_path), WATCH_MASK)
+        if wd < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code), dir_path)
+        self.paths[wd] = dir_path
+        self.watched.add(dir_path)
+
+    def read(self, timeout: float) -> tuple[set[str], bool]:
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set(), False
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return set(), False
+        dirs: set[str] = set()
+        overflow = False
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+                continue
+            dir_path = self.paths.get(wd)
+            if dir_path is None:
+                continue
+            if mask & IN_IGNORED:
+                del self.paths[wd]
+                self.watched.discard(dir_path)
+            elif mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                dirs.add(os.path.dirname(dir_path))
+            else:
+                dirs.add(dir_path)
+        return dirs, overflow
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+def watch_mode() -> str:
+    value = os.environ.get(WATCH_ENV, "auto").strip().lower()
+    if value in {"", "0", "false", "no"}:
+        return "off"
+    if value not in WATCH_MODES:
+        raise ValueError(f"{WATCH_ENV} must be one of {', '.join(WATCH_MODES)}")
+    return value
+
+
+def filesystem_type(path: Path) -> str:
+    try:
+        mounts = Path("/proc/mounts").read_text(encoding="utf-8").splitlines()
+    except OSError:
+        return ""
+    target = str(path.expanduser().resolve())
+    best_mount, best_type = "", ""
+    for line in mounts:
+        fields = line.split()
+        if len(fields) < 3:
+            continue
+        mount_point = fields[1].replace("\\040", " ")
+        inside = target == mount_point or target.startswith(mount_point.rstrip("/") + "/")
+        if inside and len(mount_point) > len(best_mount):
+            best_mount, best_type = mount_point, fields[2]
+    return best_type
+
+
+class IngestWatcher:
+    def __init__(
+        self,
+        config_path: Path,
+        db_path: Path,
+        model_name: str = ml_pipeline.MODEL_NAME,
+        batch_size: int = ml_pipeline.DEFAULT_BATCH_SIZE,
+        backend: ml_pipeline.BackendConfig = ml_pipeline.BackendConfig(),
+        mode: str = "auto",
+        poll_seconds: float = DEFAULT_POLL_SECONDS,
+        debounce_seconds: float = DEBOUNCE_SECONDS,
+    ) -> None:
+        self.config_path = config_path
+        self.db_path = db_path
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.backend = backend
+        self.mode = mode
+        self.poll_seconds = poll_seconds
+        self.debounce_seconds = debounce_seconds
+        self.notifier: Inotify | None = None
+        self.polling = mode == "poll"
+        self.sources: list[inventory.SourceScan] = []
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="ingest-watch", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self.notifier is not None:
+            self.notifier.close()
+            self.notifier = None
+
+    def _open_notifier(self) -> None:
+        network_roots = [
+            source.root
+            for source in self.sources
+            if filesystem_type(source.root) in NETWORK_FILESYSTEMS
+        ]
+        if network_roots:
+            logger.info("polling network sources: %s", ", ".join(map(str, network_roots)))
+            self.polling = True
+        if self.mode == "poll":
+            return
+        try:
+            self.notifier = Inotify()
+        except (OSError, AttributeError) as exc:
+            logger.warning("inotify unavailable (%s); polling instead", exc)
+            self.polling = True
+            return
+        self._watch_new_dirs()
+
+    def _watch_new_dirs(self) -> None:
+        if self.notifier is None:
+            return
+        for dir_path in inventory.read_dirs(self.db_path, self.sources):
+            try:
+                self.notifier.add(dir_path)
+            except OSError as exc:
+                if exc.errno != errno.ENOSPC:
+                    continue
+                logger.warning("inotify watch limit reached; polling instead")
+                self.notifier.close()
+                self.notifier = None
+                self.polling = True
+                return
+
+    def _flush(self, dirs: set[str] | None) -> bool:
+        try:
+            result = ml_pipeline.ingest_changes(
+                self.config_path,
+                self.db_path,
+                dirs=dirs,
+                model_name=self.model_name,
+                batch_size=self.batch_size,
+                backend=self.backend,
+            )
+        except Exception:
+            logger.exception("ingest failed")
+            return True
+        if result is None:
+            return False
+        if result["full_run"]:
+            ml_pipeline.start_job(
+                self.config_path,
+                self.db_path,
+                model_name=self.model_name,
+                batch_size=self.batch_size,
+                backend=self.backend,
+            )
+        elif result["ingested_images"] or result["removed_images"]:
+            logger.info(
+                "ingested %d new or changed images, removed %d",
+                result["ingested_images"],
+                result["removed_images"],
+            )
+        self._watch_new_dirs()
+        return True
+
+    def _run(self) -> None:
+        # A targeted scan over no directories only resolves the source rows.
+        self.sources = ml_pipeline.screenshot_sources(self.config_path, self.db_path, dirs=set())
+        self._open_notifier()
+        pending: set[str] = set()
+        full_pending = True
+        first_event = last_event = time.monotonic() - self.debounce_seconds
+        next_poll = time.monotonic() + self.poll_seconds
+        while not self._stop.is_set():
+            if self.notifier is not None:
+                dirs, overflow = self.notifier.read(WAIT_SECONDS)
+            else:
+                self._stop.wait(WAIT_SECONDS)
+                dirs, overflow = set(), False
+            now = time.monotonic()
+            if dirs or overflow:
+                if not pending and not full_pending:
+                    first_event = now
+                pending |= dirs
+                full_pending |= overflow
+                last_event = now
+            if self.polling and now >= next_poll:
+                if not pending and not full_pending:
+                    first_event = now - self.debounce_seconds
+                full_pending = True
+                last_event = now - self.debounce_seconds
+                next_poll = now + self.poll_seconds
+            if not pending and not full_pending:
+                continue
+            quiet = now - last_event >= self.debounce_seconds
+            if (quiet or now - first_event >= MAX_DEBOUNCE_SECONDS) and self._flush(
+                None if full_pending else pending
+            ):
+                pending = set()
+                full_pending = False
+
+
+def start_watcher(
+    config_path: Path,
+    db_path: Path,
+    model_name: str = ml_pipeline.MODEL_NAME,
+    batch_size: int = ml_pipeline.DEFAULT_BATCH_SIZE,
+    backend: ml_pipeline.BackendConfig = ml_pipeline.BackendConfig(),
+) -> IngestWatcher | None:
+    mode = watch_mode()
+    if mode == "off":
+        return None
+    if mode == "inotify":
+        # Fail at startup instead of quietly polling when inotify was asked for explicitly.
+        try:
+            Inotify().close()
+        except (OSError, AttributeError) as exc:
+            raise RuntimeError(f"{WATCH_ENV}=inotify but inotify is unavailable: {exc}") from exc
+    watcher = IngestWatcher(
+        config_path,
+        db_path,
+        model_name=model_name,
+        batch_size=batch_size,
+        backend=backend,
+        mode=mode,
+        poll_seconds=float(os.environ.get(WATCH_INTERVAL_ENV, DEFAULT_POLL_SECONDS)),
+    )
+    watcher.start()
+    return watcher